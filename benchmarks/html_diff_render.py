@@ -0,0 +1,73 @@
+"""
+Benchmark `html_diff_render()` on synthetic documents with thousands of small,
+alternating changes. For each document size, this prints the total time and
+the time spent assembling the diff from the matched tokens. Both should grow
+roughly linearly with the number of changes.
+
+Run from the root of the repository:
+
+    python benchmarks/html_diff_render.py [SIZE ...]
+"""
+import sys
+import time
+from web_monitoring import html_diff_render as renderer
+
+
+DEFAULT_SIZES = (1000, 2000, 4000, 8000)
+
+
+def list_document(size, version):
+    "A list where every other item has a changed word."
+    items = ''.join(f'<li>Item {index} is {version if index % 2 else "same"}</li>'
+                    for index in range(size))
+    return f'<html><body><ul>{items}</ul></body></html>'
+
+
+def paragraph_document(size, version):
+    "Paragraphs where every other one has a changed, emphasized word."
+    paragraphs = ''.join(
+        f'<p>Paragraph {index} is <em>{version}</em> now.</p>' if index % 2
+        else f'<p>Paragraph {index} is the same.</p>'
+        for index in range(size))
+    return f'<html><body>{paragraphs}</body></html>'
+
+
+class StageTimer:
+    "Wraps a function in `renderer` and adds up the time spent in it."
+
+    def __init__(self, name):
+        self.name = name
+        self.original = getattr(renderer, name)
+        self.elapsed = 0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.original(*args, **kwargs)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def __enter__(self):
+        setattr(renderer, self.name, self)
+        return self
+
+    def __exit__(self, *exc_info):
+        setattr(renderer, self.name, self.original)
+
+
+def run(sizes):
+    for make_document in (list_document, paragraph_document):
+        print(make_document.__name__)
+        for size in sizes:
+            a = make_document(size, 'old')
+            b = make_document(size, 'new')
+            with StageTimer('assemble_diffs') as assembly:
+                start = time.perf_counter()
+                renderer.html_diff_render(a, b, include='all')
+                total = time.perf_counter() - start
+            print(f'  {size:>7} blocks: {total:7.3f}s total, '
+                  f'{assembly.elapsed:7.3f}s assembling')
+
+
+if __name__ == '__main__':
+    run([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,52 @@
+"""
+Benchmark `links_diff_json()` and `links_diff_html()` on synthetic pages with
+many links, where some links are unchanged, some have changed text or URLs,
+and some were added or removed. Times should grow roughly linearly with the
+number of links.
+
+Run from the root of the repository:
+
+    python benchmarks/links_diff.py [SIZE ...]
+"""
+import sys
+import time
+from web_monitoring import links_diff
+
+
+DEFAULT_SIZES = (2500, 5000, 10000, 20000)
+
+
+def link_page(size, version):
+    """
+    A list of links where every 7th has changed text, every 11th has a changed
+    URL, and every 13th is only in one version of the page.
+    """
+    items = []
+    for index in range(size):
+        if index % 13 == 0:
+            href = f'/{version}/{index}'
+        elif index % 11 == 0:
+            href = f'/page/{index}?v={version}'
+        else:
+            href = f'/page/{index}'
+        text = f'Page <b>{index}</b>'
+        if index % 7 == 0:
+            text += f' ({version})'
+        items.append(f'<li><a href="{href}">{text}<img alt="icon"></a></li>')
+    return f'<html><body><ul>{"".join(items)}</ul></body></html>'
+
+
+def run(sizes):
+    for size in sizes:
+        a = link_page(size, 'old')
+        b = link_page(size, 'new')
+        times = []
+        for differ in (links_diff.links_diff_json, links_diff.links_diff_html):
+            start = time.perf_counter()
+            differ(a, b)
+            times.append(time.perf_counter() - start)
+        print(f'  {size:>7} links: {times[0]:7.3f}s json, {times[1]:7.3f}s html')
+
+
+if __name__ == '__main__':
+    run([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES)
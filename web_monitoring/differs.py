@@ -1,11 +1,16 @@
-from bs4 import Comment
+from collections import Counter
 from diff_match_patch import diff, diff_bytes
-from web_monitoring.utils import get_color_palette
+from web_monitoring import __version__
+from web_monitoring.utils import (FileCache, get_color_palette, hash_content,
+                                  longest_increasing_pairs, LRUCache,
+                                  parallel_map)
 from htmldiffer.diff import HTMLDiffer
 import htmltreediff
 import html5_parser
+import os
 import re
 import sys
+import time
 import web_monitoring.pagefreezer
 
 
@@ -17,6 +22,11 @@ diff_codes = {'=': 0, '-': -1, '+': 1}
 
 REPEATED_BLANK_LINES = re.compile(r'([^\S\n]*\n\s*){2,}')
 
+# How many documents' visible text to keep in memory (in each process) so a
+# version that is part of several diffs is only parsed once.
+TEXT_CACHE_SIZE = int(os.environ.get('DIFFER_TEXT_CACHE_SIZE', 64))
+_text_cache = LRUCache(TEXT_CACHE_SIZE)
+
 
 def compare_length(a_body, b_body):
     "Compute difference in response body lengths. (Does not compare contents.)"
@@ -28,37 +38,84 @@ def identical_bytes(a_body, b_body):
     return {'diff': a_body == b_body}
 
 
-def _get_text(html):
-    "Extract textual content from HTML."
-    soup = html5_parser.parse(html, treebuilder='soup', return_root=False)
-    [element.extract() for element in
-     soup.find_all(string=lambda text: isinstance(text, Comment))]
-    return soup.find_all(text=True)
-
-
 INVISIBLE_TAGS = set(['style', 'script', '[document]', 'head', 'title'])
-_RE_HTML_COMMENT = re.compile('<!--.*-->')
 
 
-def _is_visible(element):
-    "A best-effort guess at whether an HTML element is visible on the page."
+def _iter_visible_text(document):
+    """
+    Yield each piece of text in an lxml document that is a best-effort guess
+    at being visible on the page, in document order. Text directly inside one
+    of the `INVISIBLE_TAGS` and comments are skipped.
+    """
     # adapted from https://www.quora.com/How-can-I-extract-only-text-data-from-HTML-pages
-    if element.parent.name in INVISIBLE_TAGS:
-        return False
-    elif _RE_HTML_COMMENT.match(str(element.encode('utf-8'))):
-        return False
-    return True
+    if document.text and document.tag not in INVISIBLE_TAGS:
+        yield document.text
+    # Walk the tree with a stack of child iterators, so an element's tail can
+    # be yielded after all the text inside it without recursion.
+    stack = [(document, iter(document))]
+    while stack:
+        element, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            if stack and element.tail and stack[-1][0].tag not in INVISIBLE_TAGS:
+                yield element.tail
+        elif isinstance(child.tag, str):
+            if child.text and child.tag not in INVISIBLE_TAGS:
+                yield child.text
+            stack.append((child, iter(child)))
+        elif child.tail and element.tag not in INVISIBLE_TAGS:
+            # A comment or processing instruction; only its tail is text.
+            yield child.tail
 
 
 def _get_visible_text(html):
-    text = ' '.join(filter(_is_visible, _get_text(html)))
+    document = html5_parser.parse(html)
+    text = ' '.join(_iter_visible_text(document))
     return REPEATED_BLANK_LINES.sub('\n\n', text).strip()
 
 
+def extract_visible_text(html):
+    """
+    Extract the text from an HTML document that is (probably) visible on the
+    page.
+
+    The text is cached by the SHA-256 hash of `html`, in memory and, if the
+    `DIFFER_TOKEN_CACHE_PATH` environment variable is set, on disk, where it
+    is shared with other processes.
+    """
+    # HTML decoded from a bad response can have lone surrogates in it.
+    key = hash_content(html.encode('utf-8', 'surrogatepass'))
+    text = _text_cache.get(key)
+    if text is None:
+        file_cache = _get_text_file_cache()
+        data = file_cache and file_cache.get(key)
+        if data is None:
+            text = _get_visible_text(html)
+            if file_cache:
+                file_cache.set(key, text.encode('utf-8', 'surrogatepass'))
+        else:
+            text = data.decode('utf-8', 'surrogatepass')
+        _text_cache.set(key, text)
+    return text
+
+
+def _get_text_file_cache():
+    """
+    Get a `FileCache` for visible text if the `DIFFER_TOKEN_CACHE_PATH`
+    environment variable is set. Like tokens in `html_diff_render`, each
+    version of this package has a separate cache.
+    """
+    path = os.environ.get('DIFFER_TOKEN_CACHE_PATH')
+    if path:
+        return FileCache(os.path.join(path, 'text', __version__))
+    return None
+
+
 def side_by_side_text(a_text, b_text):
     "Extract the visible text from both response bodies."
-    return {'diff': {'a_text': _get_visible_text(a_text),
-                     'b_text': _get_visible_text(b_text)}}
+    return {'diff': {'a_text': extract_visible_text(a_text),
+                     'b_text': extract_visible_text(b_text)}}
 
 
 def pagefreezer(a_url, b_url):
@@ -70,12 +127,18 @@ def pagefreezer(a_url, b_url):
     return {'diff': obj.query_result}
 
 
-def compute_dmp_diff(a_text, b_text, timelimit=4):
+def compute_dmp_diff(a_text, b_text, timelimit=4, counts_only=False):
+    """
+    Diff two strings (or two bytes objects) with diff-match-patch. Returns a
+    list of `(change_code, text)` tuples, or `(change_code, length)` tuples
+    if `counts_only` is true, which is faster and uses less memory.
+    """
     if (isinstance(a_text, str) and isinstance(b_text, str)):
-        changes = diff(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True, counts_only=False)
+        changes = diff(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True,
+                       counts_only=counts_only)
     elif (isinstance(a_text, bytes) and isinstance(b_text, bytes)):
         changes = diff_bytes(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True,
-                             counts_only=False)
+                             counts_only=counts_only)
     else:
         raise TypeError("Both the texts should be either of type 'str' or 'bytes'.")
 
@@ -83,9 +146,236 @@ def compute_dmp_diff(a_text, b_text, timelimit=4):
     return result
 
 
-def html_text_diff(a_text, b_text):
+def compute_segmented_dmp_diff(a_text, b_text, timelimit=4, workers=None,
+                               paragraphs=False, counts_only=False):
     """
-    Diff the visible textual content of an HTML document.
+    Like `compute_dmp_diff()`, but first splits the texts into segments at
+    lines (or paragraphs, if `paragraphs` is true) that are unchanged and only
+    use diff-match-patch on the segments in between. If `workers` is more than
+    one, those segments are diffed in parallel in that many processes.
+
+    `timelimit` is for the whole diff: it's split up between the changed
+    segments by size, and time a segment doesn't use is passed on to the
+    segments after it. If a segment runs out of time, only that segment is
+    diffed roughly, instead of the whole text.
+
+    Like `compute_dmp_diff()`, this returns `(change_code, length)` tuples
+    instead of the changed text if `counts_only` is true.
+    """
+    jobs = [(a_text[a_start:a_end], b_text[b_start:b_end])
+            for a_start, a_end, b_start, b_end
+            in _segment_by_lines(a_text, b_text, paragraphs=paragraphs)]
+    workers = min(int(workers or 1), len(jobs))
+    if workers < 2:
+        results = _diff_segments(jobs, timelimit, counts_only)
+    else:
+        # Segments are diffed at the same time, so each worker gets about
+        # `timelimit` for all the segments it diffs.
+        if timelimit and timelimit > 0:
+            total = sum(len(a) + len(b) for a, b in jobs if a != b) or 1
+            jobs = [(a, b, max(MINIMUM_SEGMENT_TIMELIMIT,
+                               min(timelimit, timelimit * workers
+                                   * (len(a) + len(b)) / total)),
+                     counts_only)
+                    for a, b in jobs]
+        else:
+            jobs = [(a, b, timelimit, counts_only) for a, b in jobs]
+        results = parallel_map(_diff_segment, jobs, workers)
+
+    result = []
+    for changes in results:
+        for change in changes:
+            if result and result[-1][0] == change[0]:
+                result[-1] = (change[0], result[-1][1] + change[1])
+            else:
+                result.append(change)
+    return result
+
+
+# diff-match-patch treats a time limit of 0 as no limit, so segments that
+# are diffed after a diff's time limit has passed get this long instead.
+MINIMUM_SEGMENT_TIMELIMIT = 0.001
+
+
+def _diff_segments(segments, timelimit, counts_only=False):
+    """
+    Diff a list of `(a_text, b_text)` segments in order, sharing `timelimit`
+    between them (see `compute_segmented_dmp_diff()`).
+    """
+    if not timelimit or timelimit <= 0:
+        return [_diff_segment((a, b, 0, counts_only)) for a, b in segments]
+
+    deadline = time.perf_counter() + timelimit
+    remaining_size = sum(len(a) + len(b) for a, b in segments if a != b)
+    results = []
+    for a_text, b_text in segments:
+        segment_timelimit = 0
+        if a_text != b_text:
+            size = len(a_text) + len(b_text)
+            segment_timelimit = max(MINIMUM_SEGMENT_TIMELIMIT,
+                                    (deadline - time.perf_counter())
+                                    * size / remaining_size)
+            remaining_size -= size
+        results.append(_diff_segment((a_text, b_text, segment_timelimit,
+                                      counts_only)))
+    return results
+
+
+def _diff_segment(job):
+    a_text, b_text, timelimit, counts_only = job
+    if a_text == b_text:
+        if not a_text:
+            return []
+        return [(0, len(a_text) if counts_only else a_text)]
+    return compute_dmp_diff(a_text, b_text, timelimit=timelimit,
+                            counts_only=counts_only)
+
+
+# Splits text after blank lines (without splitting up runs of them).
+PARAGRAPH_BREAK = re.compile(r'(?<=\n\n)(?!\n)')
+
+
+def _segment_by_lines(a_text, b_text, paragraphs=False):
+    """
+    Split two texts into corresponding segments, using lines that occur
+    exactly once in each text as anchors (much like the "patience" diff
+    algorithm). Returns a list of `(a_start, a_end, b_start, b_end)` string
+    offsets. Segments alternate between runs of anchor lines, which are the
+    same in both texts, and the changed text between them.
+
+    If `paragraphs` is true, the texts are first split at unique paragraphs
+    (separated by blank lines), which are more often unique than lines in
+    text like the visible text of a page, and then the changed segments
+    between those are split at lines.
+    """
+    if not paragraphs:
+        return _segment_by_units(a_text, b_text,
+                                 a_text.splitlines(keepends=True),
+                                 b_text.splitlines(keepends=True))
+
+    segments = []
+    for segment in _segment_by_units(a_text, b_text,
+                                     _split_paragraphs(a_text),
+                                     _split_paragraphs(b_text)):
+        a_start, a_end, b_start, b_end = segment
+        a_part = a_text[a_start:a_end]
+        b_part = b_text[b_start:b_end]
+        if a_part == b_part:
+            segments.append(segment)
+        else:
+            segments.extend((a_start + a_sub_start, a_start + a_sub_end,
+                             b_start + b_sub_start, b_start + b_sub_end)
+                            for a_sub_start, a_sub_end, b_sub_start, b_sub_end
+                            in _segment_by_lines(a_part, b_part))
+    return segments
+
+
+def _split_paragraphs(text):
+    return [part for part in PARAGRAPH_BREAK.split(text) if part]
+
+
+def _segment_by_units(a_text, b_text, a_lines, b_lines):
+    """
+    Do the work of `_segment_by_lines()` with the texts already split up into
+    lines (or other units).
+    """
+    a_offsets = _line_offsets(a_lines)
+    b_offsets = _line_offsets(b_lines)
+
+    a_counts = Counter(a_lines)
+    b_counts = Counter(b_lines)
+    b_indexes = {line: index for index, line in enumerate(b_lines)
+                 if b_counts[line] == 1}
+    anchors = longest_increasing_pairs([
+        (index, b_indexes[line])
+        for index, line in enumerate(a_lines)
+        if a_counts[line] == 1 and line in b_indexes])
+
+    segments = []
+    a_index = b_index = 0
+    for a_anchor, b_anchor in anchors:
+        if a_index < a_anchor or b_index < b_anchor or not segments:
+            segments.append([a_offsets[a_index], a_offsets[a_anchor],
+                             b_offsets[b_index], b_offsets[b_anchor]])
+            segments.append([a_offsets[a_anchor], a_offsets[a_anchor],
+                             b_offsets[b_anchor], b_offsets[b_anchor]])
+        # Extend the current run of anchor lines.
+        segments[-1][1] = a_offsets[a_anchor + 1]
+        segments[-1][3] = b_offsets[b_anchor + 1]
+        a_index = a_anchor + 1
+        b_index = b_anchor + 1
+    segments.append([a_offsets[a_index], len(a_text),
+                     b_offsets[b_index], len(b_text)])
+
+    return [tuple(segment) for segment in segments
+            if segment[0] < segment[1] or segment[2] < segment[3]]
+
+
+def _line_offsets(lines):
+    "Get the offset of the start of each line, plus the end of the last one."
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    return offsets
+
+
+# Texts at least this long are split up into segments before diffing them
+# with diff-match-patch (see `compute_segmented_dmp_diff()`).
+SEGMENTED_DIFF_MINIMUM_SIZE = 100000
+
+
+def _should_segment(a_text, b_text):
+    return max(len(a_text), len(b_text)) >= SEGMENTED_DIFF_MINIMUM_SIZE
+
+
+def _summarize_dmp_diff(a_text, b_text, changes):
+    """
+    Count the changes in a diff of two strings (as `(change_code, length)`
+    tuples, like from `compute_dmp_diff(counts_only=True)`) and how many
+    characters and UTF-8 bytes were inserted and deleted.
+    """
+    summary = {'change_count': 0,
+               'insertions_count': 0,
+               'deletions_count': 0,
+               'inserted_chars': 0,
+               'deleted_chars': 0,
+               'inserted_bytes': 0,
+               'deleted_bytes': 0}
+    # Only non-ASCII text has to be encoded to count its bytes.
+    a_ascii = a_text.isascii()
+    b_ascii = b_text.isascii()
+    a_offset = b_offset = 0
+    for change_code, length in changes:
+        if change_code == -1:
+            summary['deletions_count'] += 1
+            summary['deleted_chars'] += length
+            summary['deleted_bytes'] += length if a_ascii else len(
+                a_text[a_offset:a_offset + length].encode('utf-8',
+                                                         'surrogatepass'))
+        elif change_code == 1:
+            summary['insertions_count'] += 1
+            summary['inserted_chars'] += length
+            summary['inserted_bytes'] += length if b_ascii else len(
+                b_text[b_offset:b_offset + length].encode('utf-8',
+                                                         'surrogatepass'))
+        if change_code != 1:
+            a_offset += length
+        if change_code != -1:
+            b_offset += length
+    summary['change_count'] = (summary['insertions_count']
+                               + summary['deletions_count'])
+    return summary
+
+
+def html_text_diff(a_text, b_text, counts_only=False):
+    """
+    Diff the visible textual content of an HTML document. Large texts are
+    split up at unchanged paragraphs and lines before diffing them, like in
+    `html_source_diff()`.
+
+    If `counts_only` is true, the result has no `diff`, just the number of
+    changes, insertions, and deletions and how many characters and bytes
+    were inserted and deleted. This is much faster and smaller.
 
     Example
     ------
@@ -94,19 +384,37 @@ def html_text_diff(a_text, b_text):
     [[-1, 'Delet'], [1, 'Add'], [0, 'ed Unchanged']]
     """
 
-    t1 = _get_visible_text(a_text)
-    t2 = _get_visible_text(b_text)
+    t1 = extract_visible_text(a_text)
+    t2 = extract_visible_text(b_text)
 
     TIMELIMIT = 2  # seconds
-    res = compute_dmp_diff(t1, t2, timelimit=TIMELIMIT)
+    if _should_segment(t1, t2):
+        res = compute_segmented_dmp_diff(t1, t2, timelimit=TIMELIMIT,
+                                         paragraphs=True,
+                                         counts_only=counts_only)
+    else:
+        res = compute_dmp_diff(t1, t2, timelimit=TIMELIMIT,
+                               counts_only=counts_only)
+    if counts_only:
+        return _summarize_dmp_diff(t1, t2, res)
     count = len([[type_, string_] for type_, string_ in res if type_])
     return {'change_count': count, 'diff': res}
 
 
-def html_source_diff(a_text, b_text):
+def html_source_diff(a_text, b_text, workers=None, counts_only=False):
     """
     Diff the full source code of an HTML document.
 
+    Large documents (or any documents, if `workers` is more than one) are
+    split up at unchanged lines and only the changed parts are diffed (see
+    `compute_segmented_dmp_diff()`), so the diff stays precise instead of
+    giving up when it runs out of time. If `workers` is more than one, the
+    changed parts are diffed in parallel in that many processes. The diff
+    may differ slightly since changes can't cross unchanged lines.
+
+    If `counts_only` is true, the result only has counts of the changes (see
+    `html_text_diff()`).
+
     Example
     ------
     >>> html_source_diff('<p>Deleted</p><p>Unchanged</p>',
@@ -114,7 +422,15 @@ def html_source_diff(a_text, b_text):
     [[0, '<p>'], [-1, 'Delet'], [1, 'Add'], [0, 'ed</p><p>Unchanged</p>']]
     """
     TIMELIMIT = 2  # seconds
-    res = compute_dmp_diff(a_text, b_text, timelimit=TIMELIMIT)
+    if (workers and int(workers) > 1) or _should_segment(a_text, b_text):
+        res = compute_segmented_dmp_diff(a_text, b_text, timelimit=TIMELIMIT,
+                                         workers=workers,
+                                         counts_only=counts_only)
+    else:
+        res = compute_dmp_diff(a_text, b_text, timelimit=TIMELIMIT,
+                               counts_only=counts_only)
+    if counts_only:
+        return _summarize_dmp_diff(a_text, b_text, res)
     count = len([[type_, string_] for type_, string_ in res if type_])
     return {'change_count': count, 'diff': res}
 
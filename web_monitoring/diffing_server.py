@@ -4,6 +4,8 @@ from docopt import docopt
 import hashlib
 import inspect
 import functools
+import json
+import multiprocessing
 import os
 import re
 import cchardet
@@ -29,6 +31,15 @@ sentry_sdk.integrations.logging.ignore_logger('tornado.access')
 
 DIFFER_PARALLELISM = os.environ.get('DIFFER_PARALLELISM', 10)
 
+# The most processes a single diff can be spread across (see the `workers`
+# parameter of `html_diff_render()` and `html_source_diff()`). Each diff
+# process can start this many more processes, so it's off by default.
+DIFFER_MAX_WORKERS = int(os.environ.get('DIFFER_MAX_WORKERS', 1))
+
+# Streamed responses are sent from diff worker processes in pieces of about
+# this many bytes.
+STREAM_CHUNK_SIZE = 65536
+
 # Map tokens in the REST API to functions in modules.
 # The modules do not have to be part of the web_monitoring package.
 DIFF_ROUTES = {
@@ -162,6 +173,24 @@ class DiffHandler(BaseHandler):
             return
 
         query_params = self.decode_query_params()
+        # Differs that support it can report how long each part of the diff
+        # took (see `timings` in `html_diff_render()`).
+        if 'timings' in query_params:
+            query_params['timings'] = \
+                query_params['timings'].strip().lower() == 'true'
+        # If `stream=true`, the response is sent in chunks as it's produced
+        # (see `stream_diff()`).
+        if 'stream' in query_params:
+            query_params['stream'] = \
+                query_params['stream'].strip().lower() == 'true'
+        # If `counts_only=true`, differs that support it only count the
+        # changes instead of producing a diff.
+        if 'counts_only' in query_params:
+            query_params['counts_only'] = \
+                query_params['counts_only'].strip().lower() == 'true'
+        if not self.clean_workers_param(query_params):
+            return
+
         # The logic here is a bit tortured in order to allow one or both URLs
         # to be local files, while still optimizing the common case of two
         # remote URLs that we want to fetch in parallel.
@@ -183,14 +212,41 @@ class DiffHandler(BaseHandler):
         if not all(content):
             return
 
+        if query_params.get('stream'):
+            yield self.stream_diff(func, content[0], content[1], query_params,
+                                   {'version': web_monitoring.__version__,
+                                    'type': differ})
+            return
+
         # Pass the bytes and any remaining args to the diffing function.
         res = yield self.diff(func, content[0], content[1], query_params)
         res['version'] = web_monitoring.__version__
         # Echo the client's request unless the differ func has specified
         # somethine else.
         res.setdefault('type', differ)
+        if res.get('timings'):
+            self.set_header('Server-Timing', _format_server_timing(res['timings']))
         self.write(res)
 
+    def clean_workers_param(self, query_params):
+        """
+        Validate the `workers` query parameter and limit it to
+        `DIFFER_MAX_WORKERS`. Returns false (after sending an error response)
+        if it's not valid.
+        """
+        if 'workers' not in query_params:
+            return True
+        try:
+            workers = int(query_params['workers'])
+            if workers < 1:
+                raise ValueError()
+        except ValueError:
+            self.send_error(400, reason='The `workers` query parameter must '
+                                        'be a positive integer.')
+            return False
+        query_params['workers'] = min(workers, DIFFER_MAX_WORKERS)
+        return True
+
     @tornado.gen.coroutine
     def fetch_diffable_content(self, url, expected_hash, query_params):
         """
@@ -261,14 +317,90 @@ class DiffHandler(BaseHandler):
         Actually do a diff between two pieces of content, optionally retrying
         if the process pool that executes the diff breaks.
         """
+        result = yield self.call_in_worker(tries, caller, func, a, b, **params)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def call_in_worker(self, tries, worker, *args, **kwargs):
+        """
+        Call `worker(*args, **kwargs)` in the diff executor, retrying up to
+        `tries` times if the process pool breaks.
+        """
         executor = self.get_diff_executor()
         for attempt in range(tries):
             try:
-                result = yield executor.submit(caller, func, a, b, **params)
+                result = yield executor.submit(worker, *args, **kwargs)
                 raise tornado.gen.Return(result)
             except concurrent.futures.process.BrokenProcessPool:
                 executor = self.get_diff_executor(reset=True)
 
+    @tornado.gen.coroutine
+    def stream_diff(self, func, a, b, params, extra_fields, tries=2):
+        """
+        Like `diff()`, but write the result out as it's produced. The worker
+        process sends back the JSON-encoded result in chunks (see
+        `_stream_caller()`), which are written with chunked transfer encoding
+        (and compressed incrementally if the client accepts gzip), so the
+        whole result is never held in memory here.
+
+        `extra_fields` are added to the result if the differ didn't set them.
+        """
+        yield self.stream_from_worker(tries, 'application/json; charset=UTF-8',
+                                      _stream_caller, extra_fields, func, a, b,
+                                      **params)
+
+    @tornado.gen.coroutine
+    def stream_from_worker(self, tries, content_type, worker, *args, **kwargs):
+        """
+        Call `worker(connection, *args, **kwargs)` in the diff executor and
+        write out the bytes it sends over `connection` as they arrive. Like
+        `call_in_worker()`, this retries up to `tries` times if the process
+        pool breaks, as long as nothing has been written out yet.
+        """
+        executor = self.get_diff_executor()
+        for attempt in range(tries):
+            try:
+                yield self._stream_from_executor(executor, content_type,
+                                                 worker, *args, **kwargs)
+                return
+            except concurrent.futures.process.BrokenProcessPool:
+                if self._headers_written or attempt == tries - 1:
+                    raise
+                executor = self.get_diff_executor(reset=True)
+
+    @tornado.gen.coroutine
+    def _stream_from_executor(self, executor, content_type, worker, *args,
+                              **kwargs):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        try:
+            future = executor.submit(worker, sender, *args, **kwargs)
+
+            # Everything the worker sends is in the pipe before its future
+            # finishes, so an empty message afterward marks the end of the
+            # data, whether the diff succeeded or not.
+            def end_stream(future):
+                try:
+                    sender.send_bytes(b'')
+                except OSError:
+                    # The request was already closed.
+                    pass
+            future.add_done_callback(end_stream)
+
+            loop = tornado.ioloop.IOLoop.current()
+            while True:
+                chunk = yield loop.run_in_executor(None, receiver.recv_bytes)
+                if not chunk:
+                    break
+                if not self._headers_written:
+                    self.set_header('Content-Type', content_type)
+                self.write(chunk)
+                yield self.flush()
+            # Raise any errors from the diff.
+            yield future
+        finally:
+            receiver.close()
+            sender.close()
+
     # NOTE: this doesn't do anything async, but if we change it to do so, we
     # need to add a lock (either asyncio.Lock or tornado.locks.Lock).
     def get_diff_executor(self, reset=False):
@@ -323,6 +455,113 @@ class DiffHandler(BaseHandler):
         self.finish(response)
 
 
+def _stream_caller(connection, extra_fields, func, a, b, **query_params):
+    """
+    Call a differ (see `caller()`) and send its result, encoded as JSON, over
+    a `multiprocessing.Connection` in chunks of about `STREAM_CHUNK_SIZE`
+    bytes. Any values in the result that are iterators of strings (like the
+    documents from `html_diff_render(stream=True)`) are sent as they are
+    iterated, and encoded as a single JSON string.
+    """
+    result = caller(func, a, b, **query_params)
+    for key, value in extra_fields.items():
+        result.setdefault(key, value)
+
+    _send_chunks(connection, _iter_json(result))
+
+
+def _stream_series_caller(connection, extra_fields, responses,
+                          **query_params):
+    """
+    Diff a series of versions of a page (see `SeriesHandler`) and send each
+    diff over a `multiprocessing.Connection` as a line of JSON, like
+    `_stream_caller()`. Each diff's documents are only rendered as they are
+    sent, and versions are only decoded when the series gets to them.
+    """
+    func = web_monitoring.html_diff_render.html_diff_render_series
+    parameters = inspect.signature(func).parameters
+    kwargs = {name: value for name, value in query_params.items()
+              if name in parameters and name not in ('texts', 'headers')}
+    raise_if_binary = not query_params.get('ignore_decoding_errors', False)
+    texts = (_decode_body(response, response.request.url,
+                          raise_if_binary=raise_if_binary)
+             for response in responses)
+    headers = (response.headers for response in responses)
+
+    def iter_lines():
+        for a_index, b_index, result in func(texts, headers, stream=True,
+                                             **kwargs):
+            result = {'a': a_index,
+                      'b': b_index,
+                      'a_url': responses[a_index].request.url,
+                      'b_url': responses[b_index].request.url,
+                      **result}
+            for key, value in extra_fields.items():
+                result.setdefault(key, value)
+            yield from _iter_json(result)
+            yield '\n'
+
+    _send_chunks(connection, iter_lines())
+
+
+def _send_chunks(connection, texts):
+    """
+    Send an iterable of strings over a `multiprocessing.Connection` as UTF-8
+    bytes, in chunks of about `STREAM_CHUNK_SIZE`.
+    """
+    buffer = []
+    size = 0
+    for text in texts:
+        buffer.append(text)
+        size += len(text)
+        if size >= STREAM_CHUNK_SIZE:
+            connection.send_bytes(''.join(buffer).encode('utf-8'))
+            buffer = []
+            size = 0
+    if buffer:
+        connection.send_bytes(''.join(buffer).encode('utf-8'))
+
+
+def _iter_json(result):
+    """
+    Encode a dict as JSON in pieces. Values that are strings or iterators
+    of strings are encoded a chunk at a time.
+    """
+    yield '{'
+    for index, (key, value) in enumerate(result.items()):
+        if index:
+            yield ', '
+        yield f'{json.dumps(key)}: '
+        if isinstance(value, str):
+            value = _iter_slices(value, STREAM_CHUNK_SIZE)
+        elif not hasattr(value, '__next__'):
+            yield json.dumps(value)
+            continue
+
+        yield '"'
+        for chunk in value:
+            # Strip the quotes to get just the escaped contents.
+            yield json.dumps(chunk)[1:-1]
+        yield '"'
+    yield '}'
+
+
+def _iter_slices(text, size):
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+def _format_server_timing(timings):
+    """
+    Format the `timings` from a diff result (a dict of stage names to dicts
+    with `seconds` and other measurements) as a `Server-Timing` header value,
+    so the timings show up in browser tools and other HTTP-level metrics.
+    """
+    return ', '.join(f'{name};dur={stage["seconds"] * 1000:.3f}'
+                     for name, stage in timings.items()
+                     if 'seconds' in stage)
+
+
 def _extract_encoding(headers, content):
     encoding = None
     content_type = headers.get('Content-Type', '').lower()
@@ -444,6 +683,118 @@ def caller(func, a, b, **query_params):
     return func(**kwargs)
 
 
+def _text_caller(response, **query_params):
+    """
+    Extract the visible text from an HTTPResponse (see `TextHandler`).
+    """
+    raise_if_binary = not query_params.get('ignore_decoding_errors', False)
+    text = _decode_body(response, 'url', raise_if_binary=raise_if_binary)
+    return {'text': web_monitoring.differs.extract_visible_text(text)}
+
+
+class TextHandler(DiffHandler):
+    """
+    Extract the visible text from a single version, e.g. `/text?url=<v1>`, the
+    same way `/side_by_side_text` and `/html_text_dmp` do. Like those differs,
+    it uses (and fills) the cache of extracted text, so other tools can reuse
+    it without parsing the HTML again. An expected SHA-256 hash of the
+    content can be given with the `hash` query parameter.
+    """
+
+    @tornado.gen.coroutine
+    def get(self):
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+
+        query_params = dict(self.decode_query_params())
+        try:
+            url = query_params.pop('url')
+        except KeyError:
+            self.send_error(
+                400,
+                reason='Malformed request. You must provide a URL as the '
+                       'value for the `url` query parameter.')
+            return
+
+        response = yield self.fetch_diffable_content(
+            url, query_params.pop('hash', None), query_params)
+        if not response:
+            return
+
+        result = yield self.call_in_worker(2, _text_caller, response,
+                                           **query_params)
+        result = {'url': url,
+                  **result,
+                  'version': web_monitoring.__version__,
+                  'type': 'text'}
+        self.write(result)
+
+
+class SeriesHandler(DiffHandler):
+    """
+    Diff a series of versions of a page with `html_diff_render_series()`.
+    The versions are given, in order, by repeating the `url` query parameter,
+    e.g. `/series?url=<v1>&url=<v2>&url=<v3>`. Other query parameters are
+    passed on to `html_diff_render_series()` (`against_first=true` also diffs
+    each version against the first one, and `counts_only=true` only counts
+    the changes in each diff).
+
+    The response is newline-delimited JSON: one line per diff, each with the
+    `a` and `b` indexes and URLs of the versions that were diffed, plus the
+    same fields as a `/html_token` diff. Diffs are streamed as they finish.
+    """
+
+    def compute_etag(self):
+        # `decode_query_params()` only keeps the last of each parameter, but
+        # every `url` matters here.
+        validation_bytes = str(
+            web_monitoring.__version__
+            + self.request.path
+            + str(sorted(self.request.arguments.items()))
+        ).encode('utf-8')
+        etag = f'W/"{web_monitoring.utils.hash_content(validation_bytes)}"'
+        return etag
+
+    @tornado.gen.coroutine
+    def get(self):
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+
+        urls = [url.decode() for url in self.request.arguments.get('url', [])]
+        if len(urls) < 2:
+            self.send_error(
+                400,
+                reason='Malformed request. You must provide at least two '
+                       'URLs as values for the `url` query parameter.')
+            return
+
+        query_params = dict(self.decode_query_params())
+        query_params.pop('url')
+        for name in ('against_first', 'counts_only'):
+            if name in query_params:
+                query_params[name] = \
+                    query_params[name].strip().lower() == 'true'
+        if not self.clean_workers_param(query_params):
+            return
+
+        content = yield [self.fetch_diffable_content(url, None, query_params)
+                         for url in urls]
+        if not all(content):
+            return
+
+        yield self.stream_from_worker(2, 'application/x-ndjson; charset=UTF-8',
+                                      _stream_series_caller,
+                                      {'version': web_monitoring.__version__,
+                                       'type': 'series'},
+                                      content, **query_params)
+
+
 class IndexHandler(BaseHandler):
 
     @tornado.gen.coroutine
@@ -469,6 +820,8 @@ def make_app():
 
     return tornado.web.Application([
         (r"/healthcheck", HealthCheckHandler),
+        (r"/series", SeriesHandler),
+        (r"/text", TextHandler),
         (r"/([A-Za-z0-9_]+)", BoundDiffHandler),
         (r"/", IndexHandler),
     ], debug=DEBUG_MODE, compress_response=True,
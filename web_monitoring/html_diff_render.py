@@ -14,23 +14,31 @@ For now, you can mentally divide this module into two sections:
    depends on some parts of the LXML module, but that could change. (The entry
    point for this is _htmldiff)
 """
-from bs4 import BeautifulSoup, Comment
-from collections import Counter, namedtuple
-from enum import Enum
-from functools import lru_cache
+from bs4 import BeautifulSoup, Comment, NavigableString
+import bisect
+from collections import Counter
 import copy
 import difflib
-from web_monitoring.utils import get_color_palette
+import hashlib
+from web_monitoring import __version__
+from web_monitoring.utils import (FileCache, get_color_palette, hash_content,
+                                  longest_increasing_pairs, parallel_map,
+                                  StageTimer)
 import html
 import html5_parser
+import itertools
+import json
 import logging
+import os
 import re
+import time
+import zlib
 from .content_type import raise_if_not_diffable_html
 from .differs import compute_dmp_diff
 
 # Imports only used in forked tokenization code; may be ripe for removal:
 from lxml import etree
-from lxml.html import fragment_fromstring
+from lxml.html import fragment_fromstring, HTMLParser
 from html import escape as html_escape
 
 
@@ -165,9 +173,9 @@ ACTIVE_ELEMENTS = ('script', 'style')
 
 # This diff is fundamentally a word-by-word diff, which attempts to re-assemble
 # the tags that were present before or after a word after diffing the text.
-# To help ensure a sense of structure is still involved in the diff, we look
-# words preceded by these tags and add several special, matchable tokens in
-# front of the word so that the actual diff algorithm sees some "sameness."
+# To help ensure a sense of structure is still involved in the diff, we split
+# the document into blocks wherever one of these tags starts and line up the
+# blocks before diffing the words in them (see `get_block_opcodes()`).
 #
 # One would *think* including `<h#>` tags here would make sense, but it turns
 # out we've seen a variety of real-world situations where tags flip from inline
@@ -177,6 +185,18 @@ SEPARATABLE_TAGS = set(['blockquote', 'section', 'article', 'header', 'footer',
                         'pre', 'ul', 'ol', 'li', 'table', 'p'])
 # SEPARATABLE_TAGS = block_level_tags
 
+# Flags describing how the diff should treat a given tag (see `Tag.flags`).
+# Changes should not cross the boundaries of the element (see
+# `block_level_tags`).
+BLOCK_TAG = 1
+# The element has no content (see `empty_tags`).
+VOID_TAG = 2
+# The element's content is treated as a single unit (see
+# `undiffable_content_tags`).
+UNDIFFABLE_TAG = 4
+# The element starts a new block of the document (see `SEPARATABLE_TAGS`).
+SEPARATABLE_TAG = 8
+
 # A simplistic, empty HTML document to use in place of totally empty content
 EMPTY_HTML = '''<html>
     <head></head>
@@ -185,13 +205,53 @@ EMPTY_HTML = '''<html>
     </body>
 </html>'''
 
-# Maximum number of spacer tokens to add to a token stream for a document.
-# Adding too many can cause SequenceMatcher to choke.
-MAX_SPACERS = 2500
+# The different views of a diff that can be rendered. `include='all'` renders
+# every one of them.
+DIFF_VIEWS = ('combined', 'insertions', 'deletions')
+
+# Unchanged spans of a `context` view are replaced with one of these. The
+# `data-wm-diff-elided` attribute is the number of words that were left out.
+ELIDED_HTML = '<div class="wm-diff-elided" data-wm-diff-elided="{count}">…</div>'
+
+# When streaming, rendered views are yielded in chunks of this many characters.
+STREAM_CHUNK_SIZE = 65536
+
+# The levels of detail a diff can be done at, from finest to coarsest. When a
+# diff has a time limit, each one is tried in turn until one of them finishes
+# in time (see `get_opcodes_in_time()`):
+# - `word` matches up individual words (and images, links, etc.).
+# - `sentence` matches up whole sentences within each changed block.
+# - `block` marks each changed block as entirely replaced.
+# - `body` marks the whole body as replaced if anything changed.
+DIFF_GRANULARITIES = ('word', 'sentence', 'block', 'body')
+
+# The ways changed regions of a document can be diffed once its blocks have
+# been lined up (see `get_block_opcodes()`):
+# - `grouped` diffs blocks that couldn't be paired up along with a nearby
+#   pair, since blocks are often split or merged rather than simply added or
+#   removed.
+# - `hierarchical` only diffs paired blocks word by word and marks all other
+#   blocks as entirely inserted or deleted. This is faster on long pages with
+#   lots of changed blocks, but shows split or merged blocks less precisely.
+BLOCK_MODES = ('grouped', 'hierarchical')
+
+# A rough guess at how many seconds SequenceMatcher spends per pair of items it
+# could compare, used to skip diffs that clearly can't finish within a time
+# limit. Most documents diff faster than this, but pathological ones (with
+# lots of tiny, scattered matches) can be several times slower.
+MATCH_SECONDS_PER_COMPARISON = 1e-8
+
+# When diffing with multiple worker processes, only pairs of changed blocks
+# that need at least this many comparisons to match up are sent to a worker.
+# Smaller ones are faster to diff than to send to another process.
+PARALLEL_MIN_COMPARISONS = 1000000
 
 
 def html_diff_render(a_text, b_text, a_headers=None, b_headers=None,
-                     include='combined', content_type_options='normal'):
+                     include='combined', content_type_options='normal',
+                     block_mode='grouped', context_blocks=2, timelimit=None,
+                     workers=None, timings=False, stream=False,
+                     counts_only=False):
     """
     HTML Diff for rendering. This is focused on visually highlighting portions
     of a page’s text that have been changed. It does not do much to show how
@@ -233,6 +293,14 @@ def html_diff_render(a_text, b_text, a_headers=None, b_headers=None,
         - `all` returns all of the above documents. You might use this for
           efficiency -- the most expensive part of the diff is only performed
           once and reused for all three return types.
+        - `context` returns an HTML document like `combined`, but with only
+          the changes and a few blocks (see `context_blocks`) around each of
+          them. Other unchanged parts of the page are replaced with a
+          `<div class="wm-diff-elided">` placeholder. This is much smaller
+          than `combined` when a large page has only a few changes.
+        - `patch` returns no HTML. Instead, the `patch` key has a small,
+          JSON-serializable description of the changes relative to the `b`
+          document, for clients that already have it (see `_diff_patch()`).
     content_type_options : string
         Change how content type detection is handled. It doesn’t make a lot of
         sense to apply an HTML-focused diffing algorithm to, say, a JPEG image,
@@ -244,6 +312,45 @@ def html_diff_render(a_text, b_text, a_headers=None, b_headers=None,
         - `nocheck` ignores the `Content-Type` header but still sniffs.
         - `nosniff` uses the `Content-Type` header but does not sniff.
         - `ignore` doesn’t do any checking at all.
+    block_mode : string
+        How to diff blocks (paragraphs, list items, etc.) that have changed.
+        Options are:
+        - `grouped` pairs up similar blocks and diffs them word by word,
+          along with any neighboring blocks that couldn't be paired.
+        - `hierarchical` only diffs paired blocks word by word and shows all
+          other changed blocks as wholly inserted or deleted. This is faster
+          on long pages with many changed blocks.
+    context_blocks : int
+        How many unchanged blocks (paragraphs, list items, etc.) to keep before
+        and after each change when `include` is `context`.
+    timelimit : float
+        Maximum number of seconds to spend diffing (not including creating the
+        final HTML output). If a word-by-word diff won't finish in time, this
+        falls back to coarser diffs (see `DIFF_GRANULARITIES`) -- in the worst
+        case, the whole body is marked as replaced. The result's `granularity`
+        says which level of detail was used.
+    workers : int
+        Number of processes to diff with. If more than one, large changed
+        regions of the document are diffed in parallel, which can speed up
+        diffs of very large pages.
+    timings : boolean
+        If true, the result will include a `timings` dict with the wall time,
+        net memory allocations, and token counts for each stage of the diff
+        (`parse`, `serialize`, `tokenize`, `customize`, `match`, `assemble`,
+        and `render`). Useful for tracking down slow diffs.
+    stream : boolean
+        If true, each HTML document in the result is an iterator of string
+        chunks instead of a single string, and is only rendered when it is
+        iterated over. Rendering is then not included in `timings`. This is
+        meant for writing very large diffs out incrementally, so only one
+        view has to be held in memory at a time.
+    counts_only : boolean
+        If true, no HTML is assembled or rendered (`include` is ignored) and
+        the result only has the counts of changes, insertions, and deletions,
+        the `granularity`, and how many characters and UTF-8 bytes of content
+        were inserted and deleted (`inserted_chars`, `deleted_chars`,
+        `inserted_bytes`, and `deleted_bytes`). This is much faster for
+        large pages and the result is tiny.
 
     Example
     -------
@@ -258,51 +365,227 @@ def html_diff_render(a_text, b_text, a_headers=None, b_headers=None,
         b_headers,
         content_type_options)
 
-    soup_old = html5_parser.parse(a_text.strip() or EMPTY_HTML,
-                                  treebuilder='soup', return_root=False)
-    soup_new = html5_parser.parse(b_text.strip() or EMPTY_HTML,
-                                  treebuilder='soup', return_root=False)
+    if block_mode not in BLOCK_MODES:
+        raise ValueError(f'Unknown block_mode: "{block_mode}"')
+
+    deadline = None
+    if timelimit is not None:
+        deadline = time.perf_counter() + float(timelimit)
+
+    if counts_only:
+        # No views of the diff are needed (see `_diff_tokens()`).
+        include = None
+
+    timer = StageTimer(enabled=timings)
+    with timer.stage('parse'):
+        soup_old = _parse_document(a_text)
+        soup_new = _parse_document(b_text)
+
+    results, diff_bodies = diff_elements(soup_old.body, soup_new.body, include,
+                                         block_mode=block_mode,
+                                         context_blocks=context_blocks,
+                                         timer=timer, deadline=deadline,
+                                         workers=workers)
+
+    if diff_bodies:
+        with timer.stage('render'):
+            # Some documents' titles wind up in the body, so get them first.
+            title_diff = _diff_title(get_title(soup_old), get_title(soup_new))
+
+            # The original bodies have been fully serialized and diffed at
+            # this point, so drop their contents. Each view of the diff starts
+            # from a copy of one of these documents, and there's no sense in
+            # deep-copying a whole body that is just going to be replaced.
+            _empty_body(soup_old)
+            _empty_body(soup_new)
+            _render_diffs(results, diff_bodies, soup_old, soup_new,
+                          title_diff, stream)
+
+    if timings:
+        results['timings'] = timer.results()
+
+    return results
+
+
+def html_diff_render_series(texts, headers=None, include='combined',
+                            content_type_options='normal',
+                            block_mode='grouped', context_blocks=2,
+                            timelimit=None, workers=None, against_first=False,
+                            stream=False, counts_only=False):
+    """
+    Diff each version in a series of versions of a page against the one
+    before it, like calling `html_diff_render()` on each consecutive pair,
+    but only parsing and tokenizing each version once.
+
+    This is a generator: versions are read from `texts` and their diffs are
+    yielded as they are needed, so only the previous (and first) version has
+    to be kept in memory, no matter how long the series is.
+
+    Parameters
+    ----------
+    texts : iterable of string
+        Source HTML of each version, in order
+    headers : iterable of dict, optional
+        Any HTTP headers associated with each version, in the same order as
+        `texts`
+    against_first : boolean
+        If true, also diff each version (after the second) against the first.
+    include, content_type_options, block_mode, context_blocks, timelimit, \
+    workers, stream, counts_only
+        Same as `html_diff_render()`. The time limit applies to each diff.
+
+    Yields
+    ------
+    tuple of (int, int, dict)
+        The indexes of the `a` and `b` versions that were diffed and the
+        result of the diff (the same as `html_diff_render()` would return).
+        Each version's diff against the previous one is yielded before its
+        diff against the first one.
+
+    Example
+    -------
+    for a_index, b_index, result in html_diff_render_series(texts):
+        print(f'{a_index} -> {b_index}: {result["change_count"]} changes')
+    """
+    if block_mode not in BLOCK_MODES:
+        raise ValueError(f'Unknown block_mode: "{block_mode}"')
+
+    if counts_only:
+        include = None
+    options = dict(include=include, block_mode=block_mode,
+                   context_blocks=context_blocks, timelimit=timelimit,
+                   workers=workers, stream=stream)
+    token_cache = _get_token_cache()
+    headers = itertools.repeat(None) if headers is None else headers
+    first = previous = None
+    previous_text = previous_headers = None
+    for index, (text, text_headers) in enumerate(zip(texts, headers)):
+        if index:
+            raise_if_not_diffable_html(previous_text, text, previous_headers,
+                                       text_headers, content_type_options)
+        current = _prepare_version(text, token_cache)
+        if index == 0:
+            first = current
+        else:
+            yield index - 1, index, _diff_versions(previous, current, **options)
+            if against_first and index > 1:
+                yield 0, index, _diff_versions(first, current, **options)
+        previous = current
+        previous_text, previous_headers = text, text_headers
+
+
+def _prepare_version(text, token_cache=None):
+    """
+    Parse and tokenize one version of a page for `html_diff_render_series()`.
+    Returns a tuple of the document (with its body emptied, since only the
+    tokens are needed after this), its title, and the customized tokens of its
+    body.
+    """
+    soup = _parse_document(text)
+    title = get_title(soup)
+    body = soup.body or BeautifulSoup().new_tag('div')
+    html = str(body)
+    key, tokens = _load_cached_tokens(token_cache, html)
+    if tokens is None:
+        tokens = _customize_tokens(tokenize(html))
+        _save_cached_tokens(token_cache, key, tokens)
+    _empty_body(soup)
+    return soup, title, tokens
+
+
+def _diff_versions(old, new, include='combined', block_mode='grouped',
+                   context_blocks=2, timelimit=None, workers=None,
+                   stream=False):
+    """
+    Diff and render two versions made by `_prepare_version()`.
+    """
+    deadline = None
+    if timelimit is not None:
+        deadline = time.perf_counter() + float(timelimit)
+
+    soup_old, old_title, old_tokens = old
+    soup_new, new_title, new_tokens = new
+    results, raw_diffs = _diff_tokens(old_tokens, new_tokens, include,
+                                      block_mode=block_mode,
+                                      context_blocks=context_blocks,
+                                      deadline=deadline, workers=workers)
+    diff_bodies = {}
+    for diff_type, diff in raw_diffs.items():
+        soup = diff_type == 'deletions' and soup_old or soup_new
+        diff_bodies[diff_type] = _fill_element(soup.body, diff)
+
+    if diff_bodies:
+        _render_diffs(results, diff_bodies, soup_old, soup_new,
+                      _diff_title(old_title, new_title), stream)
+    return results
+
+
+def _parse_document(text):
+    """
+    Parse a page's HTML into a Beautiful Soup document that is ready to diff.
+    """
+    soup = html5_parser.parse(text.strip() or EMPTY_HTML,
+                              treebuilder='soup', return_root=False)
 
     # Remove comment nodes since they generally don't affect display.
-    # NOTE: This could affect display if the removed are conditional comments,
-    # but it's unclear how we'd meaningfully visualize those anyway.
-    [element.extract() for element in
-     soup_old.find_all(string=lambda text:isinstance(text, Comment))]
+    # NOTE: This could affect display if the removed are conditional
+    # comments, but it's unclear how we'd meaningfully visualize those
+    # anyway.
     [element.extract() for element in
-     soup_new.find_all(string=lambda text:isinstance(text, Comment))]
+     soup.find_all(string=lambda text:isinstance(text, Comment))]
+
+    return _cleanup_document_structure(soup)
+
 
-    soup_old = _cleanup_document_structure(soup_old)
-    soup_new = _cleanup_document_structure(soup_new)
+def _empty_body(soup):
+    if soup.body:
+        soup.body.replace_with(_empty_copy(soup.body))
 
-    results, diff_bodies = diff_elements(soup_old.body, soup_new.body, include)
 
+def _render_diffs(results, diff_bodies, soup_old, soup_new, title_diff,
+                  stream=False):
+    """
+    Render each view of a diff into a full HTML document (or an iterator of
+    chunks of one, if `stream` is true) and add it to `results`.
+    """
     for diff_type, diff_body in diff_bodies.items():
-        soup = None
-        if diff_type == 'deletions':
-            soup = copy.copy(soup_old)
-        elif diff_type == 'insertions':
-            soup = copy.copy(soup_new)
+        if stream:
+            render = _iter_diff_document
         else:
-            soup = copy.copy(soup_new)
-            title_meta = soup.new_tag(
-                'meta',
-                content=_diff_title(soup_old, soup_new))
-            title_meta.attrs['name'] = 'wm-diff-title'
-            soup.head.append(title_meta)
-
-            old_head = soup.new_tag('template', id='wm-diff-old-head')
-            if soup_old.head:
-                for node in soup_old.head.contents.copy():
-                    old_head.append(copy.copy(node))
-            soup.head.append(old_head)
-
-        change_styles = soup.new_tag(
-            "style",
-            type="text/css",
-            id='wm-diff-style')
-
-        color_palette = get_color_palette()
-        change_styles.string = f'''
+            render = _render_diff_document
+        results[diff_type] = render(diff_type, diff_body, soup_old,
+                                    soup_new, title_diff)
+
+
+def _build_diff_document(diff_type, diff_body, soup_old, soup_new,
+                         title_diff):
+    """
+    Create the final Beautiful Soup document for one view of a diff (see
+    `_render_diff_document()`).
+    """
+    if diff_type == 'deletions':
+        soup = copy.copy(soup_old)
+    elif diff_type == 'insertions':
+        soup = copy.copy(soup_new)
+    else:
+        soup = copy.copy(soup_new)
+        title_meta = soup.new_tag('meta', content=title_diff)
+        title_meta.attrs['name'] = 'wm-diff-title'
+        soup.head.append(title_meta)
+
+        old_head = soup.new_tag('template', id='wm-diff-old-head')
+        if soup_old.head:
+            for node in soup_old.head.contents.copy():
+                old_head.append(copy.copy(node))
+        soup.head.append(old_head)
+
+    change_styles = soup.new_tag(
+        "style",
+        type="text/css",
+        id='wm-diff-style')
+
+    color_palette = get_color_palette()
+    change_styles.string = f'''
             ins.wm-diff, ins.wm-diff > * {{background-color:
                 {color_palette['differ_insertion']} !important;
                 all: unset;}}
@@ -310,23 +593,91 @@ def html_diff_render(a_text, b_text, a_headers=None, b_headers=None,
                 {color_palette['differ_deletion']} !important;
                 all: unset;}}
             script {{display: none !important;}}'''
-        soup.head.append(change_styles)
-
-        soup.body.replace_with(diff_body)
-        # The method we use above to append HTML strings (the diffs) to the soup
-        # results in a non-navigable soup. So we serialize and re-parse :(
-        # (Note we use no formatter for this because proper encoding escapes
-        # the tags our differ generated.)
-        soup = html5_parser.parse(soup.prettify(formatter=None),
-                                  treebuilder='soup', return_root=False)
-        runtime_scripts = soup.new_tag('script', id='wm-diff-script')
-        runtime_scripts.string = UPDATE_CONTRAST_SCRIPT
-        soup.body.append(runtime_scripts)
-        if diff_type == 'combined':
-            _deactivate_deleted_active_elements(soup)
-        results[diff_type] = soup.prettify(formatter='minimal')
+    if diff_type == 'context':
+        change_styles.string += '''
+            .wm-diff-elided {display: block !important; color: gray;
+                text-align: center;}'''
+    soup.head.append(change_styles)
+
+    soup.body.replace_with(diff_body)
+    # The method we use above to append HTML strings (the diffs) to the soup
+    # results in a non-navigable soup. So we serialize and re-parse :(
+    # (Note we use no formatter for this because proper encoding escapes
+    # the tags our differ generated.)
+    soup = html5_parser.parse(soup.prettify(formatter=None),
+                              treebuilder='soup', return_root=False)
+    runtime_scripts = soup.new_tag('script', id='wm-diff-script')
+    runtime_scripts.string = UPDATE_CONTRAST_SCRIPT
+    soup.body.append(runtime_scripts)
+    if diff_type == 'combined' or diff_type == 'context':
+        _deactivate_deleted_active_elements(soup)
+    return soup
 
-    return results
+
+def _render_diff_document(*args):
+    """
+    Create the final HTML string for one view of a diff (see `DIFF_VIEWS`).
+
+    This only reads from `soup_old` and `soup_new`, so each view of a diff can
+    be rendered independently of (and concurrently with) the others.
+    """
+    return _build_diff_document(*args).prettify(formatter='minimal')
+
+
+def _iter_diff_document(*args):
+    """
+    Like `_render_diff_document()`, but renders the document only once it is
+    iterated over, and yields it in chunks of about `STREAM_CHUNK_SIZE`
+    characters. The document is serialized a piece at a time as the chunks
+    are needed, so the whole HTML string is never held in memory.
+    """
+    buffer = []
+    size = 0
+    for piece in _iter_prettified(_build_diff_document(*args)):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _iter_prettified(element, indent_level=0):
+    """
+    Yield the same HTML as `element.prettify(formatter='minimal')` (where
+    `element` is a Beautiful Soup document or tag) in pieces. Each element is
+    serialized on its own, except for ones whose whitespace has to be kept
+    as-is (like `<pre>`), which are serialized whole.
+    """
+    for child in element.contents:
+        if isinstance(child, NavigableString):
+            text = child.output_ready(formatter='minimal').strip()
+            if text:
+                yield ' ' * indent_level + text + '\n'
+        elif (child.contents and child.name not in
+                (child.preserve_whitespace_tags or ())):
+            # Render the tag with no children to get its start and end.
+            shell = _empty_copy(child)
+            shell.preserve_whitespace_tags = child.preserve_whitespace_tags
+            start, end = shell.decode(indent_level=indent_level,
+                                      formatter='minimal') \
+                .rstrip('\n').rsplit('\n', 1)
+            yield start + '\n'
+            yield from _iter_prettified(child, indent_level + 1)
+            yield end + '\n'
+        else:
+            yield child.decode(indent_level=indent_level, formatter='minimal')
+
+
+def _empty_copy(element):
+    """
+    Create a copy of a Beautiful Soup element that has the same name and
+    attributes, but none of the children.
+    """
+    attrs = {key: copy.copy(value) for key, value in element.attrs.items()}
+    return BeautifulSoup().new_tag(element.name, attrs=attrs)
 
 
 def _cleanup_document_structure(soup):
@@ -366,91 +717,809 @@ def _html_for_dmp_operation(operation):
         return html_value
 
 
-def _diff_title(old, new):
+def _diff_title(old_title, new_title):
     """
-    Create an HTML diff (i.e. a string with `<ins>` and `<del>` tags) of the
-    title of two Beautiful Soup documents.
+    Create an HTML diff (i.e. a string with `<ins>` and `<del>` tags) of two
+    page titles (see `get_title()`).
     """
-    diff = compute_dmp_diff(get_title(old), get_title(new))
+    diff = compute_dmp_diff(old_title, new_title)
     return ''.join(map(_html_for_dmp_operation, diff))
 
 
-def diff_elements(old, new, include='all'):
+def diff_elements(old, new, include='all', block_mode='grouped',
+                  context_blocks=2, timer=None, deadline=None, workers=None):
     if not old:
         old = BeautifulSoup().new_tag('div')
     if not new:
         new = BeautifulSoup().new_tag('div')
 
-    def fill_element(element, diff):
-        result_element = copy.copy(element)
-        result_element.clear()
-        result_element.append(diff)
-        return result_element
+    timer = timer or StageTimer(enabled=False)
+    with timer.stage('serialize'):
+        old_html = str(old)
+        new_html = str(new)
 
     results = {}
-    metadata, raw_diffs = _htmldiff(str(old), str(new), include)
+    metadata, raw_diffs = _htmldiff(old_html, new_html, include,
+                                    block_mode=block_mode,
+                                    context_blocks=context_blocks,
+                                    timer=timer, deadline=deadline,
+                                    workers=workers)
     for diff_type, diff in raw_diffs.items():
         element = diff_type == 'deletions' and old or new
-        results[diff_type] = fill_element(element, diff)
+        results[diff_type] = _fill_element(element, diff)
 
     return metadata, results
 
 
-def _htmldiff(old, new, include='all'):
+def _fill_element(element, diff):
+    result_element = _empty_copy(element)
+    result_element.append(diff)
+    return result_element
+
+
+def _htmldiff(old, new, include='all', block_mode='grouped',
+              context_blocks=2, timer=None, deadline=None, workers=None):
     """
     A slightly customized version of htmldiff that uses different tokens.
     """
-    old_tokens = tokenize(old)
-    new_tokens = tokenize(new)
-    # old_tokens = [_customize_token(token) for token in old_tokens]
-    # new_tokens = [_customize_token(token) for token in new_tokens]
-    old_tokens = _limit_spacers(_customize_tokens(old_tokens), MAX_SPACERS)
-    new_tokens = _limit_spacers(_customize_tokens(new_tokens), MAX_SPACERS)
-    # result = htmldiff_tokens(old_tokens, new_tokens)
-    # result = diff_tokens(old_tokens, new_tokens) #, include='delete')
-    logger.debug('CUSTOMIZED!')
-
-    # HACK: The whole "spacer" token thing above in this code triggers the
-    # `autojunk` mechanism in SequenceMatcher, so we need to explicitly turn
-    # that off. That's probably not great, but I don't have a better approach.
-    matcher = InsensitiveSequenceMatcher(a=old_tokens, b=new_tokens, autojunk=False)
-    # matcher = SequenceMatcher(a=old_tokens, b=new_tokens, autojunk=False)
-    opcodes = matcher.get_opcodes()
+    timer = timer or StageTimer(enabled=False)
+    token_cache = _get_token_cache()
+    with timer.stage('tokenize'):
+        old_key, old_cached = _load_cached_tokens(token_cache, old)
+        new_key, new_cached = _load_cached_tokens(token_cache, new)
+        old_tokens = tokenize(old) if old_cached is None else old_cached
+        new_tokens = tokenize(new) if new_cached is None else new_cached
+    timer.count('tokenize', old_tokens=len(old_tokens),
+                new_tokens=len(new_tokens),
+                cached=(old_cached is not None) + (new_cached is not None))
+
+    with timer.stage('customize'):
+        # Cached tokens were customized before they were saved.
+        if old_cached is None:
+            old_tokens = _customize_tokens(old_tokens)
+            _save_cached_tokens(token_cache, old_key, old_tokens)
+        if new_cached is None:
+            new_tokens = _customize_tokens(new_tokens)
+            _save_cached_tokens(token_cache, new_key, new_tokens)
+    timer.count('customize', old_tokens=len(old_tokens),
+                new_tokens=len(new_tokens))
+
+    return _diff_tokens(old_tokens, new_tokens, include, block_mode,
+                        context_blocks, timer, deadline, workers)
+
+
+def _diff_tokens(old_tokens, new_tokens, include='all', block_mode='grouped',
+                 context_blocks=2, timer=None, deadline=None, workers=None):
+    """
+    Match up two lists of customized tokens and assemble the requested views
+    of the diff as HTML strings. Returns a tuple of the diff's metadata and a
+    dict of the views.
+
+    If `include` is `None`, no views are assembled, and the metadata also has
+    totals of the content that changed (see `counts_only` in
+    `html_diff_render()`).
+    """
+    timer = timer or StageTimer(enabled=False)
+    with timer.stage('match'):
+        opcodes, granularity = get_opcodes_in_time(old_tokens, new_tokens,
+                                                   block_mode, deadline,
+                                                   workers)
+    timer.count('match', opcodes=len(opcodes))
 
     metadata = _count_changes(opcodes)
-    diffs = {}
+    metadata['granularity'] = granularity
+    if include is None:
+        metadata.update(_count_changed_content(old_tokens, new_tokens,
+                                               opcodes))
+        return metadata, {}
+
+    with timer.stage('assemble'):
+        # All the requested views are assembled together in one pass over the
+        # opcodes, so `all` costs little more than `combined` alone.
+        views = [view for view in DIFF_VIEWS
+                 if include == 'all' or include == view]
+        assembled = assemble_diffs(old_tokens, new_tokens, opcodes, views)
+        if include == 'context':
+            elided = _elide_unchanged(old_tokens, new_tokens, opcodes,
+                                      int(context_blocks))
+            assembled['context'] = assemble_diffs(*elided, ['combined'])['combined']
+        elif include == 'patch':
+            metadata['patch'] = _diff_patch(old_tokens, new_tokens, opcodes)
+        diffs = {}
+        for diff_type, diff in assembled.items():
+            # diffs[diff_type] = fixup_ins_del_tags(''.join(diff).strip())
+            diffs[diff_type] = ''.join(diff).strip().replace('</li> ', '</li>')
+
+    return metadata, diffs
 
-    def render_diff(diff_type):
-        diff = assemble_diff(old_tokens, new_tokens, opcodes, diff_type)
-        # return fixup_ins_del_tags(''.join(diff).strip())
-        result = ''.join(diff).strip().replace('</li> ', '</li>')
-        return result
 
-    if include == 'all' or include == 'combined':
-        diffs['combined'] = render_diff('combined')
-    if include == 'all' or include == 'insertions':
-        diffs['insertions'] = render_diff('insertions')
-    if include == 'all' or include == 'deletions':
-        diffs['deletions'] = render_diff('deletions')
+def _get_token_cache():
+    """
+    Get a `FileCache` for tokens if the `DIFFER_TOKEN_CACHE_PATH` environment
+    variable is set. Tokens depend on the code that produced them, so each
+    version of this package has a separate cache.
+    """
+    path = os.environ.get('DIFFER_TOKEN_CACHE_PATH')
+    if path:
+        return FileCache(os.path.join(path, 'tokens', __version__))
+    return None
 
-    return metadata, diffs
 
+def _load_cached_tokens(token_cache, html):
+    """
+    Look up the customized tokens for a string of HTML in a token cache.
+    Returns a tuple of the cache key and the tokens, or `None` if they aren't
+    in the cache.
+    """
+    if token_cache is None:
+        return None, None
 
-# FIXME: this is utterly ridiculous -- the crazy spacer token solution we came
-# up with can add so much extra stuff to some kinds of pages that
-# SequenceMatcher chokes on it. This strips out excess spacers. We should
-# really re-examine the whole spacer token concept now that we control the
-# tokenization phase, though.
-def _limit_spacers(tokens, max_spacers):
-    limited_tokens = []
-    for token in tokens:
-        if isinstance(token, SpacerToken):
-            if max_spacers <= 0:
+    key = hash_content(html.encode('utf-8'))
+    data = token_cache.get(key)
+    if data is not None:
+        try:
+            return key, deserialize_tokens(data)
+        except (ValueError, LookupError, TypeError, zlib.error) as error:
+            logger.warning(f'Could not load cached tokens {key}: {error}')
+    return key, None
+
+
+def _save_cached_tokens(token_cache, key, tokens):
+    if token_cache is not None:
+        token_cache.set(key, serialize_tokens(tokens))
+
+
+class _TimeLimitExceeded(Exception):
+    "Raised when a diff can't be finished before its deadline."
+
+
+def _check_deadline(deadline, comparisons=0):
+    """
+    Raise `_TimeLimitExceeded` if the deadline (a `time.perf_counter()` value
+    or `None`) has passed or will pass before a SequenceMatcher can finish
+    comparing the given number of pairs of items.
+    """
+    if deadline is not None:
+        estimate = comparisons * MATCH_SECONDS_PER_COMPARISON
+        if time.perf_counter() + estimate > deadline:
+            raise _TimeLimitExceeded()
+
+
+def get_opcodes_in_time(old_tokens, new_tokens, block_mode='grouped',
+                        deadline=None, workers=None):
+    """
+    Diff two lists of tokens at the finest granularity (see
+    `DIFF_GRANULARITIES`) that can be finished before a deadline (a
+    `time.perf_counter()` value). Returns a tuple of the opcodes and the
+    granularity that was used.
+    """
+    for granularity in DIFF_GRANULARITIES:
+        # Leave at least half the remaining time for the coarser diffs.
+        attempt_deadline = deadline
+        if deadline is not None:
+            now = time.perf_counter()
+            attempt_deadline = now + max(0, deadline - now) / 2
+        try:
+            opcodes = get_block_opcodes(old_tokens, new_tokens, granularity,
+                                        block_mode, attempt_deadline,
+                                        workers)
+            return opcodes, granularity
+        except _TimeLimitExceeded:
+            logger.info(f'Diffing by {granularity} exceeded the time limit')
+
+
+def get_block_opcodes(old_tokens, new_tokens, granularity='word',
+                      block_mode='grouped', deadline=None, workers=None):
+    """
+    Diff two lists of tokens, returning a list of opcodes like
+    `difflib.SequenceMatcher.get_opcodes()`.
+
+    Rather than matching the whole token lists against each other, this
+    splits them into blocks (see `_find_blocks()`) and aligns the blocks first
+    by their content. Unchanged blocks are never diffed at the token level,
+    and changed blocks are paired up with similar blocks on the other side
+    and diffed individually, so changes never cross block boundaries.
+
+    With the `hierarchical` block mode (see `BLOCK_MODES`), blocks are lined
+    up by a hash of their text, and blocks that can't be paired are marked as
+    inserted or deleted without diffing them at all.
+
+    The `granularity` sets how changed blocks are diffed (see
+    `DIFF_GRANULARITIES`). If `deadline` (a `time.perf_counter()` value) is
+    set, this raises `_TimeLimitExceeded` when it looks like the diff won't be
+    done before then. The `body` granularity always finishes.
+
+    Since each pair of blocks is diffed separately, large pairs can be diffed
+    in parallel across multiple processes by setting `workers`.
+    """
+    if granularity == 'body':
+        command = 'equal' if old_tokens == new_tokens else 'replace'
+        return _normalize_opcodes([(command, 0, len(old_tokens),
+                                    0, len(new_tokens))])
+
+    _check_deadline(deadline)
+    old_blocks = _find_blocks(old_tokens)
+    new_blocks = _find_blocks(new_tokens)
+    if block_mode == 'hierarchical':
+        old_keys = [_text_hash(old_tokens, start, end)
+                    for start, end in old_blocks]
+        new_keys = [_text_hash(new_tokens, start, end)
+                    for start, end in new_blocks]
+    else:
+        old_keys = [tuple(old_tokens[start:end]) for start, end in old_blocks]
+        new_keys = [tuple(new_tokens[start:end]) for start, end in new_blocks]
+
+    # Each part is either a list of opcodes for unchanged blocks or `None` as
+    # a placeholder for the diff of the next pair of changed ranges.
+    parts = []
+    ranges = []
+    for command, i1, i2, j1, j2 in _align_blocks(old_keys, new_keys,
+                                                  deadline):
+        if command == 'equal':
+            parts.append([('equal',
+                           old_blocks[i1][0], old_blocks[i2 - 1][1],
+                           new_blocks[j1][0], new_blocks[j2 - 1][1])])
+            continue
+
+        for old_range, new_range in _pair_blocks(old_tokens, old_blocks[i1:i2],
+                                                 new_tokens, new_blocks[j1:j2],
+                                                 block_mode, deadline):
+            parts.append(None)
+            ranges.append((old_range, new_range))
+
+    diffs = iter(_diff_token_ranges(old_tokens, new_tokens, ranges,
+                                    granularity, deadline, workers))
+    opcodes = []
+    for part in parts:
+        opcodes.extend(part if part is not None else next(diffs))
+
+    return _normalize_opcodes(opcodes)
+
+
+def _text_hash(tokens, start, end):
+    """
+    Hash the text of a range of tokens. Comparing these hashes is much
+    cheaper than comparing the tokens one by one.
+    """
+    return hash(' '.join(tokens[start:end]))
+
+
+def _align_blocks(old_keys, new_keys, deadline=None):
+    """
+    Get opcodes (like `difflib.SequenceMatcher.get_opcodes()`) that line up
+    two lists of blocks.
+
+    Blocks that occur exactly once in both lists are lined up first (much like
+    the "patience" diff algorithm), and only the gaps between them are handed
+    to SequenceMatcher. Otherwise, documents with lots of small, scattered
+    changes hit SequenceMatcher's quadratic worst case, since it finds each
+    one-block match with a separate scan.
+
+    Raises `_TimeLimitExceeded` if the gaps between those blocks are too big
+    to match before `deadline` (see `_check_deadline()`).
+    """
+    old_counts = Counter(old_keys)
+    new_counts = Counter(new_keys)
+    new_indexes = {key: index for index, key in enumerate(new_keys)
+                   if new_counts[key] == 1}
+    anchors = longest_increasing_pairs([
+        (index, new_indexes[key])
+        for index, key in enumerate(old_keys)
+        if old_counts[key] == 1 and key in new_indexes])
+
+    matches = []
+    old_start = new_start = 0
+    for old_index, new_index in anchors:
+        matches.extend(_match_range(old_keys, old_start, old_index,
+                                    new_keys, new_start, new_index, deadline))
+        matches.append((old_index, new_index, 1))
+        old_start = old_index + 1
+        new_start = new_index + 1
+    matches.extend(_match_range(old_keys, old_start, len(old_keys),
+                                new_keys, new_start, len(new_keys), deadline))
+    # Like SequenceMatcher, end with a dummy match to simplify the loop below.
+    matches.append((len(old_keys), len(new_keys), 0))
+
+    opcodes = []
+    old_index = new_index = 0
+    for old_match, new_match, size in matches:
+        if old_index < old_match or new_index < new_match:
+            if old_index == old_match:
+                command = 'insert'
+            elif new_index == new_match:
+                command = 'delete'
+            else:
+                command = 'replace'
+            opcodes.append((command, old_index, old_match,
+                            new_index, new_match))
+        old_end = old_match + size
+        new_end = new_match + size
+        if size:
+            if opcodes and opcodes[-1][0] == 'equal':
+                # Extend the previous equal opcode instead of adding another.
+                _, old_match, _, new_match, _ = opcodes.pop()
+            opcodes.append(('equal', old_match, old_end, new_match, new_end))
+        old_index = old_end
+        new_index = new_end
+    return opcodes
+
+
+def _match_range(old_keys, old_start, old_end, new_keys, new_start, new_end,
+                 deadline=None):
+    """
+    Find matching blocks (like `difflib.SequenceMatcher.get_matching_blocks()`,
+    but without the terminating dummy block) in part of two lists.
+    """
+    if old_start == old_end or new_start == new_end:
+        return []
+    _check_deadline(deadline, (old_end - old_start) * (new_end - new_start))
+    matcher = difflib.SequenceMatcher(a=old_keys[old_start:old_end],
+                                      b=new_keys[new_start:new_end],
+                                      autojunk=False)
+    return [(old_index + old_start, new_index + new_start, size)
+            for old_index, new_index, size in matcher.get_matching_blocks()
+            if size]
+
+
+# Blocks must be at least this similar (as measured by the share of tokens
+# they have in common) to be paired up and diffed against each other, unless
+# they are the same kind of block (e.g. both are `<li>` elements).
+BLOCK_PAIRING_THRESHOLD = 0.5
+
+# Pairing two blocks of the same kind scores this much on top of their
+# similarity. This lines up corresponding blocks (e.g. list items in the same
+# position) even when all their text has changed.
+BLOCK_STRUCTURE_BONUS = 0.5
+
+# Pairing blocks in a changed region is quadratic in the number of blocks, so
+# fall back to simply pairing blocks of the same kind in order when a region
+# has more possible pairs than this.
+MAX_BLOCK_PAIRINGS = 10000
+
+
+def _pair_blocks(old_tokens, old_blocks, new_tokens, new_blocks,
+                 block_mode='grouped', deadline=None):
+    """
+    Pair up similar blocks from a changed region of two documents, keeping
+    them in order. Yields `(old_range, new_range)` tuples, where each range is
+    a `(start, end)` tuple of token indexes or `None`.
+
+    In the `grouped` block mode, runs of blocks that could not be paired are
+    diffed along with the pair before them (or after them, if there isn't
+    one), since blocks are often split or merged rather than simply added or
+    removed. In the `hierarchical` mode, they are yielded on their own, with
+    `None` for the other side.
+
+    Raises `_TimeLimitExceeded` if pairing the blocks doesn't finish before
+    `deadline` (see `_check_deadline()`).
+    """
+    old_count = len(old_blocks)
+    new_count = len(new_blocks)
+    if old_count == 0 or new_count == 0:
+        yield (_span(old_blocks), _span(new_blocks))
+        return
+
+    old_kinds = [_block_kind(old_tokens[start]) for start, _ in old_blocks]
+    new_kinds = [_block_kind(new_tokens[start]) for start, _ in new_blocks]
+    if old_count * new_count > MAX_BLOCK_PAIRINGS:
+        pairs = _pair_block_kinds(old_kinds, new_kinds)
+    else:
+        pairs = _best_block_pairs(old_tokens, old_blocks, old_kinds,
+                                  new_tokens, new_blocks, new_kinds, deadline)
+
+    if block_mode == 'hierarchical':
+        yield from _split_unpaired_blocks(old_blocks, new_blocks, pairs)
+        return
+
+    if not pairs:
+        yield (_span(old_blocks), _span(new_blocks))
+        return
+
+    # Each group runs from one pair up to the next, except the first, which
+    # also takes any unpaired blocks before it.
+    pairs[0] = (0, 0)
+    pairs.append((old_count, new_count))
+    for (old_start, new_start), (old_end, new_end) in zip(pairs, pairs[1:]):
+        yield (_span(old_blocks[old_start:old_end]),
+               _span(new_blocks[new_start:new_end]))
+
+
+def _split_unpaired_blocks(old_blocks, new_blocks, pairs):
+    """
+    Yield `(old_range, new_range)` tuples for each pair of blocks and for each
+    run of unpaired blocks in between (with `None` for the other side).
+    """
+    old_index = new_index = 0
+    for old_pair, new_pair in pairs + [(len(old_blocks), len(new_blocks))]:
+        if old_index < old_pair:
+            yield (_span(old_blocks[old_index:old_pair]), None)
+        if new_index < new_pair:
+            yield (None, _span(new_blocks[new_index:new_pair]))
+        if old_pair < len(old_blocks):
+            yield (old_blocks[old_pair], new_blocks[new_pair])
+        old_index = old_pair + 1
+        new_index = new_pair + 1
+
+
+def _pair_block_kinds(old_kinds, new_kinds):
+    """
+    Pair up blocks of the same kind in order, skipping blocks from whichever
+    side has more left over when the kinds don't match. This is a cheap,
+    linear-time stand-in for `_best_block_pairs()` on very large regions.
+    """
+    pairs = []
+    old_index = new_index = 0
+    old_count = len(old_kinds)
+    new_count = len(new_kinds)
+    while old_index < old_count and new_index < new_count:
+        if old_kinds[old_index] == new_kinds[new_index]:
+            pairs.append((old_index, new_index))
+            old_index += 1
+            new_index += 1
+        elif old_count - old_index > new_count - new_index:
+            old_index += 1
+        else:
+            new_index += 1
+    return pairs
+
+
+def _best_block_pairs(old_tokens, old_blocks, old_kinds,
+                      new_tokens, new_blocks, new_kinds, deadline=None):
+    """
+    Find the ordered, non-crossing list of `(old_index, new_index)` pairs of
+    blocks with the greatest total score (much like finding a longest common
+    subsequence). Raises `_TimeLimitExceeded` if `deadline` passes first.
+    """
+    old_count = len(old_blocks)
+    new_count = len(new_blocks)
+    old_counts = [Counter(old_tokens[start:end]) for start, end in old_blocks]
+    new_counts = [Counter(new_tokens[start:end]) for start, end in new_blocks]
+
+    scores = [[0.0] * (new_count + 1) for _ in range(old_count + 1)]
+    for i in range(1, old_count + 1):
+        _check_deadline(deadline)
+        old_start, old_end = old_blocks[i - 1]
+        old_size = old_end - old_start
+        for j in range(1, new_count + 1):
+            best = max(scores[i - 1][j], scores[i][j - 1])
+            new_start, new_end = new_blocks[j - 1]
+            new_size = new_end - new_start
+            total_size = old_size + new_size
+            same_kind = old_kinds[i - 1] == new_kinds[j - 1]
+            similarity = 0
+            # Skip counting shared tokens if the sizes alone rule it out.
+            if same_kind or 2 * min(old_size, new_size) >= BLOCK_PAIRING_THRESHOLD * total_size:
+                shared = sum((old_counts[i - 1] & new_counts[j - 1]).values())
+                similarity = 2 * shared / total_size
+            if same_kind:
+                best = max(best, scores[i - 1][j - 1] + similarity
+                           + BLOCK_STRUCTURE_BONUS)
+            elif similarity >= BLOCK_PAIRING_THRESHOLD:
+                best = max(best, scores[i - 1][j - 1] + similarity)
+            scores[i][j] = best
+
+    pairs = []
+    i, j = old_count, new_count
+    while i > 0 and j > 0:
+        if scores[i][j] == scores[i - 1][j]:
+            i -= 1
+        elif scores[i][j] == scores[i][j - 1]:
+            j -= 1
+        else:
+            pairs.append((i - 1, j - 1))
+            i -= 1
+            j -= 1
+    pairs.reverse()
+    return pairs
+
+
+def _block_kind(token):
+    """
+    Get the name of the innermost `SEPARATABLE_TAGS` element that starts the
+    block beginning with a given token (or `None` if there isn't one).
+    """
+    kind = None
+    for tag in token.pre_tags:
+        if tag.open and tag.flags & SEPARATABLE_TAG:
+            kind = tag.name
+    return kind
+
+
+def _span(blocks):
+    "Get a `(start, end)` range covering a consecutive list of blocks."
+    if blocks:
+        return (blocks[0][0], blocks[-1][1])
+    return None
+
+
+def _diff_token_ranges(old_tokens, new_tokens, ranges, granularity='word',
+                       deadline=None, workers=None):
+    """
+    Diff each of a list of `(old_range, new_range)` pairs (see
+    `_diff_token_range()`), returning a list of opcode lists in the same
+    order. If `workers` is more than one, large word-by-word diffs (see
+    `PARALLEL_MIN_COMPARISONS`) are done in parallel in that many processes.
+    """
+    results = [None] * len(ranges)
+
+    large = []
+    if granularity == 'word' and workers and int(workers) > 1:
+        large = [index for index, (old_range, new_range) in enumerate(ranges)
+                 if old_range and new_range
+                 and ((old_range[1] - old_range[0])
+                      * (new_range[1] - new_range[0])
+                      >= PARALLEL_MIN_COMPARISONS)]
+    if len(large) > 1:
+        _check_deadline(deadline)
+        # Only the text of each token matters for matching, and plain strings
+        # are much cheaper to send to another process than whole tokens.
+        jobs = [([str(token) for token in old_tokens[slice(*old_range)]],
+                 old_range[0],
+                 [str(token) for token in new_tokens[slice(*new_range)]],
+                 new_range[0],
+                 deadline)
+                for old_range, new_range in (ranges[index] for index in large)]
+        for index, opcodes in zip(large,
+                                  parallel_map(_match_words, jobs, workers)):
+            results[index] = opcodes
+
+    for index, (old_range, new_range) in enumerate(ranges):
+        if results[index] is None:
+            _check_deadline(deadline)
+            results[index] = _diff_token_range(old_tokens, old_range,
+                                               new_tokens, new_range,
+                                               granularity, deadline)
+
+    return results
+
+
+def _diff_token_range(old_tokens, old_range, new_tokens, new_range,
+                      granularity='word', deadline=None):
+    """
+    Get opcodes for the diff of a range of old tokens and a range of new
+    tokens. Either range may be `None` if it is empty. See
+    `get_block_opcodes()` for more on `granularity` and `deadline`.
+    """
+    if old_range is None:
+        return [('insert', None, None, *new_range)]
+    elif new_range is None:
+        return [('delete', *old_range, None, None)]
+    elif granularity == 'block':
+        return [('replace', *old_range, *new_range)]
+    elif granularity == 'sentence':
+        return _diff_sentences(old_tokens, old_range, new_tokens, new_range,
+                               deadline)
+
+    old_start, old_end = old_range
+    new_start, new_end = new_range
+    return _match_words((old_tokens[old_start:old_end], old_start,
+                         new_tokens[new_start:new_end], new_start,
+                         deadline))
+
+
+def _match_words(job):
+    """
+    Get opcodes for the diff of two lists of tokens (or plain strings). This
+    takes a single `(old_words, old_start, new_words, new_start, deadline)`
+    tuple so it can be sent to another process, and the opcodes are offset by
+    `old_start` and `new_start`.
+    """
+    old_words, old_start, new_words, new_start, deadline = job
+    _check_deadline(deadline, len(old_words) * len(new_words))
+    matcher = BlockSequenceMatcher(a=old_words, b=new_words)
+    return [(command,
+             i1 + old_start, i2 + old_start,
+             j1 + new_start, j2 + new_start)
+            for command, i1, i2, j1, j2 in matcher.get_opcodes()]
+
+
+def _diff_sentences(old_tokens, old_range, new_tokens, new_range,
+                    deadline=None):
+    """
+    Like `_diff_token_range()`, but matches up whole sentences instead of
+    individual tokens.
+    """
+    old_sentences = _find_sentences(old_tokens, *old_range)
+    new_sentences = _find_sentences(new_tokens, *new_range)
+    old_keys = [tuple(old_tokens[start:end]) for start, end in old_sentences]
+    new_keys = [tuple(new_tokens[start:end]) for start, end in new_sentences]
+    return [(command,
+             *(_span(old_sentences[i1:i2]) or (None, None)),
+             *(_span(new_sentences[j1:j2]) or (None, None)))
+            for command, i1, i2, j1, j2
+            in _align_blocks(old_keys, new_keys, deadline)]
+
+
+# Matches a token that ends a sentence, e.g. `end.` or `(really?)`
+_sentence_end_re = re.compile(r'[.!?][\'"”’)\]]*$')
+
+
+def _find_sentences(tokens, start, end):
+    """
+    Split a range of tokens into sentences. Returns a list of `(start, end)`
+    index ranges.
+    """
+    sentences = []
+    sentence_start = start
+    for index in range(start, end):
+        if _sentence_end_re.search(tokens[index]):
+            sentences.append((sentence_start, index + 1))
+            sentence_start = index + 1
+    if sentence_start < end:
+        sentences.append((sentence_start, end))
+    return sentences
+
+
+def _normalize_opcodes(opcodes):
+    """
+    Join adjacent opcodes of the same kind (and adjacent changes of any kind)
+    so the result looks like it came from a single SequenceMatcher. This also
+    fills in the positions of empty ranges (marked with `None`).
+    """
+    result = []
+    old_index = new_index = 0
+    for command, i1, i2, j1, j2 in opcodes:
+        if i1 is None:
+            i1 = i2 = old_index
+        if j1 is None:
+            j1 = j2 = new_index
+        old_index, new_index = i2, j2
+
+        if result:
+            last_command, last_i1, _, last_j1, _ = result[-1]
+            if command == 'equal' and last_command == 'equal':
+                result[-1] = ('equal', last_i1, i2, last_j1, j2)
                 continue
-            max_spacers -= 1
-        limited_tokens.append(token)
+            elif command != 'equal' and last_command != 'equal':
+                result.pop()
+                i1, j1 = last_i1, last_j1
+
+        if command != 'equal':
+            if i1 == i2:
+                command = 'insert'
+            elif j1 == j2:
+                command = 'delete'
+            else:
+                command = 'replace'
+        result.append((command, i1, i2, j1, j2))
 
-    return limited_tokens
+    return result
+
+
+# Bump this whenever the format of `_diff_patch()` changes.
+PATCH_FORMAT_VERSION = 1
+
+
+def _diff_patch(old_tokens, new_tokens, opcodes):
+    """
+    Describe a diff as a compact, JSON-serializable patch to the new (`b`)
+    document, like:
+
+        {'version': 1,
+         'b_tokens': 120,
+         'changes': [[10, 12, 'old words '], [50, 51, ''], [80, 80, 'gone']]}
+
+    Each change is a `[start, end, deleted]` list, meaning the tokens from
+    `start` up to `end` in `b` were inserted in place of the `deleted` HTML
+    from `a`. Either may be empty. Unchanged spans are left out.
+
+    Positions are indexes into the list of `b`'s tokens (`b_tokens` is how
+    many there are), which are, in document order: each whitespace-separated
+    word of text, each `<img>`, the `href` of each `<a>`, and each element
+    whose content isn't diffed (`<script>`, `<style>`, `<svg>`, etc.). These
+    are the tokens `tokenize()` produces for `b`'s body; the placeholder
+    tokens the diff adds to help match things up (`SpacerToken`) are not
+    counted.
+
+    Deleted HTML only has the text and images of the deleted tokens, not the
+    elements around them. Deleted scripts and styles are wrapped in a
+    `<template class="wm-diff-deleted-inert">` so they can't run.
+    """
+    # Map each index in `new_tokens` to its position without spacers.
+    positions = [0]
+    for token in new_tokens:
+        positions.append(positions[-1] + (not isinstance(token, SpacerToken)))
+
+    changes = []
+    for command, i1, i2, j1, j2 in opcodes:
+        if command != 'equal':
+            start = positions[j1]
+            end = positions[j2]
+            deleted = ''.join(_deleted_html(token)
+                              for token in old_tokens[i1:i2])
+            # Changes that were only to spacers don't change anything.
+            if start != end or deleted:
+                changes.append([start, end, deleted])
+
+    return {'version': PATCH_FORMAT_VERSION,
+            'b_tokens': positions[-1],
+            'changes': changes}
+
+
+def _deleted_html(token):
+    html = token.html()
+    if isinstance(token, UndiffableContentToken):
+        html = f'<template class="wm-diff-deleted-inert">{html}</template>'
+    return html + token.trailing_whitespace
+
+
+def _elide_unchanged(old_tokens, new_tokens, opcodes, context_blocks=2):
+    """
+    Replace each unchanged span of tokens, except for the `context_blocks`
+    blocks (see `_find_blocks()`) closest to a change, with an `ElidedToken`.
+    Returns new lists of old tokens, new tokens, and opcodes.
+    """
+    starts = [start for start, _ in _find_blocks(new_tokens)]
+    old_result = []
+    new_result = []
+    result_opcodes = []
+
+    def add(command, old_span, new_span):
+        old_start = len(old_result)
+        new_start = len(new_result)
+        old_result.extend(old_span)
+        new_result.extend(new_span)
+        result_opcodes.append((command, old_start, len(old_result),
+                               new_start, len(new_result)))
+
+    last_index = len(opcodes) - 1
+    for index, (command, i1, i2, j1, j2) in enumerate(opcodes):
+        if command == 'equal':
+            # Blocks are found in the new tokens; old ones are offset by this.
+            offset = i1 - j1
+            head_end = j1
+            if index > 0:
+                head_end = _context_end(starts, j1, j2, context_blocks)
+            tail_start = j2
+            if index < last_index:
+                tail_start = _context_start(starts, j1, j2, context_blocks)
+            if head_end < tail_start:
+                if j1 < head_end:
+                    add('equal', old_tokens[i1:head_end + offset],
+                        new_tokens[j1:head_end])
+                add('equal',
+                    [ElidedToken.for_tokens(
+                        old_tokens[head_end + offset:tail_start + offset])],
+                    [ElidedToken.for_tokens(new_tokens[head_end:tail_start])])
+                if tail_start < j2:
+                    add('equal', old_tokens[tail_start + offset:i2],
+                        new_tokens[tail_start:j2])
+                continue
+        add(command, old_tokens[i1:i2], new_tokens[j1:j2])
+
+    return old_result, new_result, _normalize_opcodes(result_opcodes)
+
+
+def _context_end(starts, start, end, context_blocks):
+    """
+    Find where `context_blocks` blocks after `start` (plus the rest of the
+    block `start` is in) end, but no later than `end`. `starts` is a sorted
+    list of block start indexes.
+    """
+    position = bisect.bisect_right(starts, start)
+    in_block = starts[position - 1] != start if position else True
+    index = position + context_blocks - (0 if in_block else 1)
+    if index < position:
+        return start
+    if index < len(starts):
+        return min(starts[index], end)
+    return end
+
+
+def _context_start(starts, start, end, context_blocks):
+    """
+    Find where `context_blocks` blocks before `end` (plus the part of the
+    block `end` is in) start, but no earlier than `start`. `starts` is a
+    sorted list of block start indexes.
+    """
+    position = bisect.bisect_left(starts, end)
+    in_block = position == len(starts) or starts[position] != end
+    index = position - context_blocks - (1 if in_block else 0)
+    if index >= position:
+        return end
+    if index >= 0:
+        return max(starts[index], start)
+    return start
 
 
 def _count_changes(opcodes):
@@ -462,6 +1531,27 @@ def _count_changes(opcodes):
     }
 
 
+def _count_changed_content(old_tokens, new_tokens, opcodes):
+    """
+    Count the characters and UTF-8 bytes of the content (and whitespace after
+    it) of the tokens that were deleted and inserted in a diff.
+    """
+    deleted = ''.join(token.html() + token.trailing_whitespace
+                      for operation, old_start, old_end, _, _ in opcodes
+                      if operation in ('delete', 'replace')
+                      for token in old_tokens[old_start:old_end])
+    inserted = ''.join(token.html() + token.trailing_whitespace
+                       for operation, _, _, new_start, new_end in opcodes
+                       if operation in ('insert', 'replace')
+                       for token in new_tokens[new_start:new_end])
+    return {
+        'inserted_chars': len(inserted),
+        'deleted_chars': len(deleted),
+        'inserted_bytes': len(inserted.encode('utf-8', 'surrogatepass')),
+        'deleted_bytes': len(deleted.encode('utf-8', 'surrogatepass')),
+    }
+
+
 # --------------------- lxml.html.diff Tokenization --------------------------
 # The following tokenization-related code is more-or-less copied from
 # lxml.html.diff. We plan to change it significantly.
@@ -562,8 +1652,58 @@ class href_token(DiffToken):
         return ' Link: %s' % self
 
 
-class UndiffableContentToken(DiffToken):
-    pass
+# Words longer than this are compared by fingerprint (see `LongTextToken`).
+FINGERPRINT_MIN_LENGTH = 256
+
+
+class FingerprintedToken(DiffToken):
+    """
+    A token for a potentially large piece of content. Its text, which is what
+    it's compared and hashed by, is a short 64-bit fingerprint of the content,
+    so diffing doesn't have to repeatedly hash and compare the whole thing.
+    The actual content is kept in `source` and only used when rendering.
+
+    Fingerprints start with `<`, which never appears in the (HTML-escaped)
+    text of ordinary tokens, so they can't be mistaken for regular words.
+    """
+    def __new__(cls, source, pre_tags=None, post_tags=None,
+                trailing_whitespace=""):
+        fingerprint = hashlib.blake2b(source.encode('utf-8', 'surrogatepass'),
+                                      digest_size=8).hexdigest()
+        obj = DiffToken.__new__(cls, f'<#{fingerprint}', pre_tags=pre_tags,
+                                post_tags=post_tags,
+                                trailing_whitespace=trailing_whitespace)
+        obj.source = source
+        return obj
+
+    def html(self):
+        return self.source
+
+
+class UndiffableContentToken(FingerprintedToken):
+    """
+    An element whose content isn't diffed, like `<script>` or `<svg>` (see
+    `undiffable_content_tags`). It is only ever equal or changed as a whole.
+    """
+
+
+class LongTextToken(FingerprintedToken):
+    """
+    A single, unusually long word (e.g. a data URL or a long run of
+    punctuation in the text).
+    """
+
+
+def _word_token(word, pre_tags=None, trailing_whitespace=""):
+    """
+    Create a token for a word of text, using a `LongTextToken` if the word is
+    long enough to be worth comparing by fingerprint.
+    """
+    if len(word) > FINGERPRINT_MIN_LENGTH:
+        return LongTextToken(word, pre_tags=pre_tags,
+                             trailing_whitespace=trailing_whitespace)
+    return DiffToken(word, pre_tags=pre_tags,
+                     trailing_whitespace=trailing_whitespace)
 
 
 def tokenize(html, include_hrefs=True):
@@ -585,10 +1725,7 @@ def tokenize(html, include_hrefs=True):
         body_el = html
     else:
         body_el = parse_html(html, cleanup=True)
-    # Then we split the document into text chunks for each tag, word, and end tag:
-    chunks = flatten_el(body_el, skip_tag=True, include_hrefs=include_hrefs)
-    # Finally re-joining them into token objects:
-    return fixup_chunks(chunks)
+    return tokenize_element(body_el, include_hrefs=include_hrefs)
 
 def parse_html(html, cleanup=True):
     """
@@ -601,7 +1738,10 @@ def parse_html(html, cleanup=True):
     if cleanup:
         # This removes any extra markup or structure like <head>:
         html = cleanup_html(html)
-    return fragment_fromstring(html, create_parent=True)
+    # Without `huge_tree`, libxml2 silently drops anything nested more than
+    # about 256 elements deep. (Parsers aren't thread-safe, so don't share it.)
+    return fragment_fromstring(html, create_parent=True,
+                               parser=HTMLParser(huge_tree=True))
 
 _body_re = re.compile(r'<body.*?>', re.I|re.S)
 _end_body_re = re.compile(r'</body.*?>', re.I|re.S)
@@ -627,63 +1767,91 @@ def split_trailing_whitespace(word):
     stripped_length = len(word.rstrip())
     return word[0:stripped_length], word[stripped_length:]
 
-class TokenType(Enum):
-    undiffable = 0
-    start_tag = 1
-    end_tag = 2
-    word = 3
-    href = 4
-    img = 5
-
-
-def fixup_chunks(chunks):
+def tokenize_element(body_el, include_hrefs=True):
     """
-    This function takes a list of chunks and produces a list of tokens.
+    Walk an lxml element and produce a list of tokens (words with attached
+    tags) for its contents. The element's own start and end tags are not
+    included.
+
+    Every start tag, word, and end tag in the tree becomes either a token or a
+    tag attached to a token's `pre_tags` or `post_tags`. This walks the tree
+    with an explicit stack instead of recursing, so it works on arbitrarily
+    deep documents, and builds the final tokens as it goes.
     """
+    result = []
+    # Tags that have not been attached to a token yet. They'll become the
+    # `pre_tags` of the next token.
     tag_accum = []
     cur_word = None
-    result = []
-    for chunk in chunks:
-        current_token = chunk[0]
-        if current_token == TokenType.img:
-            src = chunk[1]
-            tag, trailing_whitespace = split_trailing_whitespace(chunk[2])
-            cur_word = tag_token('img', src, html_repr=tag,
-                                 pre_tags=tag_accum,
-                                 trailing_whitespace=trailing_whitespace)
-            tag_accum = []
-            result.append(cur_word)
 
-        elif current_token == TokenType.href:
-            href = chunk[1]
-            cur_word = href_token(href, pre_tags=tag_accum, trailing_whitespace=" ")
+    # Each entry is an element and an iterator over its remaining children.
+    stack = [(body_el, iter(body_el))]
+    if not _is_empty_void(body_el):
+        for word, trailing_whitespace in _split_words(body_el.text):
+            cur_word = _word_token(word, pre_tags=tag_accum,
+                                   trailing_whitespace=trailing_whitespace)
             tag_accum = []
             result.append(cur_word)
 
-        elif current_token == TokenType.undiffable:
-            cur_word = UndiffableContentToken(chunk[1], pre_tags=tag_accum)
-            tag_accum = []
-            result.append(cur_word)
+    while stack:
+        el, children = stack[-1]
+        for child in children:
+            tag = child.tag
+            if not isinstance(tag, str):
+                # Comments and processing instructions are not diffable, but
+                # any text that follows them is.
+                for word, trailing_whitespace in _split_words(child.tail):
+                    cur_word = _word_token(
+                        word,
+                        pre_tags=tag_accum,
+                        trailing_whitespace=trailing_whitespace)
+                    tag_accum = []
+                    result.append(cur_word)
+                continue
 
-        elif current_token == TokenType.word:
-            chunk, trailing_whitespace = split_trailing_whitespace(chunk[1])
-            cur_word = DiffToken(chunk, pre_tags=tag_accum, trailing_whitespace=trailing_whitespace)
-            tag_accum = []
-            result.append(cur_word)
+            if tag == 'img':
+                cur_word = tag_token('img', child.get('src'),
+                                     html_repr=start_tag(child),
+                                     pre_tags=tag_accum)
+                tag_accum = []
+                result.append(cur_word)
+            elif tag in undiffable_content_tags:
+                # NOTE: the serialized element includes its tail text.
+                cur_word = UndiffableContentToken(
+                    etree.tostring(child, encoding=str, method='html'),
+                    pre_tags=tag_accum)
+                tag_accum = []
+                result.append(cur_word)
+                continue
+            else:
+                tag_accum.append(start_tag(child))
+
+            if _is_empty_void(child):
+                continue
 
-        elif current_token == TokenType.start_tag:
-            tag_accum.append(chunk[1])
+            for word, trailing_whitespace in _split_words(child.text):
+                cur_word = _word_token(word, pre_tags=tag_accum,
+                                       trailing_whitespace=trailing_whitespace)
+                tag_accum = []
+                result.append(cur_word)
 
-        elif current_token == TokenType.end_tag:
-            if tag_accum:
-                tag_accum.append(chunk[1])
-            else:
-                assert cur_word, (
-                    "Weird state, cur_word=%r, result=%r, chunks=%r of %r"
-                    % (cur_word, result, chunk, chunks))
-                cur_word.post_tags.append(chunk[1])
+            if len(child):
+                stack.append((child, iter(child)))
+                break
+
+            cur_word, tag_accum = _close_element(child, include_hrefs, result,
+                                                 cur_word, tag_accum)
         else:
-            assert(0)
+            stack.pop()
+            if stack:
+                cur_word, tag_accum = _close_element(el, include_hrefs, result,
+                                                     cur_word, tag_accum)
+            elif el.tag == 'a' and el.get('href') and include_hrefs:
+                # This is the outermost element; only its href is relevant.
+                cur_word = href_token(el.get('href'), pre_tags=tag_accum,
+                                      trailing_whitespace=' ')
+                tag_accum = []
+                result.append(cur_word)
 
     if not result:
         return [DiffToken('', pre_tags=tag_accum)]
@@ -692,37 +1860,42 @@ def fixup_chunks(chunks):
 
     return result
 
-def flatten_el(el, include_hrefs, skip_tag=False):
-    """ Takes an lxml element el, and generates all the text chunks for
-    that tag.  Each start tag is a chunk, each word is a chunk, and each
-    end tag is a chunk.
-
-    If skip_tag is true, then the outermost container tag is
-    not returned (just its contents)."""
-    if not skip_tag:
-        if el.tag == 'img':
-            yield (TokenType.img, el.get('src'), start_tag(el))
-        elif el.tag in undiffable_content_tags:
-            element_source = etree.tostring(el, encoding=str, method='html')
-            yield (TokenType.undiffable, element_source)
-            return
-        else:
-            yield (TokenType.start_tag, start_tag(el))
-    if el.tag in void_tags and not el.text and not len(el) and not el.tail:
-        return
-    start_words = split_words(el.text)
-    for word in start_words:
-        yield (TokenType.word, html_escape(word))
-    for child in el:
-        for item in flatten_el(child, include_hrefs=include_hrefs):
-            yield item
-    if el.tag == 'a' and el.get('href') and include_hrefs:
-        yield (TokenType.href, el.get('href'))
-    if not skip_tag:
-        yield (TokenType.end_tag, end_tag(el))
-        end_words = split_words(el.tail)
-        for word in end_words:
-            yield (TokenType.word, html_escape(word))
+
+def _close_element(el, include_hrefs, result, cur_word, tag_accum):
+    """
+    Add the tokens and tags for the end of an element (its href, end tag, and
+    tail text) to a token list that is being built by `tokenize_element()`.
+    Returns the new values for `cur_word` and `tag_accum`.
+    """
+    if el.tag == 'a' and include_hrefs:
+        href = el.get('href')
+        if href:
+            cur_word = href_token(href, pre_tags=tag_accum,
+                                  trailing_whitespace=' ')
+            tag_accum = []
+            result.append(cur_word)
+
+    if tag_accum:
+        tag_accum.append(end_tag(el))
+    else:
+        assert cur_word, (
+            "Weird state, cur_word=%r, result=%r, closing %r"
+            % (cur_word, result, el))
+        cur_word.post_tags.append(end_tag(el))
+
+    for word, trailing_whitespace in _split_words(el.tail):
+        cur_word = _word_token(word, pre_tags=tag_accum,
+                               trailing_whitespace=trailing_whitespace)
+        tag_accum = []
+        result.append(cur_word)
+
+    return cur_word, tag_accum
+
+
+def _is_empty_void(el):
+    return (el.tag in void_tags and not el.text and not len(el)
+            and not el.tail)
+
 
 split_words_re = re.compile(r'\S+(?:\s+|$)', re.U)
 
@@ -735,15 +1908,27 @@ def split_words(text):
     words = split_words_re.findall(text)
     return words
 
+_split_words_re = re.compile(r'(\S+)(\s*)', re.U)
+
+def _split_words(text):
+    """
+    Splits some text into words, returning a list of tuples with the
+    HTML-escaped word and its trailing whitespace.
+    """
+    if not text:
+        return ()
+    return [(html_escape(word), whitespace)
+            for word, whitespace in _split_words_re.findall(text)]
+
 start_whitespace_re = re.compile(r'^[ \t\n\r]')
 
 def start_tag(el):
     """
     The text representation of the start tag for a tag.
     """
-    return '<%s%s>' % (
+    return Tag('<%s%s>' % (
         el.tag, ''.join([' %s="%s"' % (name, html_escape(value, True))
-                         for name, value in el.attrib.items()]))
+                         for name, value in el.attrib.items()])), el.tag)
 
 def end_tag(el):
     """ The text representation of an end tag for a tag.  Includes
@@ -752,7 +1937,55 @@ def end_tag(el):
         extra = ' '
     else:
         extra = ''
-    return '</%s>%s' % (el.tag, extra)
+    return Tag('</%s>%s' % (el.tag, extra), el.tag, open=False)
+
+
+_tag_flags = {}
+
+
+class Tag(str):
+    """
+    The source text of a start or end tag, e.g. `<p class="intro">` or `</p>`,
+    in a token's `pre_tags` or `post_tags`. It acts like a string, but also
+    has the tag's `name`, whether it is an `open` tag, and `flags` (like
+    `BLOCK_TAG`) that describe how to treat it, so later steps of the diff
+    never need to re-parse the text.
+    """
+    def __new__(cls, text, name, open=True):
+        obj = str.__new__(cls, text)
+        obj.name = name
+        obj.open = open
+        flags = _tag_flags.get(name)
+        if flags is None:
+            flags = _tag_flags[name] = cls._flags_for_name(name)
+        obj.flags = flags
+        return obj
+
+    def __getnewargs__(self):
+        return (str(self), self.name, self.open)
+
+    @classmethod
+    def start(cls, name):
+        "Create a bare start tag (with no attributes) for an element name."
+        return cls(f'<{name}>', name)
+
+    @classmethod
+    def end(cls, name):
+        "Create an end tag for an element name."
+        return cls(f'</{name}>', name, open=False)
+
+    @staticmethod
+    def _flags_for_name(name):
+        flags = 0
+        if name in block_level_tags:
+            flags |= BLOCK_TAG
+        if name in empty_tags:
+            flags |= VOID_TAG
+        if name in undiffable_content_tags:
+            flags |= UNDIFFABLE_TAG
+        if name in SEPARATABLE_TAGS:
+            flags |= SEPARATABLE_TAG
+        return flags
 
 
 # ------------------ END lxml.html.diff Tokenization ------------------------
@@ -810,6 +2043,38 @@ class SpacerToken(DiffToken):
         return ''
 
 
+class ElidedToken(DiffToken):
+    """
+    Stands in for a span of unchanged tokens left out of a diff (see
+    `ELIDED_HTML`). Its `pre_tags` close any elements that were open before
+    the span but closed in it, and its `post_tags` open any elements that were
+    opened in the span but not closed, so the surrounding markup still nests
+    the same way.
+    """
+    def html(self):
+        return ELIDED_HTML.format(count=self.count)
+
+    @classmethod
+    def for_tokens(cls, tokens):
+        closed = []
+        opened = []
+        for token in tokens:
+            for tag in itertools.chain(token.pre_tags, token.post_tags):
+                if tag.flags & VOID_TAG:
+                    continue
+                elif tag.open:
+                    opened.append(tag)
+                elif any(open_tag.name == tag.name for open_tag in opened):
+                    # Implicitly close anything still open inside this tag.
+                    while opened.pop().name != tag.name:
+                        pass
+                else:
+                    closed.append(tag)
+        token = cls('…', pre_tags=closed, post_tags=opened)
+        token.count = len(tokens)
+        return token
+
+
 # I had some weird concern that I needed to make this token a single word with
 # no spaces, but now that I know this differ more deeply, this is pointless.
 class ImgTagToken(tag_token):
@@ -826,8 +2091,6 @@ class ImgTagToken(tag_token):
 
 
 def _customize_tokens(tokens):
-    SPACER_STRING = '\nSPACER'
-
     # Balance out pre- and post-tags so that a token of text is surrounded by
     # the opening and closing tags of the element it's in. For example:
     #
@@ -852,7 +2115,7 @@ def _customize_tokens(tokens):
         previous = tokens[token_index - 1]
         previous_post_complete = False
         for post_index, tag in enumerate(previous.post_tags):
-            if not tag.startswith('</'):
+            if tag.open:
                 # TODO: should we attempt to fill pure-structure tags here with
                 # spacers? e.g. should we take the "<p><em></em></p>" here and
                 # wrap a spacer token in it instead of moving to "next-text's"
@@ -864,7 +2127,7 @@ def _customize_tokens(tokens):
 
         if not previous_post_complete:
             for pre_index, tag in enumerate(token.pre_tags):
-                if not tag.startswith('</'):
+                if tag.open:
                     if pre_index > 0:
                         previous.post_tags.extend(token.pre_tags[:pre_index])
                         token.pre_tags = token.pre_tags[pre_index:]
@@ -877,48 +2140,7 @@ def _customize_tokens(tokens):
         # logger.debug(f'  Result...\n    pre: {token.pre_tags}\n    token: "{token}"\n    post: {token.post_tags}')
 
     result = []
-    # for token in tokens:
-    for token_index, token in enumerate(tokens):
-        # if str(token).lower().startswith('impacts'):
-        # if str(token).lower().startswith('although'):
-        #     logger.debug(f'SPECIAL TAG!\n  pre: {token.pre_tags}\n  token: "{token}"\n  post: {token.post_tags}')
-
-        # hahaha, this is crazy. But anyway, insert "spacers" that have
-        # identical text the diff algorithm can latch onto as an island of
-        # unchangedness. We do this anywhere a SEPARATABLE_TAG is opened.
-        # Basically, this lets us create a sort of "wall" between changes,
-        # ensuring a continuous insertion or deletion can't spread across
-        # list items, major page sections, etc.
-        # See farther down in this same method for a repeat of this with
-        # `post_tags`
-        try_splitting = len(token.pre_tags) > 0
-        split_start = 0
-        while try_splitting:
-            for tag_index, tag in enumerate(token.pre_tags[split_start:]):
-                split_here = False
-                for name in SEPARATABLE_TAGS:
-                    if tag.startswith(f'<{name}'):
-                        split_here = True
-                        break
-                if split_here:
-                    # new_token = SpacerToken(SPACER_STRING, pre_tags=token.pre_tags[0:tag_index + 1])
-                    # token.pre_tags = token.pre_tags[tag_index + 1:]
-
-                    new_token = SpacerToken(SPACER_STRING, pre_tags=token.pre_tags[0:tag_index + split_start])
-                    token.pre_tags = token.pre_tags[tag_index + split_start:]
-
-                    # tokens.insert(token_index + 1, token)
-                    # token = new_token
-                    result.append(new_token)
-                    result.append(SpacerToken(SPACER_STRING))
-                    result.append(SpacerToken(SPACER_STRING))
-                    try_splitting = len(token.pre_tags) > 1
-                    split_start = 1
-                    break
-                else:
-                    try_splitting = False
-
-
+    for token in tokens:
         # This is a CRITICAL scenario, but should probably be generalized and
         # a bit better understood. The case is empty elements that are fully
         # nested inside something, so you have a structure like:
@@ -929,97 +2151,150 @@ def _customize_tokens(tokens):
         # later, when stuff gets rebalanced, `Text!` gets moved down inside the
         # <div> that completely precedes it.
         for index, tag in enumerate(token.pre_tags):
-            if tag.startswith('<a') and len(token.pre_tags) > index + 1:
+            if tag.name == 'a' and tag.open and len(token.pre_tags) > index + 1:
                 next_tag = token.pre_tags[index + 1]
-                if next_tag and next_tag.startswith('</a'):
+                if next_tag.name == 'a' and not next_tag.open:
                     result.append(SpacerToken('~EMPTY~', pre_tags=token.pre_tags[0:index], post_tags=token.pre_tags[index:]))
                     token.pre_tags = []
 
-        # if _has_separation_tags(token.pre_tags):
-        #     # result.append(SpacerToken(SPACER_STRING, token.pre_tags))
-        #     # token.pre_tags = []
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     result.append(SpacerToken(SPACER_STRING))
-
-        customized = _customize_token(token)
-        result.append(customized)
-
-        if str(customized) == "Posts" and str(tokens[token_index - 1]) == 'Other' and str(tokens[token_index - 2]) == 'and': # and str(tokens[token_index - 3]) == 'posts':
-            logger.debug(f'SPECIAL TAG!\n  pre: {token.pre_tags}\n  token: "{token}"\n  post: {token.post_tags}')
-            next_token = tokens[token_index + 1]
-            logger.debug(f'SPECIAL TAG!\n  pre: {next_token.pre_tags}\n  token: "{next_token}"\n  post: {next_token.post_tags}')
-            for tag_index, tag in enumerate(customized.post_tags):
-                if tag.startswith('</ul>'):
-                    new_token = SpacerToken(SPACER_STRING)
-                    result.append(new_token)
-                    new_token = SpacerToken(SPACER_STRING, pre_tags=customized.post_tags[tag_index:])
-                    result.append(new_token)
-                    customized.post_tags = customized.post_tags[:tag_index]
-
-        # if isinstance(customized, ImgTagToken):
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     logger.debug(f'IMAGE TOKEN:')
-        #     logger.debug(f'  pre: {customized.pre_tags}\n  token: "{customized}"\n  post: {customized.post_tags}')
-
-        # if len(customized.post_tags) > 0:
-        #     result.append(SpacerToken('', post_tags=customized.post_tags))
-        #     customized.post_tags = []
-
-        # if (_has_separation_tags(customized.post_tags)):
-        #     result.append(SpacerToken(SPACER_STRING, pre_tags=customized.post_tags))
-        #     # result.append(SpacerToken(SPACER_STRING, post_tags=customized.post_tags, trailing_whitespace=customized.trailing_whitespace))
-        #     customized.post_tags = []
-        #     # customized.trailing_whitespace = ''
-        for tag_index, tag in enumerate(customized.post_tags):
-            split_here = False
-            for name in SEPARATABLE_TAGS:
-                if tag.startswith(f'<{name}'):
-                    split_here = True
-                    break
-            if split_here:
-                # new_token = SpacerToken(SPACER_STRING, pre_tags=customized.post_tags[tag_index + 1:])
-                # customized.post_tags = customized.post_tags[0:tag_index + 1]
-
-                # new_token = SpacerToken(SPACER_STRING, pre_tags=customized.post_tags[tag_index:])
-                # customized.post_tags = customized.post_tags[0:tag_index]
-
-                new_token = SpacerToken(SPACER_STRING, post_tags=customized.post_tags[tag_index:])
-                customized.post_tags = customized.post_tags[0:tag_index]
-
-                # tokens.insert(token_index + 1, token)
-                # token = new_token
-                result.append(new_token)
-                result.append(SpacerToken(SPACER_STRING))
-                result.append(SpacerToken(SPACER_STRING))
-                break
+        result.append(_customize_token(token))
 
     return result
 
 
-# One would *think* including `<h#>` tags here would make sense, but it turns
-# out we've seen a variety of real-world situations where tags flip from inline
-# markup to headings or headings nested by themselves (!) in other structural
-# markup, making them cause frequent problems if included here.
-SEPARATABLE_TAGS = set(['blockquote', 'section', 'article', 'header',
-                        'footer', 'pre', 'ul', 'ol', 'li', 'table', 'p'])
-HEADING_TAGS = set(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
-def _has_separation_tags(tag_list):
-    for index, tag in enumerate(tag_list):
-        for name in SEPARATABLE_TAGS:
-            if tag.startswith(f'<{name}') or tag.startswith(f'</{name}'):
-                logger.debug(f'Separating on: {name}')
-                return True
-        if 'id=' in tag:
+def _find_blocks(tokens):
+    """
+    Split a list of tokens into blocks wherever one of the `SEPARATABLE_TAGS`
+    is opened. The diff treats these as hard boundaries: a continuous insertion
+    or deletion can't spread across list items, major page sections, etc.
+
+    Returns a list of `(start, end)` index ranges into `tokens`.
+    """
+    starts = [0]
+    for index, token in enumerate(tokens):
+        if index > 0 and _opens_separatable_tag(token.pre_tags):
+            starts.append(index)
+        if _opens_separatable_tag(token.post_tags):
+            starts.append(index + 1)
+
+    blocks = []
+    for start, end in zip(starts, starts[1:] + [len(tokens)]):
+        if start < end:
+            blocks.append((start, end))
+    return blocks
+
+
+def _opens_separatable_tag(tag_list):
+    for tag in tag_list:
+        if tag.open and tag.flags & SEPARATABLE_TAG:
             return True
     return False
 
-def _has_heading_tags(tag_list):
-    for index, tag in enumerate(tag_list):
-        for name in HEADING_TAGS:
-            if tag.startswith(f'<{name}') or tag.startswith(f'</{name}'):
-                return True
+
+# Every kind of token that `serialize_tokens()` can handle. A token's kind is
+# stored as its index in this list, so only ever add to the end of it (and
+# bump `TOKEN_FORMAT_VERSION` if you change it).
+_SERIALIZABLE_TOKENS = [DiffToken, UndiffableContentToken, href_token,
+                        MinimalHrefToken, SpacerToken, tag_token, ImgTagToken,
+                        LongTextToken]
+
+TOKEN_FORMAT_VERSION = 2
+
+
+def serialize_tokens(tokens):
+    """
+    Serialize a list of tokens as compact, compressed bytes that can be turned
+    back into tokens with `deserialize_tokens()`.
+
+    Each unique string (token text, tag source, etc.) and each unique tag is
+    only stored once; tokens are stored as a flat list of numbers that refer
+    to them:
+
+        kind, text, trailing whitespace, pre_tags count, *pre_tags,
+        post_tags count, *post_tags, [tag, data, html_repr (tag tokens only)]
+
+    For `FingerprintedToken`s, the text is the `source`.
+    """
+    strings = {}
+    tags = {}
+    kinds = {kind: index for index, kind in enumerate(_SERIALIZABLE_TOKENS)}
+
+    def add_string(text):
+        return strings.setdefault(text, len(strings))
+
+    def add_tag(tag):
+        key = (tag, tag.name, tag.open)
+        index = tags.get(key)
+        if index is None:
+            index = tags[key] = len(tags)
+        return index
+
+    records = []
+    for token in tokens:
+        records.append(kinds[type(token)])
+        if isinstance(token, FingerprintedToken):
+            records.append(add_string(token.source))
+        else:
+            records.append(add_string(str(token)))
+        records.append(add_string(token.trailing_whitespace))
+        records.append(len(token.pre_tags))
+        records.extend(add_tag(tag) for tag in token.pre_tags)
+        records.append(len(token.post_tags))
+        records.extend(add_tag(tag) for tag in token.post_tags)
+        if isinstance(token, tag_token):
+            records.append(add_string(token.tag))
+            records.append(add_string(token.data))
+            records.append(add_string(token.html_repr))
+
+    tag_records = [[add_string(text), add_string(name), int(is_open)]
+                   for text, name, is_open in tags]
+    data = {
+        'version': TOKEN_FORMAT_VERSION,
+        'strings': list(strings),
+        'tags': tag_records,
+        'tokens': records,
+    }
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+
+
+def deserialize_tokens(data):
+    """
+    Create a list of tokens from bytes made by `serialize_tokens()`. Raises
+    `ValueError` if the data is in an unknown format.
+    """
+    data = json.loads(zlib.decompress(data))
+    if data.get('version') != TOKEN_FORMAT_VERSION:
+        raise ValueError(f'Unknown token format: {data.get("version")}')
+
+    strings = data['strings']
+    tags = [Tag(strings[text], strings[name], bool(is_open))
+            for text, name, is_open in data['tags']]
+    records = data['tokens']
+    tokens = []
+    index = 0
+    while index < len(records):
+        kind = _SERIALIZABLE_TOKENS[records[index]]
+        text = strings[records[index + 1]]
+        trailing_whitespace = strings[records[index + 2]]
+        index += 3
+        pre_tags = [tags[tag] for tag in
+                    records[index + 1:index + 1 + records[index]]]
+        index += 1 + records[index]
+        post_tags = [tags[tag] for tag in
+                     records[index + 1:index + 1 + records[index]]]
+        index += 1 + records[index]
+        if issubclass(kind, tag_token):
+            tag, tag_data, html_repr = (strings[record] for record
+                                        in records[index:index + 3])
+            index += 3
+            token = kind(tag, tag_data, html_repr, pre_tags=pre_tags,
+                         post_tags=post_tags,
+                         trailing_whitespace=trailing_whitespace)
+        else:
+            token = kind(text, pre_tags=pre_tags, post_tags=post_tags,
+                         trailing_whitespace=trailing_whitespace)
+        tokens.append(token)
+    return tokens
 
 
 # Seemed so nice and clean! But should probably be merged into
@@ -1049,8 +2324,6 @@ def _customize_token(token):
         return token
 
 
-# TODO: merge and reconcile this with `merge_change_groups()`, which is 90%
-# the same thing; it outputs the change elements as nested lists of tokens.
 def merge_changes(change_chunks, doc, tag_type='ins'):
     """
     Merge tokens that were changed into a list of tokens (that represents the
@@ -1062,6 +2335,8 @@ def merge_changes(change_chunks, doc, tag_type='ins'):
 
         <ins>Some</ins><p><ins>inserted</ins></p><ins>text</ins>
 
+    This is the same as `merge_change_groups()`, but outputs a flat list.
+
     Parameters
     ----------
     change_chunks : list of token
@@ -1071,109 +2346,9 @@ def merge_changes(change_chunks, doc, tag_type='ins'):
     tag_type : str
         The type of HTML tag to wrap the changes with.
     """
-    # NOTE: this serves a similar purpose to LXML's html.diff.merge_insert
-    # function, though this is much more complicated. LXML's version takes a
-    # simpler approach to placing tags, then later runs the whole thing through
-    # an XML parser, manipulates the tree, and re-serializes. We don't do that
-    # here because it turns out to exacerbate some errors in the placement of
-    # insert and delete tags. Think of it like splinting a broken bone without
-    # setting it first.
-    #
-    # Here, we actually attempt to keep track of the stack of elements and
-    # proactively put tags in the right place and break them up so the
-    # resulting token stream represents valid markup. Happily, that also means
-    # we don't also have to do the expensive parse-then-serialize step later!
-    depth = 0
-    current_content = None
-    for chunk in change_chunks:
-        inline_tag = False
-        inline_tag_name = None
-
-        if chunk == '':
-            continue
-
-        # FIXME: explicitly handle elements that can't have our markers as
-        # direct children.
-        if chunk[0] == '<':
-            # NOTE: split first by `>` because we could have undiffable items
-            # with content here, i.e. more than one tag.
-            name = chunk.split('>', 1)[0].split(None, 1)[0].strip('<>/')
-            # Also treat `a` tags as block in this context, because they *can*
-            # contain block elements, like `h1`, etc.
-            is_block = name in block_level_tags or name == 'a'
-
-            if chunk[1] == '/':
-                if depth > 0:
-                    if is_block:
-                        for nested_tag in current_content:
-                            doc.append(f'</{nested_tag}>')
-                        doc.append(f'</{tag_type}>')
-                        current_content = None
-                        depth -= 1
-                        doc.append(chunk)
-                    else:
-                        if name in current_content:
-                            index = current_content.index(name)
-                            current_content = current_content[index + 1:]
-                            doc.append(chunk)
-                        else:
-                            # only a malformed document should hit this case
-                            # where tags aren't properly nested ¯\_(ツ)_/¯
-                            for nested_tag in current_content:
-                                doc.append(f'</{nested_tag}>')
-
-                            doc.append(f'</{tag_type}>')
-                            doc.append(chunk)
-                            doc.append(f'<{tag_type} class="wm-diff">')
-
-                            # other side of the malformed document case from above
-                            current_content.reverse()
-                            for nested_tag in current_content:
-                                doc.append(f'<{nested_tag}>')
-                            current_content.reverse()
-                else:
-                    doc.append(chunk)
-                # There is no case for a closing tag where aren't doen with the chunk
-                continue
-            else:
-                if is_block:
-                    if depth > 0:
-                        for nested_tag in current_content:
-                            doc.append(f'</{nested_tag}>')
-                        doc.append(f'</{tag_type}>')
-                        current_content = None
-                        depth -= 1
-                    doc.append(chunk)
-                    continue
-                else:
-                    inline_tag = True
-                    inline_tag_name = name
-
-        if depth == 0:
-            doc.append(f'<{tag_type} class="wm-diff">')
-            depth += 1
-            current_content = []
-
-        doc.append(chunk)
-        # Note the undiffable_content_tags check here. We assume tokens for
-        # those tags represent a whole element, not just a start or end tag,
-        # so we don't consider them "open" as part of `current_content`.
-        if (inline_tag and
-                (inline_tag_name not in undiffable_content_tags) and
-                (inline_tag_name not in empty_tags)):
-            # FIXME: track the original start tag for when we need to break
-            # these elements around boundaries.
-            current_content.insert(0, inline_tag_name)
-
-    if depth > 0:
-        for nested_tag in current_content:
-            doc.append(f'</{nested_tag}>')
-
-        doc.append(f'</{tag_type}>')
-
-        current_content.reverse()
-        for nested_tag in current_content:
-            doc.append(f'<{nested_tag}>')
+    groups = []
+    merge_change_groups(change_chunks, groups, tag_type)
+    doc.extend(flatten_groups(groups))
 
 
 def assemble_diff(html1_tokens, html2_tokens, commands, include='combined'):
@@ -1181,128 +2356,165 @@ def assemble_diff(html1_tokens, html2_tokens, commands, include='combined'):
     Assembles a renderable HTML string from a set of old and new tokens and a
     list of operations to perform agains them.
     """
-    include_insert = include == 'combined' or include == 'insertions'
-    include_delete = include == 'combined' or include == 'deletions'
+    return assemble_diffs(html1_tokens, html2_tokens, commands,
+                          (include,))[include]
+
+
+def assemble_diffs(html1_tokens, html2_tokens, commands, views=DIFF_VIEWS):
+    """
+    Assemble renderable lists of HTML chunks for several views of the same
+    diff (see `DIFF_VIEWS`) in a single pass over the operations.
+
+    Each span of tokens is only expanded into HTML chunks once, and the chunks
+    are then routed to every view they belong in: unchanged chunks from the
+    old document go to the `combined` and `deletions` views, unchanged chunks
+    from the new document go to the `combined` and `insertions` views, and
+    changed chunks go to `combined` plus whichever of `insertions` or
+    `deletions` matches the type of change.
+
+    Returns a dict mapping each view name to a list of chunks.
+    """
+    combined = [] if 'combined' in views else None
+    insertions = [] if 'insertions' in views else None
+    deletions = [] if 'deletions' in views else None
+    include_old = combined is not None or deletions is not None
+    include_new = combined is not None or insertions is not None
 
     # Generating a combined diff view is a relatively complicated affair. We
     # keep track of all the consecutive insertions and deletions in buffers
     # until we find a portion of the document that is unchanged, at which point
     # we reconcile the DOM structures of the changes before inserting the
     # unchanged parts.
-    result = []
     insert_buffer = []
     delete_buffer = []
 
     for command, i1, i2, j1, j2 in commands:
         if command == 'equal':
-            # When encountering an unchanged series of tokens, we first expand
-            # them to include the HTML elements that are attached to the
-            # tokenized text. Then we find the changed HTML tags before and
-            # after the unchanged text and add them to the previous buffer of
-            # changes and the next buffer of changes, respectively. This
-            # ensures that the reconciliation routine that handles differences
-            # in DOM structure is used on them, while portions that are exactly
-            # the same are simply inserted as-is.
-            #
-            # TODO: this splitting approach could probably be handled better if
-            # it was part of or better integrated with expanding the tokens, so
-            # we could just look at the first token's `pre_tags` and the last
-            # token's `post_tags` instead of having to reverse engineer them.
-            equal_buffer_delete = []
-            equal_buffer_insert = []
-            equal_buffer_delete_next = []
-            equal_buffer_insert_next = []
-            if include_insert and include_delete:
-                merge_change_groups(
-                    expand_tokens(html1_tokens[i1:i2], equal=True),
-                    equal_buffer_delete,
-                    tag_type=None)
-                merge_change_groups(
-                    expand_tokens(html2_tokens[j1:j2], equal=True),
-                    equal_buffer_insert,
-                    tag_type=None)
-
-                first_delete_group = -1
-                first_insert_group = -1
-                for token_index, token in enumerate(equal_buffer_delete):
-                    if isinstance(token, list):
-                        first_delete_group = token_index
-                        break
-                for token_index, token in enumerate(equal_buffer_insert):
-                    if isinstance(token, list):
-                        first_insert_group = token_index
-                        break
-                # In theory we should always find both, but sanity check anyway
-                if first_delete_group > -1 and first_insert_group > -1:
-                    max_index = min(first_delete_group, first_insert_group)
-                    unequal_reverse_index = max_index
-                    for reverse_index in range(max_index):
-                        delete_token = equal_buffer_delete[first_delete_group - 1 - reverse_index]
-                        insert_token = equal_buffer_insert[first_insert_group - 1 - reverse_index]
-                        if delete_token != insert_token:
-                            unequal_reverse_index = reverse_index
-                            break
-                    delete_buffer.extend(equal_buffer_delete[:first_delete_group - unequal_reverse_index])
-                    equal_buffer_delete = equal_buffer_delete[first_delete_group - unequal_reverse_index:]
-                    insert_buffer.extend(equal_buffer_insert[:first_insert_group - unequal_reverse_index])
-                    equal_buffer_insert = equal_buffer_insert[first_insert_group - unequal_reverse_index:]
-
-                last_delete_group = -1
-                last_insert_group = -1
-                # FIXME: totally inefficient; should go backward
-                for token_index, token in enumerate(equal_buffer_delete):
-                    if isinstance(token, list):
-                        last_delete_group = token_index
-                for token_index, token in enumerate(equal_buffer_insert):
-                    if isinstance(token, list):
-                        last_insert_group = token_index
-
-                # In theory we should always find both, but sanity check anyway
-                if last_delete_group > -1 and last_insert_group > -1:
-                    max_range = min(len(equal_buffer_delete) - last_delete_group, len(equal_buffer_insert) - last_insert_group)
-                    unequal_index = max(1, max_range)
-                    for index in range(1, max_range):
-                        delete_token = equal_buffer_delete[last_delete_group + index]
-                        insert_token = equal_buffer_insert[last_insert_group + index]
-                        if delete_token != insert_token:
-                            unequal_index = index
-                            break
-                    equal_buffer_delete_next = equal_buffer_delete[last_delete_group + unequal_index:]
-                    equal_buffer_delete = equal_buffer_delete[:last_delete_group + unequal_index]
-                    equal_buffer_insert_next = equal_buffer_insert[last_insert_group + unequal_index:]
-                    equal_buffer_insert = equal_buffer_insert[:last_insert_group + unequal_index]
-
-            if insert_buffer or delete_buffer:
-                reconcile_change_groups(insert_buffer, delete_buffer, result)
-
-            if include_insert and include_delete:
-                result.extend(flatten_groups(equal_buffer_insert))
-                delete_buffer.extend(equal_buffer_delete_next)
-                insert_buffer.extend(equal_buffer_insert_next)
-            elif include_insert:
-                result.extend(expand_tokens(html2_tokens[j1:j2], equal=True))
-            else:
-                result.extend(expand_tokens(html1_tokens[i1:i2], equal=True))
+            if include_old:
+                old_chunks = list(expand_tokens(html1_tokens[i1:i2],
+                                                equal=True))
+            if include_new:
+                new_chunks = list(expand_tokens(html2_tokens[j1:j2],
+                                                equal=True))
+            if combined is not None:
+                _assemble_combined_equal(old_chunks, new_chunks,
+                                         insert_buffer, delete_buffer,
+                                         combined)
+            if insertions is not None:
+                insertions.extend(new_chunks)
+            if deletions is not None:
+                deletions.extend(old_chunks)
             continue
-        if (command == 'insert' or command == 'replace') and include_insert:
-            ins_tokens = expand_tokens(html2_tokens[j1:j2])
-            if include_delete:
-                merge_change_groups(ins_tokens, insert_buffer, 'ins')
-            else:
-                merge_changes(ins_tokens, result, 'ins')
-        if (command == 'delete' or command == 'replace') and include_delete:
-            del_tokens = expand_tokens(html1_tokens[i1:i2])
-            if include_insert:
-                merge_change_groups(del_tokens, delete_buffer, 'del')
-            else:
-                merge_changes(del_tokens, result, 'del')
+        if (command == 'insert' or command == 'replace') and include_new:
+            ins_chunks = list(expand_tokens(html2_tokens[j1:j2]))
+            if combined is not None:
+                merge_change_groups(ins_chunks, insert_buffer, 'ins')
+            if insertions is not None:
+                merge_changes(ins_chunks, insertions, 'ins')
+        if (command == 'delete' or command == 'replace') and include_old:
+            del_chunks = list(expand_tokens(html1_tokens[i1:i2]))
+            if combined is not None:
+                merge_change_groups(del_chunks, delete_buffer, 'del')
+            if deletions is not None:
+                merge_changes(del_chunks, deletions, 'del')
+
+    if combined is not None:
+        reconcile_change_groups(insert_buffer, delete_buffer, combined)
 
-    reconcile_change_groups(insert_buffer, delete_buffer, result)
-    return result
+    results = {}
+    for view, chunks in (('combined', combined),
+                         ('insertions', insertions),
+                         ('deletions', deletions)):
+        if chunks is not None:
+            results[view] = chunks
+    return results
+
+
+def _assemble_combined_equal(old_chunks, new_chunks, insert_buffer,
+                             delete_buffer, result):
+    """
+    Add a span of unchanged chunks to a combined diff, first reconciling and
+    flushing any pending changes in `insert_buffer` and `delete_buffer`.
+    """
+    # When encountering an unchanged series of tokens, we first expand
+    # them to include the HTML elements that are attached to the
+    # tokenized text. Then we find the changed HTML tags before and
+    # after the unchanged text and add them to the previous buffer of
+    # changes and the next buffer of changes, respectively. This
+    # ensures that the reconciliation routine that handles differences
+    # in DOM structure is used on them, while portions that are exactly
+    # the same are simply inserted as-is.
+    #
+    # TODO: this splitting approach could probably be handled better if
+    # it was part of or better integrated with expanding the tokens, so
+    # we could just look at the first token's `pre_tags` and the last
+    # token's `post_tags` instead of having to reverse engineer them.
+    equal_buffer_delete = []
+    equal_buffer_insert = []
+    merge_change_groups(old_chunks, equal_buffer_delete, tag_type=None)
+    merge_change_groups(new_chunks, equal_buffer_insert, tag_type=None)
+
+    first_delete_group = -1
+    first_insert_group = -1
+    for token_index, token in enumerate(equal_buffer_delete):
+        if isinstance(token, list):
+            first_delete_group = token_index
+            break
+    for token_index, token in enumerate(equal_buffer_insert):
+        if isinstance(token, list):
+            first_insert_group = token_index
+            break
+    # In theory we should always find both, but sanity check anyway
+    if first_delete_group > -1 and first_insert_group > -1:
+        max_index = min(first_delete_group, first_insert_group)
+        unequal_reverse_index = max_index
+        for reverse_index in range(max_index):
+            delete_token = equal_buffer_delete[first_delete_group - 1 - reverse_index]
+            insert_token = equal_buffer_insert[first_insert_group - 1 - reverse_index]
+            if delete_token != insert_token:
+                unequal_reverse_index = reverse_index
+                break
+        delete_buffer.extend(equal_buffer_delete[:first_delete_group - unequal_reverse_index])
+        equal_buffer_delete = equal_buffer_delete[first_delete_group - unequal_reverse_index:]
+        insert_buffer.extend(equal_buffer_insert[:first_insert_group - unequal_reverse_index])
+        equal_buffer_insert = equal_buffer_insert[first_insert_group - unequal_reverse_index:]
+
+    equal_buffer_delete_next = []
+    equal_buffer_insert_next = []
+    last_delete_group = _last_group_index(equal_buffer_delete)
+    last_insert_group = _last_group_index(equal_buffer_insert)
+
+    # In theory we should always find both, but sanity check anyway
+    if last_delete_group > -1 and last_insert_group > -1:
+        max_range = min(len(equal_buffer_delete) - last_delete_group, len(equal_buffer_insert) - last_insert_group)
+        unequal_index = max(1, max_range)
+        for index in range(1, max_range):
+            delete_token = equal_buffer_delete[last_delete_group + index]
+            insert_token = equal_buffer_insert[last_insert_group + index]
+            if delete_token != insert_token:
+                unequal_index = index
+                break
+        equal_buffer_delete_next = equal_buffer_delete[last_delete_group + unequal_index:]
+        equal_buffer_delete = equal_buffer_delete[:last_delete_group + unequal_index]
+        equal_buffer_insert_next = equal_buffer_insert[last_insert_group + unequal_index:]
+        equal_buffer_insert = equal_buffer_insert[:last_insert_group + unequal_index]
+
+    if insert_buffer or delete_buffer:
+        reconcile_change_groups(insert_buffer, delete_buffer, result)
+
+    result.extend(flatten_groups(equal_buffer_insert))
+    delete_buffer.extend(equal_buffer_delete_next)
+    insert_buffer.extend(equal_buffer_insert_next)
+
+
+def _last_group_index(groups):
+    "Find the index of the last group in a list from `merge_change_groups()`."
+    for index in range(len(groups) - 1, -1, -1):
+        if isinstance(groups[index], list):
+            return index
+    return -1
 
 
-# TODO: merge and reconcile this with `merge_changes()`, which is 90% the same
-# thing; it just outputs a flat instead of nested list.
 def merge_change_groups(change_chunks, doc, tag_type=None):
     """
     Group tokens from a flat list of tokens into continuous mark-up-able
@@ -1342,6 +2554,18 @@ def merge_change_groups(change_chunks, doc, tag_type=None):
     tag_type : str
         The type of HTML tag to wrap the changes with.
     """
+    # NOTE: this serves a similar purpose to LXML's html.diff.merge_insert
+    # function, though this is much more complicated. LXML's version takes a
+    # simpler approach to placing tags, then later runs the whole thing through
+    # an XML parser, manipulates the tree, and re-serializes. We don't do that
+    # here because it turns out to exacerbate some errors in the placement of
+    # insert and delete tags. Think of it like splinting a broken bone without
+    # setting it first.
+    #
+    # Here, we actually attempt to keep track of the stack of elements and
+    # proactively put tags in the right place and break them up so the
+    # resulting token stream represents valid markup. Happily, that also means
+    # we don't also have to do the expensive parse-then-serialize step later!
     depth = 0
     current_content = None
     group = doc
@@ -1354,19 +2578,20 @@ def merge_change_groups(change_chunks, doc, tag_type=None):
 
         # FIXME: explicitly handle elements that can't have our markers as
         # direct children.
-        if chunk[0] == '<':
-            # NOTE: split first by `>` because we could have undiffable items
-            # with content here, i.e. more than one tag.
-            name = chunk.split('>', 1)[0].split(None, 1)[0].strip('<>/')
-            # Also treat `a` tags as block in this context, because they *can*
-            # contain block elements, like `h1`, etc.
-            is_block = name in block_level_tags or name == 'a'
-
-            if chunk[1] == '/':
+        # NOTE: chunks for undiffable items and images also start with `<`,
+        # but they are whole elements (not `Tag` objects), so they are treated
+        # like any other content here.
+        if isinstance(chunk, Tag):
+            name = chunk.name
+            # This includes `a` tags, because they *can* contain block
+            # elements, like `h1`, etc.
+            is_block = chunk.flags & BLOCK_TAG
+
+            if not chunk.open:
                 if depth > 0:
                     if is_block:
                         for nested_tag in current_content:
-                            group.append(f'</{nested_tag}>')
+                            group.append(Tag.end(nested_tag))
                         if tag_type:
                             group.append(f'</{tag_type}>')
                         current_content = None
@@ -1382,7 +2607,7 @@ def merge_change_groups(change_chunks, doc, tag_type=None):
                             # only a malformed document should hit this case
                             # where tags aren't properly nested ¯\_(ツ)_/¯
                             for nested_tag in current_content:
-                                group.append(f'</{nested_tag}>')
+                                group.append(Tag.end(nested_tag))
 
                             if tag_type:
                                 group.append(f'</{tag_type}>')
@@ -1400,7 +2625,7 @@ def merge_change_groups(change_chunks, doc, tag_type=None):
                             # other side of the malformed document case from above
                             current_content.reverse()
                             for nested_tag in current_content:
-                                group.append(f'<{nested_tag}>')
+                                group.append(Tag.start(nested_tag))
                             current_content.reverse()
                 else:
                     group.append(chunk)
@@ -1410,7 +2635,7 @@ def merge_change_groups(change_chunks, doc, tag_type=None):
                 if is_block:
                     if depth > 0:
                         for nested_tag in current_content:
-                            group.append(f'</{nested_tag}>')
+                            group.append(Tag.end(nested_tag))
                         if tag_type:
                             group.append(f'</{tag_type}>')
                         current_content = None
@@ -1434,16 +2659,14 @@ def merge_change_groups(change_chunks, doc, tag_type=None):
         # Note the undiffable_content_tags check here. We assume tokens for
         # those tags represent a whole element, not just a start or end tag,
         # so we don't consider them "open" as part of `current_content`.
-        if (inline_tag and
-                (inline_tag_name not in undiffable_content_tags) and
-                (inline_tag_name not in empty_tags)):
+        if inline_tag and not chunk.flags & (UNDIFFABLE_TAG | VOID_TAG):
             # FIXME: track the original start tag for when we need to break
             # these elements around boundaries.
             current_content.insert(0, inline_tag_name)
 
     if depth > 0:
         for nested_tag in current_content:
-            group.append(f'</{nested_tag}>')
+            group.append(Tag.end(nested_tag))
 
         if tag_type:
             group.append(f'</{tag_type}>')
@@ -1451,21 +2674,8 @@ def merge_change_groups(change_chunks, doc, tag_type=None):
 
         current_content.reverse()
         for nested_tag in current_content:
-            group.append(f'<{nested_tag}>')
-
-
-TagInfo = namedtuple('TagInfo', ('name', 'open', 'source'))
+            group.append(Tag.start(nested_tag))
 
-@lru_cache(maxsize=1024)
-def tag_info(tag_text):
-    """
-    Read text like `<span>` and return a `TagInfo` named tuple or None if not
-    a tag.
-    """
-    if not tag_text.startswith('<'):
-        return None
-    name = tag_text.split()[0].strip('<>/')
-    return TagInfo(name, not tag_text.startswith('</'), tag_text)
 
 # TODO: rewrite this in a way that doesn't mutate the input?
 def reconcile_change_groups(insert_groups, delete_groups, document):
@@ -1488,8 +2698,8 @@ def reconcile_change_groups(insert_groups, delete_groups, document):
     thrown out (if they do not contain meaningful changes).
     """
     logger.debug('------------------ RECONCILING ----------------------')
-    logger.debug(f'  INSERT:\n  {insert_groups}\n')
-    logger.debug(f'  DELETE:\n  {delete_groups}\n')
+    logger.debug('  INSERT:\n  %s\n', insert_groups)
+    logger.debug('  DELETE:\n  %s\n', delete_groups)
     start_index = len(document)
     insert_index = 0
     delete_index = 0
@@ -1501,6 +2711,9 @@ def reconcile_change_groups(insert_groups, delete_groups, document):
     delete_tag_unstack = []
     insert_buffer = []
     delete_buffer = []
+    # Whether `delete_buffer` has any actual deletions (not just structure).
+    # Tracked as we go so we never have to search the buffer for them.
+    delete_buffer_has_changes = False
     buffer = document
 
     while True:
@@ -1521,13 +2734,15 @@ def reconcile_change_groups(insert_groups, delete_groups, document):
             delete_index += 1
         elif isinstance(deletion, list):
             buffer.extend(deletion)
+            if buffer is delete_buffer and '<del class="wm-diff">' in deletion:
+                delete_buffer_has_changes = True
             delete_index += 1
         elif isinstance(insertion, list):
             buffer.extend(insertion)
             insert_index += 1
         elif deletion:
-            tag = tag_info(deletion)
-            if tag:
+            if isinstance(deletion, Tag):
+                tag = deletion
                 if tag.open:
                     if delete_tag_unstack:
                         delete_buffer.append(deletion)
@@ -1537,9 +2752,10 @@ def reconcile_change_groups(insert_groups, delete_groups, document):
                             delete_tag_unstack.append(active_tag)
                             delete_tag_unstack.append(tag)
                         if not delete_tag_unstack:
-                            logger.debug(f'INSERTING DELETE UNSTACK BUFFER: {delete_buffer}')
+                            logger.debug('INSERTING DELETE UNSTACK BUFFER: %s', delete_buffer)
                             document.extend(delete_buffer)
                             delete_buffer.clear()
+                            delete_buffer_has_changes = False
                             buffer = document
                     else:
                         buffer = delete_buffer
@@ -1557,9 +2773,10 @@ def reconcile_change_groups(insert_groups, delete_groups, document):
                         delete_buffer.append(deletion)
                         delete_index += 1
                         if not delete_tag_stack:
-                            logger.debug(f'INSERTING DELETE BUFFER: {delete_buffer}')
+                            logger.debug('INSERTING DELETE BUFFER: %s', delete_buffer)
                             document.extend(delete_buffer)
                             delete_buffer.clear()
+                            delete_buffer_has_changes = False
                             buffer = document
                     else:
                         # Speculatively go the opposite direction
@@ -1591,16 +2808,16 @@ def reconcile_change_groups(insert_groups, delete_groups, document):
         elif insertion:
             # if we have a hanging delete buffer (with content, not just HTML
             # DOM structure), clean it up and insert it before moving on.
-            # FIXME: this should not look explicitly for `<del>`
-            if '<del class="wm-diff">' in delete_buffer:
+            if delete_buffer_has_changes:
                 for tag in delete_tag_stack:
-                    delete_buffer.append(f'</{tag[0]}>')
+                    delete_buffer.append(Tag.end(tag.name))
                 document.extend(delete_buffer)
                 delete_tag_stack.clear()
                 delete_buffer.clear()
+                delete_buffer_has_changes = False
 
-            tag = tag_info(insertion)
-            if tag:
+            if isinstance(insertion, Tag):
+                tag = insertion
                 if tag.open:
                     buffer = insert_buffer
                     insert_tag_stack.append(tag)
@@ -1636,10 +2853,9 @@ def reconcile_change_groups(insert_groups, delete_groups, document):
 
     # Add any hanging buffer of deletes that never got completed, but only if
     # it has salient changes in it.
-    # FIXME: this should not look explicitly for `<del>`
-    if '<del class="wm-diff">' in delete_buffer:
+    if delete_buffer_has_changes:
         for tag in delete_tag_stack:
-            delete_buffer.append(f'</{tag[0]}>')
+            delete_buffer.append(Tag.end(tag.name))
         document.extend(delete_buffer)
 
     document.extend(insert_buffer)
@@ -1647,8 +2863,8 @@ def reconcile_change_groups(insert_groups, delete_groups, document):
     insert_groups.clear()
     delete_groups.clear()
 
-    result = document[start_index:]
-    logger.debug(f'  RESULT:\n  {result}\n')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('  RESULT:\n  %s\n', document[start_index:])
 
     return document
 
@@ -1681,6 +2897,26 @@ class InsensitiveSequenceMatcher(difflib.SequenceMatcher):
                 or not item[2]]
 
 
+class BlockSequenceMatcher(InsensitiveSequenceMatcher):
+    """
+    Acts like InsensitiveSequenceMatcher, but for sequences that are known to
+    be corresponding blocks of a document. Small equal blocks are still kept
+    if they are anchored to the start or end of both blocks, since they line
+    up structurally (e.g. the same link text in two versions of a list item).
+    """
+
+    def get_matching_blocks(self):
+        size = min(len(self.a), len(self.b))
+        threshold = min(self.threshold, size / 4)
+        actual = difflib.SequenceMatcher.get_matching_blocks(self)
+        return [item for item in actual
+                if item[2] > threshold
+                or not item[2]
+                or (item[0] == 0 and item[1] == 0)
+                or (item[0] + item[2] == len(self.a)
+                    and item[1] + item[2] == len(self.b))]
+
+
 UPDATE_CONTRAST_SCRIPT = """
     (function () {
         // Update the text color of change elements to ensure a readable level
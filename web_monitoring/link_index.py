@@ -0,0 +1,235 @@
+# An index of the outgoing links on each version of a page, for answering
+# questions about a page's links across its whole history (like "when did this
+# link disappear?") without diffing every pair of versions.
+from datetime import datetime, timezone
+import sqlite3
+from .links_diff import Link, canonicalize_href, extract_links
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    page TEXT NOT NULL,
+    version_id TEXT NOT NULL,
+    capture_time REAL NOT NULL,
+    UNIQUE (page, version_id)
+);
+CREATE INDEX IF NOT EXISTS versions_by_time ON versions (page, capture_time);
+
+-- Each unique link (see `Link.match_key`) is only stored once.
+CREATE TABLE IF NOT EXISTS links (
+    id INTEGER PRIMARY KEY,
+    href TEXT NOT NULL,
+    text_key TEXT NOT NULL,
+    text TEXT NOT NULL,
+    UNIQUE (href, text_key)
+);
+
+CREATE TABLE IF NOT EXISTS version_links (
+    version INTEGER NOT NULL REFERENCES versions (id),
+    link INTEGER NOT NULL REFERENCES links (id),
+    PRIMARY KEY (version, link)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS version_links_by_link ON version_links (link, version);
+'''
+
+
+class LinkIndex:
+    """
+    An index of the outgoing links (see `links_diff.extract_links()`) on each
+    version of one or more pages, stored in a SQLite database.
+
+    Versions can be added at any time (and in any order) as they are imported.
+    Each one's links are only extracted once, when it's added.
+
+    Parameters
+    ----------
+    path : string, optional
+        Path to the SQLite database file. It is created if it doesn't exist.
+        By default, the index is only kept in memory.
+
+    Examples
+    --------
+    Find when a link was removed from a page:
+
+    >>> with LinkIndex('links.sqlite3') as index:
+    ...     for version in versions:
+    ...         index.add_version(page_id, version['uuid'],
+    ...                           version['capture_time'], version['text'])
+    ...     index.last_seen(page_id, 'https://example.gov/data.csv')
+    {'version_id': '...', 'capture_time': datetime(...), 'removed_in': '...'}
+    """
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        "Close the underlying database connection."
+        self._connection.close()
+
+    def has_version(self, page, version_id):
+        "Check whether a version of a page has already been indexed."
+        return self._version_row(page, version_id) is not None
+
+    def add_version(self, page, version_id, capture_time, text,
+                    page_url=None):
+        """
+        Extract the links from a version of a page and add them to the index.
+        If the version was already indexed, this does nothing.
+
+        Parameters
+        ----------
+        page : string
+            ID or URL of the page
+        version_id : string
+            ID of the version (unique within the page)
+        capture_time : datetime
+            When the version was captured. Naive datetimes are assumed to be
+            in the local timezone.
+        text : string
+            The version's HTML
+        page_url : string, optional
+            The URL of the page, which relative links are resolved against
+            (see `links_diff.extract_links()`). This should not be the URL of
+            an archived copy of the page.
+
+        Returns
+        -------
+        boolean
+            Whether the version was added (i.e. it wasn't already indexed).
+        """
+        if self.has_version(page, version_id):
+            return False
+
+        links = extract_links(text, page_url)['links']
+        with self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO versions (page, version_id, capture_time) '
+                'VALUES (?, ?, ?)',
+                (page, version_id, capture_time.timestamp()))
+            version = cursor.lastrowid
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO links (href, text_key, text) '
+                'VALUES (?, ?, ?)',
+                ((*link.match_key, link.text) for link in links))
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO version_links (version, link) '
+                'SELECT ?, id FROM links WHERE href = ? AND text_key = ?',
+                ((version, *link.match_key) for link in links))
+        return True
+
+    def first_seen(self, page, href, text=None):
+        """
+        Find the earliest version of a page that has a link.
+
+        Parameters
+        ----------
+        page : string
+            ID or URL of the page
+        href : string
+            The link's URL. It's canonicalized the same way as links in the
+            index (see `links_diff.canonicalize_href()`).
+        text : string, optional
+            The link's text (case-insensitive). If not set, links to `href`
+            with any text are included.
+
+        Returns
+        -------
+        dict or None
+            The `version_id` and `capture_time` of the version, or `None` if
+            no indexed version of the page has the link.
+        """
+        row = self._find_version_with_link(page, href, text, 'ASC')
+        return row and self._version_info(row)
+
+    def last_seen(self, page, href, text=None):
+        """
+        Find the latest version of a page that has a link. Takes the same
+        parameters as `first_seen()`.
+
+        Returns
+        -------
+        dict or None
+            The `version_id` and `capture_time` of the version, and the
+            `removed_in` ID of the next version of the page (which no longer
+            has the link), or `None` if the link is still in the latest version.
+            Returns `None` if no indexed version of the page has the link.
+        """
+        row = self._find_version_with_link(page, href, text, 'DESC')
+        if row is None:
+            return None
+
+        info = self._version_info(row)
+        next_version = self._connection.execute(
+            'SELECT version_id FROM versions '
+            'WHERE page = ? AND (capture_time, id) > (?, ?) '
+            'ORDER BY capture_time, id LIMIT 1',
+            (page, row[2], row[0])).fetchone()
+        info['removed_in'] = next_version and next_version[0]
+        return info
+
+    def diff_versions(self, page, a_version_id, b_version_id):
+        """
+        Find the links that were added and removed between two versions of a
+        page. The versions need not be consecutive.
+
+        Returns
+        -------
+        dict
+            `added` and `removed` lists of links (as dicts with `href` and
+            `text`, like `links_diff_json()`), sorted like in a links diff.
+        """
+        a_row = self._version_row(page, a_version_id)
+        b_row = self._version_row(page, b_version_id)
+        for version_id, row in ((a_version_id, a_row), (b_version_id, b_row)):
+            if row is None:
+                raise KeyError(f'Version "{version_id}" of "{page}" is not '
+                               f'in the index')
+
+        return {'added': self._links_only_in(b_row[0], a_row[0]),
+                'removed': self._links_only_in(a_row[0], b_row[0])}
+
+    def _version_row(self, page, version_id):
+        return self._connection.execute(
+            'SELECT id FROM versions WHERE page = ? AND version_id = ?',
+            (page, version_id)).fetchone()
+
+    def _find_version_with_link(self, page, href, text, order):
+        # Use CROSS JOIN to make SQLite look up the (few) matching links
+        # first, rather than scanning every version of the page.
+        query = ('SELECT versions.id, versions.version_id, '
+                 'versions.capture_time '
+                 'FROM links '
+                 'CROSS JOIN version_links ON version_links.link = links.id '
+                 'CROSS JOIN versions ON versions.id = version_links.version '
+                 'WHERE links.href = ? AND versions.page = ? ')
+        parameters = [canonicalize_href(href), page]
+        if text is not None:
+            query += 'AND links.text_key = ? '
+            parameters.append(text.strip().lower())
+        query += (f'ORDER BY versions.capture_time {order}, '
+                  f'versions.id {order} LIMIT 1')
+        return self._connection.execute(query, parameters).fetchone()
+
+    def _version_info(self, row):
+        return {'version_id': row[1],
+                'capture_time': datetime.fromtimestamp(row[2], timezone.utc)}
+
+    def _links_only_in(self, version, other_version):
+        rows = self._connection.execute(
+            'SELECT links.href, links.text FROM version_links '
+            'JOIN links ON links.id = version_links.link '
+            'WHERE version_links.version = ? AND version_links.link NOT IN '
+            '(SELECT link FROM version_links WHERE version = ?)',
+            (version, other_version))
+        links = sorted((Link(href, text) for href, text in rows),
+                       key=lambda link: link.sort_key)
+        return [link.json() for link in links]
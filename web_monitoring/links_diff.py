@@ -2,25 +2,59 @@ import html5_parser
 from .content_type import raise_if_not_diffable_html
 from .differs import compute_dmp_diff
 from web_monitoring.utils import get_color_palette
-from difflib import SequenceMatcher
-from .html_diff_render import (get_title, _html_for_dmp_operation,
-                               undiffable_content_tags)
+from collections import defaultdict, deque
+from .html_diff_render import _html_for_dmp_operation, undiffable_content_tags
+import html
+from lxml import etree
 import re
+from urllib.parse import urldefrag, urljoin, urlsplit, urlunsplit
+
+
+# Finds the `<a>` elements in a document that point to other pages (and not
+# just to another part of the same page).
+OUTGOING_LINKS = etree.XPath('//a[@href != "" and not(starts-with(@href, "#"))]')
+
+# Query parameters that only track how visitors got to a page and don't
+# change what a link points to. They're removed from links' URLs.
+TRACKING_PARAMETERS = re.compile(
+    r'^(utm_\w+|fbclid|gclid|dclid|msclkid|mc_cid|mc_eid|_ga|_hsenc|_hsmi)$',
+    re.IGNORECASE)
+
+# Ports that are the same as not specifying one for a URL scheme.
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21}
 
 
 def links_diff(a_text, b_text, a_headers=None, b_headers=None,
-               content_type_options='normal'):
+               content_type_options='normal', a_page_url=None,
+               b_page_url=None, counts_only=False):
     """
     Extracts all the outgoing links from a page and produces a diff of an
     HTML document that is simply a list of the text and URL of those links.
 
     It ignores links that merely navigate within the page.
 
-    NOTE: this diff currently suffers from the fact that our diff server does
-    not know the original URL of the content, so it can identify:
-        <a href="#anchor-in-this-page">Text</a>
-    as an internal link, but not:
+    Along with the diff, the result has the titles of both pages as `a_title`
+    and `b_title`. (The parsed documents are only kept while extracting their
+    links; see `extract_links()`.)
+
+    Links are resolved against the page's `<base>` element or, if the URLs of
+    the pages are given as `a_page_url` and `b_page_url`, against them, and
+    put in a canonical form (see `canonicalize_href()`), so the same link
+    written in different ways isn't shown as a change. Knowing the URL also
+    lets this identify links like this as internal:
         <a href="http://this.domain.com/this/page#anchor-in-this-page">Text</a>
+    Without the URL, only links like `<a href="#anchor">` are recognized as
+    internal, and relative links are left relative.
+
+    The page URLs should be the URLs of the pages themselves, not where the
+    versions were fetched from (like a Wayback Machine or storage URL).
+    Otherwise, the same relative link in two snapshots of a page would be
+    resolved to different URLs.
+
+    If `counts_only` is true, the result only has the number of changed links
+    as `change_count`, and how many of those were added and removed as
+    `insertions_count` and `deletions_count` (the rest were changed). This
+    skips diffing the text and URLs of changed links and building the diff.
     """
     raise_if_not_diffable_html(
         a_text,
@@ -29,36 +63,136 @@ def links_diff(a_text, b_text, a_headers=None, b_headers=None,
         b_headers,
         content_type_options)
 
-    a_soup = html5_parser.parse(a_text, treebuilder='soup', return_root=False)
-    b_soup = html5_parser.parse(b_text, treebuilder='soup', return_root=False)
-
-    a_links = sorted(
-        set([Link.from_element(element) for element in _find_outgoing_links(a_soup)]),
-        key=lambda link: link.text.lower() + f'({link.href})')
-    b_links = sorted(
-        set([Link.from_element(element) for element in _find_outgoing_links(b_soup)]),
-        key=lambda link: link.text.lower() + f'({link.href})')
+    a_extracted = extract_links(a_text, a_page_url)
+    b_extracted = extract_links(b_text, b_page_url)
+    if counts_only:
+        _, changed, removed, added = _match_links(a_extracted['links'],
+                                                  b_extracted['links'])
+        return {
+            'change_count': len(changed) + len(removed) + len(added),
+            'insertions_count': len(added),
+            'deletions_count': len(removed)
+        }
 
-    matcher = SequenceMatcher(a=a_links, b=b_links)
-    opcodes = matcher.get_opcodes()
-    diff = list(_assemble_diff(a_links, b_links, opcodes))
+    diff = list(_diff_links(a_extracted['links'], b_extracted['links']))
 
     return {
         'change_count': _count_changes(diff),
         'diff': diff,
-        'a_parsed': a_soup,
-        'b_parsed': b_soup
+        'a_title': a_extracted['title'],
+        'b_title': b_extracted['title']
     }
 
 
+def extract_links(text, page_url=None):
+    """
+    Parse an HTML document and get everything the links diff needs from it:
+    its title and a sorted list of the unique outgoing links (see `Link`) on
+    it. The parsed document is thrown away afterward.
+
+    Parameters
+    ----------
+    text : string
+        The document's HTML
+    page_url : string, optional
+        The URL of the page (not of an archived copy of it). If set, links are
+        resolved against it (or the document's `<base>`), and links to other
+        parts of the same page are skipped.
+
+    Returns
+    -------
+    dict
+        A dict with `title` (a string) and `links` (a list of `Link`).
+    """
+    document = html5_parser.parse(text)
+    resolve = HrefResolver(_get_base_url(document, page_url))
+    own_url = page_url and urldefrag(canonicalize_href(page_url))[0]
+    links = set()
+    for element in _find_outgoing_links(document):
+        link = Link.from_element(element, resolve)
+        if own_url:
+            link_url, fragment = urldefrag(link.href)
+            if fragment and link_url == own_url:
+                continue
+        links.add(link)
+
+    links = sorted(links, key=lambda link: link.sort_key)
+    return {'title': _get_title(document), 'links': links}
+
+
+def canonicalize_href(href, base_url=None):
+    """
+    Resolve a link's href against a base URL (if there is one) and put it in
+    a canonical form, so that different ways of writing the same URL are
+    equal. The scheme and host are lower-cased, default ports (e.g. `:80` for
+    `http`) and tracking parameters (see `TRACKING_PARAMETERS`) are removed,
+    and an empty path is written as `/`. Relative hrefs are left relative if
+    there's no base URL.
+    """
+    href = href.strip()
+    if base_url:
+        href = urljoin(base_url, href)
+
+    try:
+        scheme, netloc, path, query, fragment = parts = urlsplit(href)
+        port = parts.port
+    except ValueError:
+        # Not a valid URL (e.g. it has a non-numeric port), so leave it be.
+        return href
+
+    scheme = scheme.lower()
+    if netloc:
+        userinfo, at, host = netloc.rpartition('@')
+        host = host.lower()
+        if port is not None and port == DEFAULT_PORTS.get(scheme):
+            host = host.rsplit(':', 1)[0]
+        netloc = f'{userinfo}{at}{host}'
+        if not path and scheme in DEFAULT_PORTS:
+            path = '/'
+    if query:
+        query = '&'.join(parameter for parameter in query.split('&')
+                         if not TRACKING_PARAMETERS.match(
+                             parameter.split('=', 1)[0]))
+
+    canonical = (scheme, netloc, path, query, fragment)
+    if canonical == tuple(parts):
+        # Don't risk re-formatting a URL that was already canonical.
+        return href
+    return urlunsplit(canonical)
+
+
+class HrefResolver:
+    """
+    Resolves and canonicalizes the hrefs in one document against the same
+    base URL (see `canonicalize_href()`). Pages often repeat the same hrefs
+    many times, so the results are remembered.
+    """
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url
+        self._cache = {}
+
+    def __call__(self, href):
+        try:
+            return self._cache[href]
+        except KeyError:
+            result = canonicalize_href(href, self.base_url)
+            self._cache[href] = result
+            return result
+
+
 def links_diff_json(a_text, b_text, a_headers=None, b_headers=None,
-                    content_type_options='normal'):
+                    content_type_options='normal', a_page_url=None,
+                    b_page_url=None, counts_only=False):
     """
     Generate a diff of all outgoing links (see `links_diff()`) where the `diff`
     property is formatted as a list of change codes and values.
     """
     diff = links_diff(a_text, b_text, a_headers, b_headers,
-                      content_type_options)
+                      content_type_options, a_page_url, b_page_url,
+                      counts_only)
+    if counts_only:
+        return diff
     return {
         'change_count': diff['change_count'],
         'diff': diff['diff']
@@ -66,22 +200,20 @@ def links_diff_json(a_text, b_text, a_headers=None, b_headers=None,
 
 
 def links_diff_html(a_text, b_text, a_headers=None, b_headers=None,
-                    content_type_options='normal'):
+                    content_type_options='normal', a_page_url=None,
+                    b_page_url=None, counts_only=False):
     """
     Generate a diff of all outgoing links (see `links_diff()`) where the `diff`
     property is an HTML string. Note the actual return type is still JSON.
     """
     diff = links_diff(a_text, b_text, a_headers, b_headers,
-                      content_type_options)
-    soup = _render_html_diff(diff['diff'])
+                      content_type_options, a_page_url, b_page_url,
+                      counts_only)
+    if counts_only:
+        return diff
 
-    # Add styling and metadata
     color_palette = get_color_palette()
-    change_styles = soup.new_tag(
-        'style',
-        type='text/css',
-        id='wm-diff-style')
-    change_styles.string = f"""
+    change_styles = f"""
         body {{
             font-family: "Helvetica Neue", Helvetica, Arial, sans-serif;
             margin: 0;
@@ -131,53 +263,52 @@ def links_diff_html(a_text, b_text, a_headers=None, b_headers=None,
         !important; all: unset;}}
         script {{display: none !important;}}"""
 
-    soup.head.append(change_styles)
-    soup.title.string = get_title(diff['b_parsed'])
-
     return {
         'change_count': diff['change_count'],
-        'diff': soup.prettify(formatter=None)
+        'diff': ''.join(_iter_html_diff(diff['diff'], diff['b_title'],
+                                        change_styles))
     }
 
 
 class Link:
     """
-    Represents a link that was used on the page. Designed to be fed into
-    SequenceMatcher for diffing.
-
-    Note that Link objects have a very loose sense of equality. That is:
-
-        link_a == link_b
+    Represents a link that was used on the page.
 
-    only indicates that link_a and link_b may be sorta kinda be representing
-    the same thing, but that you should still compare them in a more nuanced
-    way. To check for strict equality, use their hashes:
-
-        hash(link_a) == hash(link_b)
+    Two links are equal if they have the same href and the same text, ignoring
+    case (see `match_key`). Links that are only partially the same (e.g. they
+    have the same href but different text) are paired up in `_diff_links()`.
     """
 
     @classmethod
-    def from_element(cls, element):
+    def from_element(cls, element, resolve=None):
         """
-        Create a Link from a Beautiful Soup `<a>` element
+        Create a Link from an lxml `<a>` element. If set, `resolve` is called
+        on the element's href to get the link's URL (see `HrefResolver`).
         """
-        return cls(element['href'], _get_link_text(element))
+        href = element.get('href')
+        if resolve:
+            href = resolve(href)
+        return cls(href, _get_link_text(element))
 
     def __init__(self, href, text):
-        # TODO: add a `url` so we can differentiate the href and the actual
-        # target of the link (in the case of paths rather than URLs)
-        # This requires knowing the base origin and path for the link.
         self.href = self._clean_href(href)
         self.text = text.strip()
 
+    @property
+    def match_key(self):
+        "The href and lower-cased text, which identify a unique link."
+        return (self.href, self.text.lower())
+
+    @property
+    def sort_key(self):
+        "A string links are sorted by in a diff."
+        return self.text.lower() + f'({self.href})'
+
     def __hash__(self):
-        return hash((self.href, self.text.lower()))
+        return hash(self.match_key)
 
     def __eq__(self, other):
-        # This is actually a "rough" equality check -- trying to get a sense
-        # of whether two links are the same "thing" even if they have
-        # internal differences in their text or href.
-        return self.href == other.href or self.text.lower() == other.text.lower()
+        return self.match_key == other.match_key
 
     def json(self):
         return {'text': self.text, 'href': self.href}
@@ -189,37 +320,69 @@ class Link:
         return href
 
 
-def _find_outgoing_links(soup):
+def _find_outgoing_links(document):
     """
-    Yields each of the `<a>` elements in a Beautiful Soup document that point
-    to other pages.
+    Get a list of the `<a>` elements in an lxml document that point to other
+    pages.
     """
-    for link in soup.find_all('a'):
-        href = link.get('href')
-        if href and not href.startswith('#'):
-            yield link
+    return OUTGOING_LINKS(document)
+
+
+def _get_base_url(document, page_url=None):
+    """
+    Get the URL that relative links in an lxml document are relative to: the
+    first `<base href>`, if there is one (resolved against `page_url`), or
+    else `page_url`.
+    """
+    base = document.find('.//base[@href]')
+    if base is not None:
+        base_href = base.get('href').strip()
+        return urljoin(page_url, base_href) if page_url else base_href
+    return page_url
+
+
+def _get_title(document):
+    "Get the title of an lxml document."
+    title = document.find('.//title')
+    return title is not None and title.text or ''
 
 
 def _get_link_text(link):
     """
-    Get the "text" to diff and display for an `<a>` element.
+    Get the "text" to diff and display for an lxml `<a>` element. Images are
+    shown as their alt text, and the content of tags like `<script>` and
+    `<style>` (see `undiffable_content_tags`) is skipped. The document is not
+    modified.
     """
-    # The content of tags like <script> and <style> shows up in the `.text`
-    # attribute, so just go ahead and remove them from the DOM
-    for invisible_tag in link.find_all(undiffable_content_tags):
-        invisible_tag.extract()
-
-    for image in link.find_all('img'):
-        alt = image.get('alt')
-        if alt:
-            image.replace_with(f'[image: {alt}]')
+    parts = [link.text]
+    # Walk the link's descendants in document order with a stack of child
+    # iterators, so deeply nested markup doesn't need deep recursion.
+    stack = [(link, iter(link))]
+    while stack:
+        element, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            if stack:
+                parts.append(element.tail)
+        elif (not isinstance(child.tag, str)
+                or child.tag in undiffable_content_tags):
+            # Comments, processing instructions, and elements whose content
+            # isn't displayed as text.
+            parts.append(child.tail)
+        elif child.tag == 'img':
+            alt = child.get('alt')
+            parts.append(f'[image: {alt}]' if alt else '[image]')
+            parts.append(child.tail)
         else:
-            image.replace_with('[image]')
+            parts.append(child.text)
+            stack.append((child, iter(child)))
 
-    text = link.text.strip()
+    text = ''.join(part for part in parts if part).strip()
     if not text:
-        if link.has_attr('title'):
-            text = f'[tooltip: {link["title"]}]'
+        title = link.get('title')
+        if title is not None:
+            text = f'[tooltip: {title}]'
         else:
             text = '[no text]'
 
@@ -230,174 +393,93 @@ def _count_changes(opcodes):
     return len([operation for operation in opcodes if operation[0] != 0])
 
 
-def _assemble_diff(a, b, opcodes):
+def _diff_links(a_links, b_links):
     """
     Yield each link in the diff with a code for addition (1), removal (-1),
     unchanged (0), or nested diff (100).
 
+    Links are matched up in a few passes, each of which uses a hash table, so
+    this takes roughly linear time even on pages with many thousands of links:
+
+    1. Links with the same href and text (ignoring case) are unchanged.
+    2. Remaining links with the same href, or else the same text, are paired
+       up as changed and get a nested diff of their text and href.
+    3. Any links left over were added or removed.
+
     Parameters
     ----------
-    a : list
-        The list of links in the previous verson of a document.
-    b : list
-        The list of links in the new version of a document.
-    opcodes : list
-        List of opcodes from SequenceMatcher that defines what to do with each
-        item in the lists of links.
+    a_links : list
+        The links in the previous version of a document, sorted by `sort_key`.
+    b_links : list
+        The links in the new version of a document, sorted by `sort_key`.
+    """
+    unchanged, changed, removed, added = _match_links(a_links, b_links)
+
+    # Put everything back in sorted order (using the new version of changed
+    # links). No two entries can have the same sort key, so this is
+    # deterministic.
+    entries = [(b_link.sort_key, (0, b_link.json()))
+               for _, b_link in unchanged]
+    entries.extend((b_link.sort_key, (100, _diff_link(a_link, b_link)))
+                   for a_link, b_link in changed)
+    entries.extend((link.sort_key, (1, link.json())) for link in added)
+    entries.extend((link.sort_key, (-1, link.json())) for link in removed)
+    entries.sort(key=lambda entry: entry[0])
+    for _, item in entries:
+        yield item
+
+
+def _match_links(a_links, b_links):
+    """
+    Match up the links in two versions of a document, as described in
+    `_diff_links()`. Returns lists of unchanged and changed `(a_link, b_link)`
+    pairs, then lists of the removed and the added links.
+    """
+    unchanged, a_rest, b_rest = _pair_links(a_links, b_links,
+                                            lambda link: link.match_key)
+    # A link with the same URL but different text is more clearly "the same
+    # link" than one with the same text and a different URL, so match those
+    # first.
+    changed_href, a_rest, b_rest = _pair_links(a_rest, b_rest,
+                                               lambda link: link.href)
+    changed_text, a_rest, b_rest = _pair_links(a_rest, b_rest,
+                                               lambda link: link.text.lower())
+    return unchanged, changed_href + changed_text, a_rest, b_rest
+
+
+def _pair_links(a_links, b_links, key):
+    """
+    Pair up links in `a_links` and `b_links` that have the same value for
+    `key(link)`, in order. Returns a list of `(a_link, b_link)` pairs, then
+    lists of the links in `a_links` and in `b_links` that were not paired.
     """
-    # If we have the lists:
-    #    A                             B
-    #    --------------------------- | ------------------------------
-    # 1. "Pony time!" ponytime.com/a | "Pony time!" ponytime.com/b
-    # 2. "Pony time!" ponytime.com/b | "Donkey time." not-ponies.com/
-    #
-    # SequenceMatcher can wind up putting the first row together as equal, but
-    # then sectioning off the second row as deleted from A. That's because the
-    # links in the first row qualify as "roughly" equal, which is equal as far
-    # as SequenceMatcher is allowed to know. Unfortunately, that prevents it
-    # from correctly identifying that A2 + B1 are actually the ones that are
-    # the same and A1 is the one that should be marked as gone. We need to do a
-    # first pass to move any insertions or deletions that are exactly equal to
-    # a link in the adjacent set SequenceMatcher marked as equal into that
-    # equal set. (Note this also means our equal set handling below will have
-    # to account for A having more items than B or vice-versa, which couldn't
-    # happen before.)
-    operation_count = len(opcodes)
-    for index, operation in enumerate(opcodes):
-        command = operation[0]
-        if command == 'equal':
-            continue
-
-        last_equal = None
-        next_equal = None
-        if index > 0 and opcodes[index - 1][0] == 'equal':
-            last_equal = a[opcodes[index - 1][2] - 1]
-        if index + 1 < operation_count and opcodes[index + 1][0] == 'equal':
-            next_equal = a[opcodes[index + 1][1]]
-
-        if (command == 'insert' or command == 'replace'):
-            for link_index, link in enumerate(b[operation[3]:operation[4]]):
-                # FIXME: really we should stop looking for last_equal after
-                # finding a non-equal one... this implementatin assumes (I
-                # *think* correctly, but not with total confidence) that equal
-                # items will always be lined up on one side or the other of the
-                # added/removed content.
-                if last_equal and last_equal == link:
-                    # opcodes are tuples, so we can't just edit them.
-                    last_op = opcodes[index - 1]
-                    opcodes[index - 1] = (last_op[0], last_op[1], last_op[2], last_op[3], last_op[4] + 1)
-                    opcodes[index] = (operation[0], operation[1], operation[2], operation[3] + 1, operation[4])
-                elif next_equal and next_equal == link:
-                    # opcodes are tuples, so we can't just edit them.
-                    next_op = opcodes[index + 1]
-                    opcodes[index] = (operation[0], operation[1], operation[2], operation[3], operation[4] - 1)
-                    opcodes[index + 1] = (next_op[0], next_op[1], next_op[2], next_op[3] - 1, next_op[4])
-
-        if (command == 'delete' or command == 'replace'):
-            for link_index, link in enumerate(a[operation[1]:operation[2]]):
-                # FIXME: really we should stop looking for last_equal after
-                # finding a non-equal one... this implementatin assumes (I
-                # *think* correctly, but not with total confidence) that equal
-                # items will always be lined up on one side or the other of the
-                # added/removed content.
-                if last_equal and last_equal == link:
-                    # opcodes are tuples, so we can't just edit them.
-                    last_op = opcodes[index - 1]
-                    opcodes[index - 1] = (last_op[0], last_op[1], last_op[2] + 1, last_op[3], last_op[4])
-                    opcodes[index] = (operation[0], operation[1] + 1, operation[2], operation[3], operation[4])
-                elif next_equal and next_equal == link:
-                    # opcodes are tuples, so we can't just edit them.
-                    next_op = opcodes[index + 1]
-                    opcodes[index] = (operation[0], operation[1], operation[2] - 1, operation[3], operation[4])
-                    opcodes[index + 1] = (next_op[0], next_op[1] - 1, next_op[2], next_op[3], next_op[4])
-
-    for command, a_start, a_end, b_start, b_end in opcodes:
-        # The equality comparator for links only tells us whether links were
-        # "roughly" equal -- so two links that SequenceMatcher told us were the
-        # same may internal differences we need to display (this is by design).
-        if command == 'equal':
-            # This is a bit tricky: there might be several roughly equal links
-            # in a row, where some are exactly equal, but their order is
-            # shuffled around. We want to match up all the exactly equal ones.
-            a_remainders = []
-            a_set = a[a_start:a_end]
-            b_set = b[b_start:b_end]
-            last_index = a_end - 1 - a_start
-            for index, a_link in enumerate(a_set):
-                # Look for a B version link that was exactly equal to the
-                # current A version link.
-                for b_index, b_link in enumerate(b_set):
-                    if hash(a_link) == hash(b_link):
-                        del b_set[b_index]
-                        yield (0, b_link.json())
-                        break
-                # If we didn't find an exact match, set this A link aside.
-                else:
-                    a_remainders.append(a_link)
-
-                # If we're at the end of the list or the next link is not
-                # roughly equal, go back through the links that were set aside
-                # and generate a sub-diff for each of them.
-                if index == last_index or a_link != a_set[index + 1]:
-                    for a_link in a_remainders:
-                        # b_set may contain more items at the end that are not
-                        # roughly equal (see how we disbalanced this group in
-                        # the first pass over the opcodes above), so we need
-                        # to check that the items match before diffing inside.
-                        if b_set and b_set[0] == a_link:
-                            b_link = b_set[0]
-                            del b_set[0]
-                            text_diff = compute_dmp_diff(a_link.text, b_link.text)
-                            href_diff = compute_dmp_diff(a_link.href, b_link.href)
-                            yield (100, {
-                                'text': text_diff,
-                                'href': href_diff,
-                                'hrefs': (a_link.href, b_link.href)
-                            })
-                        else:
-                            yield (-1, a_link.json())
-
-                    while b_set and b_set[0] == a_link:
-                        yield (1, b_set[0].json())
-                        del b_set[0]
-
-                    a_remainders.clear()
-
-            # Handle any left over additions
-            for b_link in b_set:
-                yield (1, b_link.json())
-
-        if (command == 'insert' or command == 'replace'):
-            for link in b[b_start:b_end]:
-                yield (1, link.json())
-
-        if (command == 'delete' or command == 'replace'):
-            for link in a[a_start:a_end]:
-                yield (-1, link.json())
+    a_by_key = defaultdict(deque)
+    for link in a_links:
+        a_by_key[key(link)].append(link)
+
+    pairs = []
+    b_unpaired = []
+    for link in b_links:
+        candidates = a_by_key.get(key(link))
+        if candidates:
+            pairs.append((candidates.popleft(), link))
+        else:
+            b_unpaired.append(link)
 
+    paired = set(id(a_link) for a_link, _ in pairs)
+    a_unpaired = [link for link in a_links if id(link) not in paired]
+    return pairs, a_unpaired, b_unpaired
 
-# HTML DIFF RENDERING -----------------------------------------------------
 
-def _create_empty_soup(title=''):
-    """
-    Creates a Beautiful Soup document representing an empty HTML page.
+def _diff_link(a_link, b_link):
+    return {
+        'text': compute_dmp_diff(a_link.text, b_link.text),
+        'href': compute_dmp_diff(a_link.href, b_link.href),
+        'hrefs': (a_link.href, b_link.href)
+    }
 
-    Parameters
-    ----------
-    title : string
-        The new document's title.
-    """
-    return html5_parser.parse(f"""<!doctype html>
-        <html>
-            <head>
-                <meta charset="utf-8">
-                <title>{title}</title>
-            </head>
-            <body>
-            </body>
-        </html>
-        """, treebuilder='soup', return_root=False)
 
+# HTML DIFF RENDERING -----------------------------------------------------
 
 def not_deleted(diff_item):
     return diff_item[0] >= 0
@@ -411,30 +493,6 @@ def _html_for_text_diff(diff):
     return ''.join(map(_html_for_dmp_operation, diff))
 
 
-def _tag(soup, name, attributes=None, *children):
-    """
-    Build tags in a quicker, more composable way. Also lets you use 'class'
-    attributes without a lot of extra rigamarole.
-    """
-    tag = soup.new_tag(name)
-    if attributes:
-        for key, value in attributes.items():
-            # Remove boolean attributes that are False
-            if value is not None and value is not False:
-                tag[key] = value
-
-    for child in children:
-        tag.append(child)
-
-    return tag
-
-
-def _tagger(soup):
-    def tagger(*args, **kwargs):
-        return _tag(soup, *args, **kwargs)
-    return tagger
-
-
 CHANGE_INFO = {
     -1:  {'symbol': '-', 'title': 'Deleted'},
     0:   {'symbol': '⚬', 'title': None},
@@ -442,79 +500,90 @@ CHANGE_INFO = {
     100: {'symbol': '±', 'title': 'Changed'},
 }
 
+HTML_DIFF_START = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style type="text/css" id="wm-diff-style">{styles}</style>
+</head>
+<body>
+<table class="links-list">
+<col class="links-list--change-type-col">
+<col class="links-list--text-col">
+<col class="links-list--href-col">
+<thead>
+<tr><th></th><th>Link Text</th><th>URL</th></tr>
+</thead>
+<tbody>
+"""
+
+HTML_DIFF_END = """</tbody>
+</table>
+</body>
+</html>
+"""
+
+
+def _iter_html_diff(raw_diff, title='', styles=''):
+    """
+    Render a diff as an HTML document with a table of the links, yielding
+    the HTML in pieces (roughly one per link).
+
+    Parameters
+    ----------
+    raw_diff : sequence
+        The basic diff as a sequence of opcodes and links.
+    title : string
+        The document's title.
+    styles : string
+        CSS to include in the document.
+    """
+    yield HTML_DIFF_START.format(title=html.escape(title), styles=styles)
+    for code, link in raw_diff:
+        yield _table_row_for_link(code, link)
+    yield HTML_DIFF_END
+
 
-def _table_row_for_link(soup, change_type, link):
-    tag = _tagger(soup)
-    row = tag('tr', {
-        'class': 'links-list--item',
+def _table_row_for_link(change_type, link):
+    row_attributes = {
+        'wm-deleted': change_type == -1,
+        'wm-has-deletions': change_type < 0 or change_type == 100,
         'wm-has-insertions': change_type > 0,
         'wm-inserted': change_type == 1,
-        'wm-has-deletions': change_type < 0 or change_type == 100,
-        'wm-deleted': change_type == -1,
-    })
+    }
+    flags = ''.join(f' {name}="True"'
+                    for name, value in row_attributes.items() if value)
 
     change = CHANGE_INFO[change_type] or CHANGE_INFO[0]
-    row.append(tag('td', {
-        'class': 'links-list--change-type',
-        'title': change['title'],
-    }, change['symbol']))
+    change_title = ''
+    if change['title']:
+        change_title = f' title="{html.escape(change["title"])}"'
 
-    text_cell = tag('td', {'class': 'links-list--text'})
-    row.append(text_cell)
     if change_type == 100:
-        text_insertions = filter(not_deleted, link['text'])
-        text_cell.append(_html_for_text_diff(text_insertions))
+        text = _html_for_text_diff(filter(not_deleted, link['text']))
         if len(link['text']) != 1:
-            text_cell.append(tag('br'))
             text_deletions = filter(not_inserted, link['text'])
-            text_cell.append(_html_for_text_diff(text_deletions))
-    else:
-        text_cell.append(link['text'])
+            text += f'<br>{_html_for_text_diff(text_deletions)}'
 
-    href_cell = tag('td', {'class': 'links-list--href'})
-    row.append(href_cell)
-    if change_type == 100:
+        old_url, new_url = link['hrefs']
         href_insertions = filter(not_deleted, link['href'])
-        url_text = _html_for_text_diff(href_insertions)
-        url = link['hrefs'][1]
-        href_cell.append(tag('a', {'href': url}, f'({url_text})'))
-
-        if link['hrefs'][0] != link['hrefs'][1]:
-            href_cell.append(tag('br'))
+        href = _link_html(new_url, _html_for_text_diff(href_insertions))
+        if old_url != new_url:
             href_deletions = filter(not_inserted, link['href'])
-            url_text = _html_for_text_diff(href_deletions)
-            url = link['hrefs'][0]
-            href_cell.append(tag('a', {'href': url}, f'({url_text})'))
+            old_href = _link_html(old_url, _html_for_text_diff(href_deletions))
+            href += f'<br>{old_href}'
     else:
-        url = link['href']
-        href_cell.append(tag('a', {'href': url}, f'({url})'))
+        text = html.escape(link['text'])
+        href = _link_html(link['href'], html.escape(link['href']))
 
-    return row
+    return (f'<tr class="links-list--item"{flags}>'
+            f'<td class="links-list--change-type"{change_title}>'
+            f'{change["symbol"]}</td>'
+            f'<td class="links-list--text">{text}</td>'
+            f'<td class="links-list--href">{href}</td>'
+            '</tr>\n')
 
 
-def _render_html_diff(raw_diff):
-    """
-    Create a Beautiful Soup document representing a diff.
-
-    Parameters
-    ----------
-    raw_diff : sequence
-        The basic diff as a sequence of opcodes and links.
-    """
-    result = _create_empty_soup()
-    tag = _tagger(result)
-    result.body.append(
-        tag('table', {'class': 'links-list'},
-            tag('col', {'class': 'links-list--change-type-col'}),
-            tag('col', {'class': 'links-list--text-col'}),
-            tag('col', {'class': 'links-list--href-col'}),
-            tag('thead', {},
-                tag('tr', {},
-                    tag('th'),
-                    tag('th', {}, 'Link Text'),
-                    tag('th', {}, 'URL'))),
-            tag('tbody', {}, *(
-                _table_row_for_link(result, code, link)
-                for code, link in raw_diff))))
-
-    return result
+def _link_html(url, url_html):
+    return f'<a href="{html.escape(url)}">({url_html})</a>'
@@ -1,5 +1,6 @@
 import pytest
 import web_monitoring.differs as wd
+from web_monitoring.utils import LRUCache
 
 
 def test_side_by_side_text():
@@ -69,3 +70,86 @@ def test_get_visible_text():
     html = '<!--First comment--><h1>First Heading</h1><p>First paragraph.</p>'
     actual = wd._get_visible_text(html)
     assert actual == 'First Heading First paragraph.'
+
+
+def test_get_visible_text_skips_invisible_tags_and_comments():
+    html = ('<head><title>Title</title><style>p {}</style></head>'
+            '<body>Before<script>var x;</script> after '
+            '<div>One<!-- comment --> two<p>three</p>four</div>five</body>')
+    actual = wd._get_visible_text(html)
+    assert actual == 'Before  after  One  two three four five'
+
+
+def test_extract_visible_text_is_cached(tmp_path, monkeypatch):
+    monkeypatch.setenv('DIFFER_TOKEN_CACHE_PATH', str(tmp_path))
+    monkeypatch.setattr(wd, '_text_cache', LRUCache(2))
+    html = '<title>Cached</title><p>Some cached text.</p>'
+    assert wd.extract_visible_text(html) == 'Some cached text.'
+    assert len(list(tmp_path.glob('text/*/*/*'))) == 1
+
+    # Once the text is cached, the document isn't parsed again, whether it's
+    # in memory or only on disk (e.g. from another process).
+    def fail(html):
+        raise AssertionError('Visible text was extracted twice')
+    monkeypatch.setattr(wd, '_get_visible_text', fail)
+    assert wd.extract_visible_text(html) == 'Some cached text.'
+    monkeypatch.setattr(wd, '_text_cache', LRUCache(2))
+    assert wd.extract_visible_text(html) == 'Some cached text.'
+
+
+def test_source_diff_with_workers():
+    a = ''.join(f'<p>Line {index} is old</p>\n' if index % 10 == 0
+                else f'<p>Line {index}</p>\n' for index in range(100))
+    b = a.replace('old', 'new')
+    result = wd.html_source_diff(a, b, workers=2)
+    assert result == wd.html_source_diff(a, b)
+    assert result['change_count'] == 20
+
+
+def test_segmented_dmp_diff_splits_at_unique_lines():
+    a = 'header\none\nsame\ntwo\nfooter'
+    b = 'header\nuno\nsame\ndos\nfooter'
+    assert wd._segment_by_lines(a, b) == [(0, 7, 0, 7),
+                                          (7, 11, 7, 11),
+                                          (11, 16, 11, 16),
+                                          (16, 20, 16, 20),
+                                          (20, 26, 20, 26)]
+    result = wd.compute_segmented_dmp_diff(a, b)
+    assert ''.join(text for change, text in result if change <= 0) == a
+    assert ''.join(text for change, text in result if change >= 0) == b
+
+
+def test_segmented_dmp_diff_splits_at_unique_paragraphs():
+    a = 'Intro\nMore\n\nSame\nMore\n\nOld\nEnd'
+    b = 'Intro\nMore\n\nSame\nMore\n\nNew\nEnd'
+    # "More" isn't unique, but the paragraphs it's in are.
+    assert wd._segment_by_lines(a, b, paragraphs=True) == [(0, 23, 0, 23),
+                                                           (23, 27, 23, 27),
+                                                           (27, 30, 27, 30)]
+
+
+def test_segmented_dmp_diff_shares_time_limit():
+    a = ''.join(f'Line {index} is {"old" if index % 50 == 0 else "the same"}\n'
+                for index in range(10000))
+    b = a.replace('old', 'new')
+    # The whole diff can't be done in this little time, but each segment can.
+    result = wd.compute_dmp_diff(a, b, timelimit=0.001)
+    assert len([change for change in result if change[0]]) == 2
+    result = wd.compute_segmented_dmp_diff(a, b, timelimit=0.001)
+    assert len([change for change in result if change[0]]) == 400
+
+
+def test_text_and_source_diffs_counts_only():
+    a = '<p>Some old text.</p><p>Unchanged</p>'
+    b = '<p>Some new text, café.</p><p>Unchanged</p>'
+    expected = {'change_count': 3,
+                'insertions_count': 2,
+                'deletions_count': 1,
+                'inserted_chars': 9,
+                'deleted_chars': 3,
+                'inserted_bytes': 10,
+                'deleted_bytes': 3}
+    assert wd.html_text_diff(a, b, counts_only=True) == expected
+    assert wd.html_source_diff(a, b, counts_only=True) == expected
+    full = wd.html_source_diff(a, b)['diff']
+    assert [change[0] for change in full if change[0]] == [-1, 1, 1]
@@ -1,3 +1,4 @@
+import concurrent.futures
 import json
 import mimetypes
 import os
@@ -75,6 +76,145 @@ class DiffingServerEtagTest(DiffingServerTestCase):
                 self.assertEqual(mismatch_response.code, 200)
 
 
+class DiffingServerTimingsTest(DiffingServerTestCase):
+    def test_timings(self):
+        with tempfile.NamedTemporaryFile() as a:
+            with tempfile.NamedTemporaryFile() as b:
+                a.write(b'<p>Hello there</p>')
+                a.flush()
+                b.write(b'<p>Hello world</p>')
+                b.flush()
+                response = self.fetch('/html_token?timings=true&'
+                                      f'a=file://{a.name}&b=file://{b.name}')
+                self.assertEqual(response.code, 200)
+                result = json.loads(response.body)
+                assert 'tokenize' in result['timings']
+                assert 'tokenize;dur=' in response.headers['Server-Timing']
+
+    def test_no_timings_by_default(self):
+        with tempfile.NamedTemporaryFile() as a:
+            with tempfile.NamedTemporaryFile() as b:
+                response = self.fetch('/html_token?timings=false&'
+                                      f'a=file://{a.name}&b=file://{b.name}')
+                self.assertEqual(response.code, 200)
+                assert 'timings' not in json.loads(response.body)
+                assert 'Server-Timing' not in response.headers
+
+
+class DiffingServerCountsOnlyTest(DiffingServerTestCase):
+    def test_counts_only(self):
+        with tempfile.NamedTemporaryFile() as a:
+            with tempfile.NamedTemporaryFile() as b:
+                a.write(b'<p>Hello there <a href="/a">A</a></p>')
+                a.flush()
+                b.write(b'<p>Hello world <a href="/b">B</a></p>')
+                b.flush()
+                for differ in ('html_token', 'html_text_dmp',
+                               'html_source_dmp', 'links_json'):
+                    response = self.fetch(f'/{differ}?counts_only=true&'
+                                          f'a=file://{a.name}&'
+                                          f'b=file://{b.name}')
+                    self.assertEqual(response.code, 200)
+                    result = json.loads(response.body)
+                    assert 'diff' not in result
+                    assert result['change_count'] > 0
+                    assert 'insertions_count' in result
+
+
+class DiffingServerStreamTest(DiffingServerTestCase):
+    def test_stream(self):
+        with tempfile.NamedTemporaryFile() as a:
+            with tempfile.NamedTemporaryFile() as b:
+                a.write(b'<p>Hello there</p>')
+                a.flush()
+                b.write(b'<p>Hello world</p>')
+                b.flush()
+                query = (f'include=all&a=file://{a.name}&b=file://{b.name}')
+                response = self.fetch(f'/html_token?stream=true&{query}')
+                self.assertEqual(response.code, 200)
+                assert response.headers['Content-Type'].startswith(
+                    'application/json')
+                result = json.loads(response.body)
+                expected = json.loads(self.fetch(f'/html_token?{query}').body)
+                assert result == expected
+
+    def test_stream_error(self):
+        with tempfile.NamedTemporaryFile() as a:
+            response = self.fetch('/html_token?stream=true&'
+                                  f'a=file://{a.name}&b=file://{a.name}&'
+                                  'timelimit=nonsense')
+            self.assertEqual(response.code, 500)
+
+    def test_stream_retries_broken_process_pool(self):
+        # Kill a process in the pool so that it's broken when the diff runs.
+        executor = concurrent.futures.ProcessPoolExecutor(1)
+        with self.assertRaises(concurrent.futures.process.BrokenProcessPool):
+            executor.submit(os._exit, 1).result()
+        self._app.settings['diff_executor'] = executor
+
+        with tempfile.NamedTemporaryFile() as a:
+            a.write(b'<p>Hello there</p>')
+            a.flush()
+            response = self.fetch('/html_token?stream=true&include=all&'
+                                  f'a=file://{a.name}&b=file://{a.name}')
+            self.assertEqual(response.code, 200)
+            assert json.loads(response.body)['change_count'] == 0
+            assert self._app.settings['diff_executor'] is not executor
+
+
+class DiffingServerSeriesTest(DiffingServerTestCase):
+    def test_series(self):
+        with tempfile.TemporaryDirectory() as directory:
+            urls = []
+            for index, text in enumerate(('Hello there', 'Hello world',
+                                          'Goodbye world')):
+                path = os.path.join(directory, f'{index}.html')
+                with open(path, 'w') as file:
+                    file.write(f'<p>{text}</p>')
+                urls.append(f'file://{path}')
+
+            query = '&'.join(f'url={url}' for url in urls)
+            response = self.fetch(f'/series?against_first=true&{query}')
+            self.assertEqual(response.code, 200)
+            assert response.headers['Content-Type'].startswith(
+                'application/x-ndjson')
+            results = [json.loads(line) for line
+                       in response.body.decode().splitlines()]
+            assert [(result['a'], result['b']) for result in results] == \
+                [(0, 1), (1, 2), (0, 2)]
+            for result in results:
+                a_url = result.pop('a_url')
+                b_url = result.pop('b_url')
+                assert (a_url, b_url) == (urls[result.pop('a')],
+                                          urls[result.pop('b')])
+                expected = json.loads(self.fetch(
+                    f'/html_token?a={a_url}&b={b_url}').body)
+                assert result == {**expected, 'type': 'series'}
+
+    def test_series_requires_two_urls(self):
+        response = self.fetch('/series?url=file:///tmp/a')
+        self.json_check(response)
+        self.assertEqual(response.code, 400)
+
+
+class DiffingServerTextTest(DiffingServerTestCase):
+    def test_text(self):
+        with tempfile.NamedTemporaryFile() as a:
+            a.write(b'<title>Title</title><p>Some <b>visible</b> text.</p>')
+            a.flush()
+            response = self.fetch(f'/text?url=file://{a.name}')
+            self.assertEqual(response.code, 200)
+            result = json.loads(response.body)
+            assert result['url'] == f'file://{a.name}'
+            assert result['text'] == 'Some  visible  text.'
+            assert result['type'] == 'text'
+
+    def test_text_requires_url(self):
+        response = self.fetch('/text')
+        self.json_check(response)
+        self.assertEqual(response.code, 400)
+
+
 class DiffingServerHealthCheckHandlingTest(DiffingServerTestCase):
 
     def test_healthcheck(self):
@@ -108,6 +248,28 @@ class DiffingServerFetchTest(DiffingServerTestCase):
             assert b_headers.get('Accept') != 'application/json'
 
 
+    def test_links_are_not_resolved_against_archive_urls(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            html = ('<a href="/about.html">About</a>'
+                    '<a href="news">News</a>'
+                    '<a href="#top">Top</a>')
+            mock.respond_to(r'/20170101000000/', body=html,
+                            headers={'Content-Type': 'text/html'})
+            mock.respond_to(r'/20170201000000/', body=html,
+                            headers={'Content-Type': 'text/html'})
+
+            response = self.fetch(
+                '/links_json?'
+                'a=https://web.archive.org/web/20170101000000/http://epa.gov/&'
+                'b=https://web.archive.org/web/20170201000000/http://epa.gov/')
+            self.assertEqual(response.code, 200)
+            result = json.loads(response.body)
+            assert result['change_count'] == 0
+            assert [link['href'] for _, link in result['diff']] == [
+                '/about.html', 'news']
+
+
 class DiffingServerExceptionHandlingTest(DiffingServerTestCase):
 
     def test_local_file_disallowed_in_production(self):
@@ -138,6 +300,14 @@ class DiffingServerExceptionHandlingTest(DiffingServerTestCase):
         self.assertEqual(response.code, 400)
         self.assertFalse(response.headers.get('Etag'))
 
+    def test_invalid_workers(self):
+        for workers in ('many', '0', '-2'):
+            response = self.fetch(f'/html_source_dmp?workers={workers}&'
+                                  'a=https://example.org/a&'
+                                  'b=https://example.org/b')
+            self.json_check(response)
+            self.assertEqual(response.code, 400)
+
     def test_invalid_diffing_method(self):
         response = self.fetch('/non_existing?format=json&include=all&'
                               'a=example.org&b=https://example.org')
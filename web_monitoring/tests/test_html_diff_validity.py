@@ -9,10 +9,25 @@ doesn’t break or throw exceptions.
 from pathlib import Path
 from pkg_resources import resource_filename
 import html5_parser
+from lxml import etree
 import pytest
 import re
+import sys
+import time
+import web_monitoring.html_diff_render
 from web_monitoring.diff_errors import UndiffableContentError
-from web_monitoring.html_diff_render import html_diff_render
+from web_monitoring.html_diff_render import (html_diff_render, tokenize,
+                                             html_diff_render_series,
+                                             _customize_tokens,
+                                             get_block_opcodes,
+                                             get_opcodes_in_time,
+                                             serialize_tokens,
+                                             deserialize_tokens,
+                                             FingerprintedToken,
+                                             LongTextToken,
+                                             SpacerToken,
+                                             UndiffableContentToken,
+                                             BLOCK_TAG, SEPARATABLE_TAG)
 
 
 # TODO: extend these to other html differs via parameterization, a la
@@ -175,3 +190,365 @@ def test_html_diff_works_on_documents_with_no_body():
 
     assert 'combined' in results
     assert isinstance(results['combined'], str)
+
+
+def test_html_diff_render_all_matches_individual_views():
+    a = '<p>Here is some <em>old</em> text.</p><ul><li>One</li></ul>'
+    b = '<p>Here is some <em>new</em> text.</p><ul><li>One</li><li>Two</li></ul>'
+    results = html_diff_render(a, b, include='all')
+    for view in ('combined', 'insertions', 'deletions'):
+        assert results[view] == html_diff_render(a, b, include=view)[view]
+
+
+def test_tokenize_handles_deeply_nested_elements():
+    root = etree.Element('div')
+    element = root
+    depth = sys.getrecursionlimit() + 1000
+    for _ in range(depth):
+        element = etree.SubElement(element, 'span')
+    element.text = 'Deep text'
+
+    tokens = tokenize(root)
+    assert [str(token) for token in tokens] == ['Deep', 'text']
+    assert len(tokens[0].pre_tags) == depth
+    assert len(tokens[-1].post_tags) == depth
+
+
+def test_html_diff_render_handles_deeply_nested_elements():
+    depth = 5000
+    a = '<div>' * depth + 'Some old text' + '</div>' * depth
+    b = a.replace('old', 'new')
+    results = html_diff_render(a, b)
+    assert results['change_count'] == 2
+    changes = re.findall(r'<(ins|del)[^>]*>(.*?)</\1>', results['combined'],
+                         re.DOTALL)
+    assert [(kind, text.strip()) for kind, text in changes] == [('del', 'old'),
+                                                                ('ins', 'new')]
+
+
+def test_html_diff_render_keeps_changes_within_blocks():
+    a = ('<ul><li><a href="/a">Share</a> this old page</li>'
+         '<li>Unchanged item</li></ul>'
+         '<p>Removed paragraph</p><h4>Heading</h4>')
+    b = ('<ul><li><a href="/b">Share</a> this new page</li>'
+         '<li>Unchanged item</li></ul>'
+         '<h4>Heading</h4>')
+    results = html_diff_render(a, b)
+
+    changes = results['combined'].split('<body>')[1]
+    changes = re.findall(r'<(ins|del)[^>]*>(.*?)</\1>', changes, re.DOTALL)
+    changes = [(kind, ' '.join(text.split())) for kind, text in changes]
+    assert changes == [('del', 'this old'),
+                       ('ins', 'this new'),
+                       ('del', 'Removed paragraph')]
+
+
+def test_tokenize_parses_tags():
+    tokens = tokenize(etree.fromstring('<div><p>Hello <em>there</em></p></div>'))
+    p_tag = tokens[0].pre_tags[-1]
+    assert p_tag == '<p>'
+    assert p_tag.name == 'p'
+    assert p_tag.open
+    assert p_tag.flags & BLOCK_TAG
+    assert p_tag.flags & SEPARATABLE_TAG
+
+    em_end_tag = tokens[1].post_tags[0]
+    assert em_end_tag == '</em>'
+    assert em_end_tag.name == 'em'
+    assert not em_end_tag.open
+    assert not em_end_tag.flags & BLOCK_TAG
+
+
+def test_html_diff_render_handles_many_small_changes():
+    def make_list(version):
+        items = ''.join(f'<li>Item {index} is {version}</li>' if index % 2
+                        else f'<li>Item {index} is the same</li>'
+                        for index in range(2000))
+        return f'<ul>{items}</ul>'
+
+    results = html_diff_render(make_list('old'), make_list('new'))
+    assert results['change_count'] == 2000
+    assert results['combined'].count('<del class="wm-diff">') == 1000
+    assert results['combined'].count('<ins class="wm-diff">') == 1000
+
+
+def test_html_diff_render_timings():
+    results = html_diff_render('<p>Hello there</p>', '<p>Hello world</p>',
+                               timings=True)
+    timings = results['timings']
+    assert list(timings) == ['parse', 'serialize', 'tokenize', 'customize',
+                             'match', 'assemble', 'render']
+    assert all(stage['seconds'] >= 0 for stage in timings.values())
+    assert timings['tokenize']['new_tokens'] == 2
+
+    assert 'timings' not in html_diff_render('<p>Hello</p>', '<p>Hi</p>')
+
+
+@pytest.mark.parametrize('granularity,expected', [
+    ('word', [('equal', 0, 6, 0, 6),
+              ('replace', 6, 7, 6, 7),
+              ('equal', 7, 9, 7, 9)]),
+    ('sentence', [('equal', 0, 3, 0, 3),
+                  ('replace', 3, 7, 3, 7),
+                  ('equal', 7, 9, 7, 9)]),
+    ('block', [('replace', 0, 9, 0, 9)]),
+    ('body', [('replace', 0, 9, 0, 9)]),
+])
+def test_get_block_opcodes_granularity(granularity, expected):
+    def get_tokens(text):
+        return _customize_tokens(tokenize(etree.fromstring(f'<p>{text}</p>')))
+
+    old = get_tokens('First sentence here. Second one is old. Third stays.')
+    new = get_tokens('First sentence here. Second one is new. Third stays.')
+    assert get_block_opcodes(old, new, granularity) == expected
+
+
+def test_html_diff_render_falls_back_when_out_of_time():
+    a = '<p>Here is some old text.</p>'
+    b = '<p>Here is some new text.</p>'
+    assert html_diff_render(a, b)['granularity'] == 'word'
+
+    results = html_diff_render(a, b, timelimit=0)
+    assert results['granularity'] == 'body'
+    assert results['change_count'] == 2
+
+
+def test_get_opcodes_in_time_stays_within_time_limit():
+    # Every block changed, so pairing the blocks up and diffing each pair
+    # word by word both take a lot longer than the time limit.
+    def get_tokens(seed):
+        html = ''.join('<p>' + ' '.join(f'w{(index * seed + block) % 300}'
+                                        for index in range(1000)) + '</p>'
+                       for block in range(100))
+        return _customize_tokens(tokenize(html))
+
+    old = get_tokens(7)
+    new = get_tokens(13)
+    timelimit = 0.5
+    start = time.perf_counter()
+    _, granularity = get_opcodes_in_time(old, new,
+                                         deadline=start + timelimit)
+    assert time.perf_counter() - start < timelimit + 0.5
+    assert granularity != 'word'
+
+
+def test_html_diff_render_hierarchical_block_mode():
+    a = ('<p>First paragraph is the same.</p>'
+         '<p>Second paragraph has old text.</p>'
+         '<p>Removed paragraph says old text.</p>')
+    b = ('<p>First paragraph is the same.</p>'
+         '<p>Second paragraph has new text.</p>'
+         '<h2>Added heading</h2>')
+    results = html_diff_render(a, b, block_mode='hierarchical')
+
+    changes = results['combined'].split('<body>')[1]
+    changes = re.findall(r'<(ins|del)[^>]*>(.*?)</\1>', changes, re.DOTALL)
+    changes = [(kind, ' '.join(re.sub(r'<[^>]+>', ' ', text).split()))
+               for kind, text in changes]
+    assert changes == [('del', 'old text.'),
+                       ('ins', 'new text.'),
+                       ('del', 'Removed paragraph says old text.'),
+                       ('ins', 'Added heading')]
+
+    with pytest.raises(ValueError):
+        html_diff_render(a, b, block_mode='nonsense')
+
+
+@pytest.mark.parametrize('block_mode,expected', [
+    # The deleted list item is diffed along with the changed paragraph.
+    ('grouped', [('equal', 0, 1, 0, 1),
+                 ('delete', 1, 6, 1, 1),
+                 ('equal', 6, 9, 1, 4)]),
+    # The deleted list item is deleted as a whole.
+    ('hierarchical', [('equal', 0, 2, 0, 2),
+                      ('replace', 2, 9, 2, 4)]),
+])
+def test_get_block_opcodes_block_mode(block_mode, expected):
+    def get_tokens(html):
+        return _customize_tokens(tokenize(etree.fromstring(f'<div>{html}</div>')))
+
+    old = get_tokens('<p>Alpha beta gamma.</p>'
+                     '<ul><li>Words from alpha beta gamma delta.</li></ul>')
+    new = get_tokens('<p>Alpha beta gamma delta.</p>')
+    assert get_block_opcodes(old, new, block_mode=block_mode) == expected
+
+
+def test_html_diff_render_with_workers(monkeypatch):
+    monkeypatch.setattr('web_monitoring.html_diff_render.PARALLEL_MIN_COMPARISONS', 1)
+    a = ''.join(f'<p>Paragraph {index} has some old text.</p>'
+                for index in range(10))
+    b = ''.join(f'<p>Paragraph {index} has some new text.</p>'
+                for index in range(10))
+    assert html_diff_render(a, b, workers=2) == html_diff_render(a, b)
+
+
+def test_serialize_tokens():
+    html = ('<div><p>Hello <a href="/there">there</a>!</p>'
+            '<img src="picture.jpg" alt="A picture">'
+            '<script>alert("hi")</script><a href="/empty"></a></div>')
+    tokens = _customize_tokens(tokenize(html))
+    loaded = deserialize_tokens(serialize_tokens(tokens))
+    assert [repr(token) for token in loaded] == [repr(token) for token in tokens]
+    assert [type(token) for token in loaded] == [type(token) for token in tokens]
+    for token, loaded_token in zip(tokens, loaded):
+        for tag, loaded_tag in zip(token.pre_tags + token.post_tags,
+                                   loaded_token.pre_tags + loaded_token.post_tags):
+            assert (loaded_tag.name, loaded_tag.open, loaded_tag.flags) == \
+                (tag.name, tag.open, tag.flags)
+
+
+def test_fingerprinted_tokens():
+    script = '<script>' + 'var x = 1;' * 1000 + '</script>'
+    long_word = 'x' * 1000
+    html = f'<div><p>Hello {long_word} there</p>{script}</div>'
+    tokens = tokenize(html)
+    fingerprinted = [token for token in tokens
+                     if isinstance(token, FingerprintedToken)]
+    assert [type(token) for token in fingerprinted] == [LongTextToken,
+                                                       UndiffableContentToken]
+    assert all(len(token) < 20 for token in fingerprinted)
+    assert fingerprinted[0].html() == long_word
+    assert fingerprinted[1] == tokenize(html)[tokens.index(fingerprinted[1])]
+
+    loaded = deserialize_tokens(serialize_tokens(tokens))
+    assert loaded == tokens
+    assert [token.html() for token in loaded] == [token.html() for token in tokens]
+
+    changed = html.replace('var x = 1;', 'var x = 2;', 1)
+    result = html_diff_render(html, changed, include='all')
+    assert long_word in result['combined']
+    assert 'var x = 2;' in result['insertions']
+    assert 'var x = 1;' in result['deletions']
+    assert result['change_count'] == 2
+
+
+def test_html_diff_render_uses_token_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('DIFFER_TOKEN_CACHE_PATH', str(tmp_path))
+    a = '<p>Here is some <a href="/old">old</a> text.</p>'
+    b = '<p>Here is some <a href="/new">new</a> text.</p>'
+    first = html_diff_render(a, b, timings=True)
+    assert first.pop('timings')['tokenize']['cached'] == 0
+    second = html_diff_render(a, b, timings=True)
+    assert second.pop('timings')['tokenize']['cached'] == 2
+    assert second == first
+
+
+def test_html_diff_render_counts_only():
+    a = '<p>Here is some old text.</p>'
+    b = '<p>Here is some new text, café.</p>'
+    result = html_diff_render(a, b, counts_only=True)
+    full = html_diff_render(a, b)
+    assert 'combined' not in result
+    for key in ('change_count', 'insertions_count', 'deletions_count',
+                'granularity'):
+        assert result[key] == full[key]
+    assert result['deleted_chars'] == len('old text.')
+    assert result['inserted_chars'] == len('new text, café.')
+    assert result['inserted_bytes'] == result['inserted_chars'] + 1
+
+
+def test_html_diff_render_series():
+    versions = ['<p>The first version.</p>',
+                '<title>Second</title><p>The second version.</p>',
+                '<p>The second version, again.</p><p>Plus more.</p>',
+                '<p>The last version.</p>']
+    series = list(html_diff_render_series(versions, include='all',
+                                          against_first=True))
+    assert [(a, b) for a, b, _ in series] == [(0, 1), (1, 2), (0, 2), (2, 3),
+                                              (0, 3)]
+    for a, b, result in series:
+        assert result == html_diff_render(versions[a], versions[b],
+                                          include='all')
+
+
+def test_html_diff_render_context():
+    def make_list(changed):
+        items = ''.join(f'<li>Item {index}</li>' for index in range(20))
+        return f'<div><ul>{items}</ul><p>The end.</p></div>'.replace(
+            'Item 10<', f'Item 10 {changed}<')
+
+    results = html_diff_render(make_list('old'), make_list('new'),
+                               include='context', context_blocks=1)
+    assert list(results) == ['change_count', 'deletions_count',
+                             'insertions_count', 'granularity', 'context']
+    soup = html5_parser.parse(results['context'], treebuilder='soup',
+                              return_root=False)
+    items = [' '.join(item.get_text().split())
+             for item in soup.select('body > div > ul > li')]
+    assert items == ['Item 9', 'Item 10 old new', 'Item 11']
+    placeholders = soup.select('.wm-diff-elided')
+    assert len(placeholders) == 2
+    assert placeholders[0]['data-wm-diff-elided'] == '18'
+    assert soup.select('body > div > p') == []
+
+
+def test_html_diff_render_patch():
+    a = ('<p>Here is some old text.</p><script>var x = 1;</script>'
+         '<ul><li>One</li><li>Gone</li></ul>')
+    b = '<p>Here is some new text.</p><ul><li>One</li><li>Two</li></ul>'
+    results = html_diff_render(a, b, include='patch')
+    assert 'combined' not in results
+    assert results['patch'] == {
+        'version': 1,
+        'b_tokens': 7,
+        'changes': [
+            [3, 5, 'old text.<template class="wm-diff-deleted-inert">'
+                   '<script>var x = 1;</script></template>'],
+            [6, 7, 'Gone'],
+        ]
+    }
+
+
+def test_html_diff_render_stream():
+    a = '<p>Here is some old text.</p>'
+    b = '<p>Here is some new text.</p>'
+    results = html_diff_render(a, b, include='all', stream=True)
+    expected = html_diff_render(a, b, include='all')
+    for view in ('combined', 'insertions', 'deletions'):
+        assert not isinstance(results[view], str)
+        assert ''.join(results[view]) == expected[view]
+
+
+def test_html_diff_render_stream_serializes_in_pieces(monkeypatch):
+    monkeypatch.setattr(web_monitoring.html_diff_render,
+                        'STREAM_CHUNK_SIZE', 100)
+    a = ('<title>Old</title><div class="x"><p>Here is <b>some</b> old text.'
+         '</p><pre>  keep\n    this  </pre><!-- note --><br><img src="a.png">'
+         '</div>') * 10
+    b = a.replace('old', 'new').replace('Old', 'New')
+    results = html_diff_render(a, b, include='all', stream=True)
+    expected = html_diff_render(a, b, include='all')
+    for view in ('combined', 'insertions', 'deletions'):
+        chunks = list(results[view])
+        assert len(chunks) > 10
+        assert ''.join(chunks) == expected[view]
+
+
+def test_html_diff_render_patch_positions_match_tokenize():
+    # The empty `<a>` gets a spacer token in the diff, which shouldn't shift
+    # positions in the patch.
+    a = ('<p>Some old text.</p><div><span><a name="x"></a></span></div>'
+         '<p>More <img src="old.png"> words. <a href="/old">Link</a></p>')
+    b = a.replace('old', 'new').replace('Link', 'New link')
+    patch = html_diff_render(a, b, include='patch')['patch']
+    assert patch['b_tokens'] == len(tokenize(b))
+
+    # Replacing the changed tokens in `b` with the deleted HTML gets back `a`.
+    # (Customizing changes how links are rendered, but keeps the tokens
+    # otherwise lined up with `tokenize()`.)
+    def token_html(token):
+        return token.html() + token.trailing_whitespace
+
+    a_tokens = _customize_tokens(tokenize(a))
+    b_tokens = [token for token in _customize_tokens(tokenize(b))
+                if not isinstance(token, SpacerToken)]
+    assert len(b_tokens) == patch['b_tokens']
+
+    result = []
+    position = 0
+    for start, end, deleted in patch['changes']:
+        result.extend(token_html(token) for token in b_tokens[position:start])
+        result.append(deleted)
+        position = end
+    result.extend(token_html(token) for token in b_tokens[position:])
+    assert ''.join(result) == ''.join(token_html(token) for token in a_tokens)
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from web_monitoring.link_index import LinkIndex
+
+
+START = datetime(2018, 1, 1, tzinfo=timezone.utc)
+VERSIONS = [
+    ('v1', '<a href="/data.csv">Data</a><a href="/about">About</a>'),
+    ('v2', '<a href="/data.csv">Data</a><a href="/about">About us</a>'),
+    ('v3', '<a href="/about">About us</a><a href="/new">New</a>'),
+]
+
+
+@pytest.fixture
+def index():
+    with LinkIndex() as index:
+        # Add them out of order to make sure order comes from capture time.
+        for position in (2, 0, 1):
+            version_id, text = VERSIONS[position]
+            assert index.add_version('page', version_id,
+                                     START + timedelta(days=position), text)
+        yield index
+
+
+def test_link_index_first_and_last_seen(index):
+    assert index.first_seen('page', '/data.csv') == {
+        'version_id': 'v1',
+        'capture_time': START,
+    }
+    assert index.last_seen('page', '/data.csv') == {
+        'version_id': 'v2',
+        'capture_time': START + timedelta(days=1),
+        'removed_in': 'v3',
+    }
+    assert index.first_seen('page', '/about', text='ABOUT US')['version_id'] == 'v2'
+    assert index.last_seen('page', '/about')['removed_in'] is None
+    assert index.first_seen('page', '/nope') is None
+    assert index.first_seen('other-page', '/data.csv') is None
+
+
+def test_link_index_diff_versions(index):
+    assert index.diff_versions('page', 'v1', 'v3') == {
+        'added': [{'href': '/about', 'text': 'About us'},
+                  {'href': '/new', 'text': 'New'}],
+        'removed': [{'href': '/about', 'text': 'About'},
+                    {'href': '/data.csv', 'text': 'Data'}],
+    }
+    with pytest.raises(KeyError):
+        index.diff_versions('page', 'v1', 'v4')
+
+
+def test_link_index_updates_incrementally(tmp_path):
+    path = str(tmp_path / 'links.sqlite3')
+    with LinkIndex(path) as index:
+        index.add_version('page', 'v1', START, VERSIONS[0][1])
+
+    with LinkIndex(path) as index:
+        assert index.has_version('page', 'v1')
+        assert not index.add_version('page', 'v1', START, VERSIONS[0][1])
+        index.add_version('page', 'v2', START + timedelta(days=1),
+                          VERSIONS[2][1])
+        assert index.last_seen('page', '/data.csv')['removed_in'] == 'v2'
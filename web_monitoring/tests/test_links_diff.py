@@ -1,8 +1,14 @@
+import html5_parser
+import json
 from pathlib import Path
 from pkg_resources import resource_filename
 import pytest
 from web_monitoring.diff_errors import UndiffableContentError
-from web_monitoring.links_diff import links_diff, links_diff_html
+from web_monitoring.links_diff import (links_diff, links_diff_html,
+                                       links_diff_json, canonicalize_href,
+                                       CHANGE_INFO,
+                                       not_deleted, not_inserted,
+                                       _html_for_text_diff)
 
 
 def test_links_diff_only_includes_links():
@@ -98,3 +104,245 @@ def test_links_diff_should_not_check_content_if_content_type_options_is_ignore()
         a_headers={'Content-Type': 'text/html'},
         b_headers={'Content-Type': 'application/pdf'},
         content_type_options='ignore')
+
+
+def test_links_diff_link_text():
+    html = """
+           <a href="/script">Some <script>ignored()</script>text</a>
+           <a href="/nested"><span>Nested <b>text</b></span> and more</a>
+           <a href="/tooltip" title="A tooltip"><img src="whatever.jpg"
+              alt=""><!-- not text --></a>
+           <a href="/empty-tooltip" title="">   </a>
+           <a href="/nothing"></a>
+           """
+    links = links_diff_json(html, html)['diff']
+    assert sorted(link['text'] for _, link in links) == [
+        'Nested text and more',
+        'Some text',
+        '[image]',
+        '[no text]',
+        '[tooltip: ]',
+    ]
+
+
+def test_links_diff_matches_links():
+    html_a = """
+             <a href="/same">Same</a>
+             <a href="/text-changes">Old text</a>
+             <a href="/old-href">Href changes</a>
+             <a href="/removed">Removed</a>
+             """
+    html_b = """
+             <a href="/added">Added</a>
+             <a href="/old-href/new">Href changes</a>
+             <a href="/same">SAME</a>
+             <a href="/text-changes">New text</a>
+             """
+    result = links_diff_json(html_a, html_b)
+    assert result['change_count'] == 4
+    assert [(code, link.get('hrefs', link.get('href')))
+            for code, link in result['diff']] == [
+        (1, '/added'),
+        (100, ('/old-href', '/old-href/new')),
+        (100, ('/text-changes', '/text-changes')),
+        (-1, '/removed'),
+        (0, '/same'),
+    ]
+    assert result == links_diff_json(html_a, html_b)
+
+
+def test_links_diff_result_is_small():
+    html_a = '<title>Old title</title><a href="/a">A link</a>'
+    html_b = '<title>New title</title><a href="/b">A link</a>'
+    result = links_diff(html_a, html_b)
+    assert set(result) == {'change_count', 'diff', 'a_title', 'b_title'}
+    assert (result['a_title'], result['b_title']) == ('Old title', 'New title')
+    # The whole result should be serializable, e.g. for the diffing server.
+    json.dumps(result)
+    assert 'New title' in links_diff_html(html_a, html_b)['diff']
+
+
+def test_links_diff_html_matches_reference_renderer():
+    for name in ('change-href', 'change-link-text', 'change-list-href',
+                 'change-list-text', 'add-list', 'remove-list'):
+        before = Path(resource_filename('web_monitoring',
+                                        f'example_data/{name}.before'))
+        after = Path(resource_filename('web_monitoring',
+                                       f'example_data/{name}.after'))
+        a, b = before.read_text(), after.read_text()
+        diff = links_diff(a, b)
+        expected = _reference_render_html_diff(diff['diff'])
+        expected.title.string = diff['b_title']
+        actual = links_diff_html(a, b)['diff']
+        assert _normalize_html(actual) == \
+            _normalize_html(expected.prettify(formatter=None))
+
+
+def test_links_diff_html_escapes_links():
+    html_a = '<a href="/a?x=1&amp;y=2">Fish &amp; &lt;chips&gt;</a>'
+    html_b = '<a href="/b&quot;onclick=&quot;">Fish &amp; &lt;chips&gt;</a>'
+    result = links_diff_html(html_a, html_b)['diff']
+    assert 'Fish &amp; &lt;chips&gt;' in result
+    assert 'href="/a?x=1&amp;y=2"' in result
+    assert 'href="/b&quot;onclick=&quot;"' in result
+
+
+@pytest.mark.parametrize('href,base_url,expected', [
+    ('/about', None, '/about'),
+    ('/about', 'https://example.gov/page', 'https://example.gov/about'),
+    ('about', 'https://example.gov/dir/page', 'https://example.gov/dir/about'),
+    ('HTTP://Example.GOV:80', None, 'http://example.gov/'),
+    ('https://example.gov:443/a?x=1', None, 'https://example.gov/a?x=1'),
+    ('https://example.gov:8443/a', None, 'https://example.gov:8443/a'),
+    ('https://example.gov/a?utm_source=x&id=5&fbclid=y#top', None,
+     'https://example.gov/a?id=5#top'),
+    ('  /spaces  ', None, '/spaces'),
+    ('mailto:someone@example.gov', 'https://example.gov/',
+     'mailto:someone@example.gov'),
+    ('http://example.gov:nope/', None, 'http://example.gov:nope/'),
+])
+def test_canonicalize_href(href, base_url, expected):
+    assert canonicalize_href(href, base_url) == expected
+
+
+def test_links_diff_resolves_links_with_urls():
+    html_a = """
+             <a href="/data?utm_campaign=email">Data</a>
+             <a href="https://example.gov/page#section">Section</a>
+             """
+    html_b = """
+             <base href="/new-base/">
+             <a href="HTTPS://example.gov:443/data">Data</a>
+             <a href="other">Other</a>
+             """
+    result = links_diff_json(html_a, html_b,
+                             a_page_url='https://example.gov/page',
+                             b_page_url='https://example.gov/page')
+    assert result['diff'] == [
+        (0, {'href': 'https://example.gov/data', 'text': 'Data'}),
+        (1, {'href': 'https://example.gov/new-base/other', 'text': 'Other'}),
+    ]
+
+
+def test_links_diff_counts_only():
+    html_a = '<a href="/a">A</a><a href="/b">B</a><a href="/c">C</a>'
+    html_b = '<a href="/a">A</a><a href="/b">Bee</a><a href="/d">D</a>'
+    result = links_diff_json(html_a, html_b, counts_only=True)
+    assert result == {'change_count': 3,
+                      'insertions_count': 1,
+                      'deletions_count': 1}
+    assert result['change_count'] == links_diff_json(html_a,
+                                                     html_b)['change_count']
+
+
+def _normalize_html(text):
+    """
+    List the elements, attributes, and (whitespace-normalized) text of the
+    body of an HTML document, so documents that differ only in formatting can
+    be compared.
+    """
+    body = html5_parser.parse(text).find('body')
+    result = []
+    for element in body.iter():
+        result.append((element.tag, sorted(element.attrib.items())))
+        for text in (element.text, element.tail):
+            text = ' '.join((text or '').split())
+            if text:
+                result.append(text)
+    return result
+
+
+# The original Beautiful Soup-based renderer for `links_diff_html()`, kept as
+# a reference for the string-based one.
+def _reference_render_html_diff(raw_diff):
+    result = html5_parser.parse("""<!doctype html>
+        <html>
+            <head>
+                <meta charset="utf-8">
+                <title></title>
+            </head>
+            <body>
+            </body>
+        </html>
+        """, treebuilder='soup', return_root=False)
+    tag = _reference_tagger(result)
+    result.body.append(
+        tag('table', {'class': 'links-list'},
+            tag('col', {'class': 'links-list--change-type-col'}),
+            tag('col', {'class': 'links-list--text-col'}),
+            tag('col', {'class': 'links-list--href-col'}),
+            tag('thead', {},
+                tag('tr', {},
+                    tag('th'),
+                    tag('th', {}, 'Link Text'),
+                    tag('th', {}, 'URL'))),
+            tag('tbody', {}, *(
+                _reference_table_row_for_link(result, code, link)
+                for code, link in raw_diff))))
+
+    return result
+
+
+def _reference_tagger(soup):
+    def tagger(name, attributes=None, *children):
+        tag = soup.new_tag(name)
+        if attributes:
+            for key, value in attributes.items():
+                # Remove boolean attributes that are False
+                if value is not None and value is not False:
+                    tag[key] = value
+
+        for child in children:
+            tag.append(child)
+
+        return tag
+    return tagger
+
+
+def _reference_table_row_for_link(soup, change_type, link):
+    tag = _reference_tagger(soup)
+    row = tag('tr', {
+        'class': 'links-list--item',
+        'wm-has-insertions': change_type > 0,
+        'wm-inserted': change_type == 1,
+        'wm-has-deletions': change_type < 0 or change_type == 100,
+        'wm-deleted': change_type == -1,
+    })
+
+    change = CHANGE_INFO[change_type] or CHANGE_INFO[0]
+    row.append(tag('td', {
+        'class': 'links-list--change-type',
+        'title': change['title'],
+    }, change['symbol']))
+
+    text_cell = tag('td', {'class': 'links-list--text'})
+    row.append(text_cell)
+    if change_type == 100:
+        text_insertions = filter(not_deleted, link['text'])
+        text_cell.append(_html_for_text_diff(text_insertions))
+        if len(link['text']) != 1:
+            text_cell.append(tag('br'))
+            text_deletions = filter(not_inserted, link['text'])
+            text_cell.append(_html_for_text_diff(text_deletions))
+    else:
+        text_cell.append(link['text'])
+
+    href_cell = tag('td', {'class': 'links-list--href'})
+    row.append(href_cell)
+    if change_type == 100:
+        href_insertions = filter(not_deleted, link['href'])
+        url_text = _html_for_text_diff(href_insertions)
+        url = link['hrefs'][1]
+        href_cell.append(tag('a', {'href': url}, f'({url_text})'))
+
+        if link['hrefs'][0] != link['hrefs'][1]:
+            href_cell.append(tag('br'))
+            href_deletions = filter(not_inserted, link['href'])
+            url_text = _html_for_text_diff(href_deletions)
+            url = link['hrefs'][0]
+            href_cell.append(tag('a', {'href': url}, f'({url_text})'))
+    else:
+        url = link['href']
+        href_cell.append(tag('a', {'href': url}, f'({url})'))
+
+    return row
@@ -1,6 +1,10 @@
 from datetime import datetime
+import os
 import requests_mock
-from web_monitoring.utils import extract_title, retryable_request, rate_limited
+from web_monitoring.utils import (extract_title, FileCache,
+                                  longest_increasing_pairs, LRUCache,
+                                  parallel_map, retryable_request,
+                                  rate_limited)
 
 
 def test_extract_title():
@@ -80,3 +84,44 @@ def test_retryable_request_with_custom_retry_logic():
         response = retryable_request('GET', 'http://test.com', backoff=0,
                                      should_retry=lambda r: r.status_code == 400)
         assert response.status_code == 200
+
+
+def test_longest_increasing_pairs():
+    pairs = [(0, 3), (1, 1), (2, 4), (3, 2), (4, 5), (5, 0)]
+    assert longest_increasing_pairs(pairs) == [(1, 1), (3, 2), (4, 5)]
+    assert longest_increasing_pairs([]) == []
+
+
+def test_parallel_map():
+    items = list(range(20))
+    assert parallel_map(abs, items, workers=3) == items
+    assert parallel_map(abs, items) == items
+
+
+def test_parallel_map_reuses_processes():
+    items = list(range(20))
+    first = set(parallel_map(_process_id, items, workers=2))
+    second = set(parallel_map(_process_id, items, workers=2))
+    assert len(first | second) <= 2
+
+
+def _process_id(_):
+    return os.getpid()
+
+
+def test_file_cache(tmp_path):
+    cache = FileCache(str(tmp_path))
+    assert cache.get('abc123') is None
+    cache.set('abc123', b'Some data')
+    assert cache.get('abc123') == b'Some data'
+    assert FileCache(str(tmp_path)).get('abc123') == b'Some data'
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
@@ -1,10 +1,14 @@
-from collections import defaultdict
+import bisect
+from collections import OrderedDict, defaultdict
+import concurrent.futures
 from contextlib import contextmanager
 import hashlib
 import io
 import lxml.html
 import os
 import requests
+import sys
+import tempfile
 import time
 
 
@@ -122,3 +126,211 @@ def get_color_palette():
     differ_deletion = os.environ.get('DIFFER_COLOR_DELETION', '#e8a4c8')
     return {'differ_insertion': differ_insertion,
             'differ_deletion': differ_deletion}
+
+
+class FileCache:
+    """
+    A cache of bytes stored as files in a directory, keyed by strings (usually
+    content hashes). Files are written atomically, so multiple processes can
+    safely share the same directory.
+
+    Examples
+    --------
+    >>> cache = FileCache('/tmp/cache/tokens')
+    >>> cache.set(hash_content(content), data)
+    >>> cache.get(hash_content(content))
+    b'...'
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key):
+        "Get the bytes stored for a key, or `None` if there aren't any."
+        try:
+            with open(self._key_path(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        "Store bytes for a key."
+        path = self._key_path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as file:
+            file.write(value)
+        os.replace(file.name, path)
+
+    def _key_path(self, key):
+        # Spread files across subdirectories so none get too big.
+        return os.path.join(self.path, key[:2], key)
+
+
+class LRUCache:
+    """
+    A cache of values in memory that holds up to `max_size` items, discarding
+    the least recently used ones to make room for new ones. It has the same
+    interface as `FileCache`, and can be put in front of one for values that
+    are used over and over.
+
+    Examples
+    --------
+    >>> cache = LRUCache(2)
+    >>> cache.set('a', 1)
+    >>> cache.get('a')
+    1
+    """
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        "Get the value stored for a key, or `None` if there isn't one."
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            return None
+        return self._items[key]
+
+    def set(self, key, value):
+        "Store a value for a key."
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+
+def longest_increasing_pairs(pairs):
+    """
+    Given a list of `(a, b)` pairs sorted by `a`, find the longest
+    subsequence of them where `b` is also increasing.
+    """
+    tails = []
+    tail_indexes = []
+    previous = []
+    for index, (_, value) in enumerate(pairs):
+        position = bisect.bisect_left(tails, value)
+        if position == len(tails):
+            tails.append(value)
+            tail_indexes.append(index)
+        else:
+            tails[position] = value
+            tail_indexes[position] = index
+        previous.append(tail_indexes[position - 1] if position else None)
+
+    result = []
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        result.append(pairs[index])
+        index = previous[index]
+    result.reverse()
+    return result
+
+
+def parallel_map(func, items, workers=None):
+    """
+    Like `map()`, but spreads the calls across a pool of `workers` processes
+    and returns a list of the results in order. If there are fewer than two
+    workers or items, this just calls `func` directly in the current process.
+
+    `func`, the items, and the results must all be picklable.
+    """
+    items = list(items)
+    workers = int(workers or 1)
+    if workers < 2 or len(items) < 2:
+        return [func(item) for item in items]
+
+    # Send items in batches so small items don't each cost a round trip.
+    chunksize = max(1, len(items) // (workers * 4))
+    try:
+        executor = _get_process_pool(workers)
+        return list(executor.map(func, items, chunksize=chunksize))
+    except concurrent.futures.process.BrokenProcessPool:
+        executor = _get_process_pool(workers, reset=True)
+        return list(executor.map(func, items, chunksize=chunksize))
+
+
+# The pool `parallel_map()` uses, as a tuple of the process ID that created
+# it, its size, and the pool itself.
+_process_pool = None
+
+
+def _get_process_pool(workers, reset=False):
+    """
+    Get a pool of `workers` processes. The same pool is reused across calls
+    (as long as they want the same number of workers) so that calling
+    `parallel_map()` over and over, e.g. once per diff, doesn't start new
+    processes every time.
+    """
+    global _process_pool
+    # A pool that was copied into this process by a fork doesn't work here.
+    if (reset or _process_pool is None
+            or _process_pool[:2] != (os.getpid(), workers)):
+        if _process_pool is not None and _process_pool[0] == os.getpid():
+            _process_pool[2].shutdown(wait=False)
+        _process_pool = (os.getpid(), workers,
+                         concurrent.futures.ProcessPoolExecutor(workers))
+    return _process_pool[2]
+
+
+class StageTimer:
+    """
+    Record how long each stage of a multi-step process (like a diff) takes,
+    how much memory it allocates, and any other useful numbers about it (like
+    how many tokens it produced).
+
+    Memory allocation is measured as the net change in the number of memory
+    blocks Python has allocated (see `sys.getallocatedblocks()`), which is
+    cheap to check but only approximates how much memory a stage used.
+
+    If `enabled` is false, stages are not measured at all, so code can always
+    be instrumented whether or not anybody asked for timings.
+
+    Examples
+    --------
+    >>> timer = StageTimer()
+    >>> with timer.stage('parse'):
+    ...     tokens = parse(text)
+    >>> timer.count('parse', tokens=len(tokens))
+    >>> timer.results()
+    {'parse': {'seconds': 0.0123, 'allocated_blocks': 2311, 'tokens': 405}}
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measure a block of code as part of the given stage. If the same stage
+        is measured more than once, the results are added together.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        stage = self._get_stage(name)
+        start_blocks = sys.getallocatedblocks()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            blocks = sys.getallocatedblocks() - start_blocks
+            stage['seconds'] = stage.get('seconds', 0) + seconds
+            stage['allocated_blocks'] = stage.get('allocated_blocks', 0) + blocks
+
+    def count(self, name, **counts):
+        "Record some arbitrary numbers about a stage."
+        if self.enabled:
+            self._get_stage(name).update(counts)
+
+    def results(self):
+        "Get a dict of each stage's measurements, in the order they started."
+        return {name: stage.copy() for name, stage in self.stages.items()}
+
+    def _get_stage(self, name):
+        return self.stages.setdefault(name, {})